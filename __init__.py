@@ -28,24 +28,39 @@ bl_info = {
     "category": "Sculpt",
     "location": "3D View > Tool shelf > Remesh"}
 
-import bpy
+try:
+    import bpy
+except ImportError:
+    # imported outside Blender, only the array core is usable: from .core import remesh
+    bpy = None
 
 # load and reload submodules
 ##################################
 
 modules = [
+    "profiling",
+    "particle_arrays",
+    "spatial_hash",
+    "triangle_grid",
+    "parallel_relax",
+    "mesh_extraction",
     "surface_particles",
     "draw_3d",
     "vector_fields",
+    "field_cache",
+    "core",
+    "pipeline",
     "particle_remesher",
     "ui",
+    "benchmarks",
+    "batch",
 ]
 
 import importlib
 
 imported_modules = []
 
-for module in modules:
+for module in modules if bpy else ():
     if module in locals():
         if hasattr(module, "unregister"):
             module.unregister()
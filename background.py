@@ -0,0 +1,90 @@
+'''
+Copyright (C) 2018 Jean Da Costa machado.
+Jean3dimensional@gmail.com
+
+Created by Jean Da Costa machado
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import threading
+import traceback
+
+# the cancel event of the BackgroundStages running on the current thread
+_worker = threading.local()
+
+
+class Cancelled(Exception):
+    """Raised by check_cancelled() to abandon a stage in the middle of its work."""
+
+
+def check_cancelled():
+    """Raises Cancelled on the worker thread of a cancelled BackgroundStages.
+
+    Long stretches of work that don't yield, like the field build and the
+    extraction, call this between their chunks. Anywhere else it does nothing.
+    """
+    cancelled = getattr(_worker, "cancelled", None)
+    if cancelled is not None and cancelled.is_set():
+        raise Cancelled()
+
+
+class BackgroundStages:
+    """Runs a stage generator on a worker thread, the owner only polls it.
+
+    stages must not touch Blender data, bpy isn't thread safe. feedback holds the
+    lines the generator yielded last. cancel() makes the worker stop at its next
+    yield, or at the next check_cancelled() of a stage that doesn't yield for a
+    while. For RemeshPipeline.solve that is a budgeted step chunk while spreading
+    and relaxing, a solver iteration or growth level while building the field and
+    a chunk of the extraction triangles. interrupted tells a stage was abandoned
+    that way, so its results are incomplete. A failure is kept as the formatted
+    traceback in error.
+    """
+
+    def __init__(self, stages):
+        self.stages = stages
+        self.feedback = []
+        self.error = None
+        self.interrupted = False
+        self.cancelled = threading.Event()
+        self.finished = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="tesselator solver", daemon=True)
+        self.thread.start()
+
+    @property
+    def done(self):
+        return self.finished.is_set()
+
+    def run(self):
+        _worker.cancelled = self.cancelled
+        try:
+            for feedback in self.stages:
+                self.feedback = feedback
+                if self.cancelled.is_set():
+                    break
+        except Cancelled:
+            self.interrupted = True
+        except Exception:
+            self.error = traceback.format_exc()
+        finally:
+            self.stages.close()
+            self.finished.set()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def join(self, timeout=None):
+        """Cancels and waits at most timeout seconds for the worker, returns whether it stopped."""
+        self.cancel()
+        return self.finished.wait(timeout)
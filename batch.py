@@ -0,0 +1,256 @@
+'''
+Copyright (C) 2018 Jean Da Costa machado.
+Jean3dimensional@gmail.com
+
+Created by Jean Da Costa machado
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from types import SimpleNamespace
+
+import bpy
+
+from .particle_remesher import ParticleTest
+from .pipeline import RemeshPipeline
+
+
+def _properties():
+    for name, value in vars(ParticleTest).items():
+        # properties are (function, keywords) tuples until the class is registered
+        if isinstance(value, tuple) and len(value) == 2 and isinstance(value[1], dict):
+            yield name, value[0], value[1]
+
+
+def _coerce(function, value):
+    if function is bpy.props.BoolProperty:
+        return value.lower() in {"1", "true", "yes", "on"} if isinstance(value, str) else bool(value)
+    if function is bpy.props.IntProperty:
+        return int(value)
+    if function is bpy.props.FloatProperty:
+        return float(value)
+    return value
+
+
+def default_params():
+    """The remesh operator settings and their defaults."""
+    params = {}
+    for name, function, keywords in _properties():
+        if "default" in keywords:
+            params[name] = _coerce(function, keywords["default"])
+        elif function is bpy.props.EnumProperty:
+            params[name] = keywords["items"][0][0]
+        elif function is bpy.props.BoolProperty:
+            params[name] = False
+        elif function is bpy.props.IntProperty:
+            params[name] = 0
+        elif function is bpy.props.FloatProperty:
+            params[name] = 0.0
+    return params
+
+
+def parse_settings(settings, params):
+    """params updated with name=value settings, each value parsed by the type of its property."""
+    params = dict(params)
+    functions = {name: function for name, function, keywords in _properties()}
+    for setting in settings:
+        name, _, value = setting.partition("=")
+        if name not in params:
+            raise ValueError("Unknown setting: %s" % name)
+        params[name] = _coerce(functions.get(name), value)
+    return params
+
+
+def job_name(spec):
+    path, _, name = _split_spec(spec)
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return stem + "_" + name if name else stem
+
+
+def _split_spec(spec):
+    if ".blend:" in spec:
+        return spec.rpartition(":")
+    return spec, "", ""
+
+
+def load_input(spec):
+    """Loads an input into the empty scene, returns it as a single mesh object."""
+    scene = bpy.context.scene
+    path, _, name = _split_spec(spec)
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".obj":
+        bpy.ops.import_scene.obj(filepath=path)
+    elif extension == ".ply":
+        bpy.ops.import_mesh.ply(filepath=path)
+    elif extension == ".blend":
+        with bpy.data.libraries.load(path) as (data_from, data_to):
+            data_to.objects = [name] if name else list(data_from.objects)
+        for obj in data_to.objects:
+            if obj is not None and obj.type == "MESH":
+                scene.objects.link(obj)
+    else:
+        raise ValueError("Unsupported input: %s" % spec)
+
+    objects = [obj for obj in scene.objects if obj.type == "MESH"]
+    if not objects:
+        raise ValueError("No mesh in %s" % spec)
+    for obj in scene.objects:
+        obj.select = obj in objects
+    scene.objects.active = objects[0]
+    if len(objects) > 1:
+        bpy.ops.object.join()
+    return scene.objects.active
+
+
+def save_output(obj, path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".obj":
+        bpy.ops.export_scene.obj(filepath=path, use_selection=True)
+    elif extension == ".ply":
+        bpy.ops.export_mesh.ply(filepath=path)
+    else:
+        bpy.ops.wm.save_as_mainfile(filepath=path, copy=True)
+
+
+def run_job(spec, output, params, extension=".obj"):
+    """Remeshes one input in this Blender process and writes its result and json log."""
+    name = job_name(spec)
+    log = {"input": spec, "params": params, "status": "failed"}
+    start = perf_counter()
+    pipeline = None
+    try:
+        for obj in list(bpy.context.scene.objects):
+            bpy.data.objects.remove(obj, do_unlink=True)
+        obj = load_input(spec)
+        log["source_verts"] = len(obj.data.vertices)
+
+        pipeline = RemeshPipeline(bpy.context, obj, SimpleNamespace(**params))
+        for feedback in pipeline.stages():
+            pass
+        pipeline.finish()
+
+        log["output"] = os.path.join(output, name + extension)
+        save_output(obj, log["output"])
+        log["particles"] = len(pipeline.solver.particles)
+        log["verts"] = len(obj.data.vertices)
+        log["faces"] = len(obj.data.polygons)
+        log["status"] = "done"
+    except Exception:
+        log["error"] = traceback.format_exc()
+        if pipeline and pipeline.solver:
+            pipeline.solver.stop_parallel()
+    if pipeline:
+        pipeline.profile.deactivate()
+        log["profile"] = pipeline.profile.to_dict()
+    log["time"] = perf_counter() - start
+
+    with open(os.path.join(output, name + ".json"), "w") as file:
+        json.dump(log, file, indent=2)
+    return log
+
+
+def worker_command(blender, spec, args):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    expression = "import sys; sys.path.insert(0, %r); import %s.batch as b; b.main()" % (root, __package__)
+    command = [blender, "--background", "--factory-startup", "--python-expr", expression, "--",
+               "--worker", "--output", args.output, "--format", args.format]
+    for setting in args.set:
+        command += ["--set", setting]
+    return command + [spec]
+
+
+def run_batch(args):
+    args.output = os.path.abspath(args.output)
+    os.makedirs(args.output, exist_ok=True)
+
+    def launch(spec):
+        name = job_name(spec)
+        log_path = os.path.join(args.output, name + ".json")
+        if os.path.exists(log_path):
+            os.remove(log_path)
+        start = perf_counter()
+        with open(os.path.join(args.output, name + ".out.txt"), "w") as out:
+            try:
+                code = subprocess.call(worker_command(args.blender, spec, args), stdout=out,
+                                       stderr=subprocess.STDOUT, timeout=args.timeout)
+            except subprocess.TimeoutExpired:
+                code = None
+        job = {"input": spec, "returncode": code, "wall_time": perf_counter() - start}
+        try:
+            with open(log_path) as file:
+                job["log"] = json.load(file)
+        except (OSError, ValueError):
+            job["log"] = None
+        print("%s: %s in %.1fs" % (spec, job["log"]["status"] if job["log"] else "crashed", job["wall_time"]))
+        return job
+
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        jobs = list(executor.map(launch, args.inputs))
+    summary = {
+        "jobs": jobs,
+        "workers": args.jobs,
+        "wall_time": perf_counter() - start,
+        "done": sum(1 for job in jobs if job["log"] and job["log"]["status"] == "done"),
+    }
+    with open(os.path.join(args.output, "batch_log.json"), "w") as file:
+        json.dump(summary, file, indent=2)
+    return summary
+
+
+def main(argv=None):
+    """Headless batch remeshing, run from a background Blender with the arguments after "--".
+
+        blender --background --python-expr "import tesselator.batch as b; b.main()" -- \\
+            --output out_dir --jobs 4 --set resolution=80 --set steps=40 scan.obj bust.ply scene.blend:Suzanne
+
+    Each input is remeshed by its own background Blender process, at most --jobs at
+    a time. Inputs are OBJ or PLY files, or .blend files with an optional ":object"
+    suffix, every mesh object in the file is joined otherwise. --set takes any remesh
+    operator setting, the rest keep the operator defaults. Every job writes its result,
+    a json log with the stage timings and its process output to the output directory,
+    batch_log.json sums up all jobs.
+    """
+    if argv is None:
+        argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    parser = argparse.ArgumentParser(prog="tesselator batch", description="Remesh many inputs without UI.")
+    parser.add_argument("inputs", nargs="+", help="OBJ, PLY or .blend[:object] inputs")
+    parser.add_argument("--output", required=True, help="Directory for results and logs")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="Blender processes running at once")
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE",
+                        help="Remesh setting, see the remesh operator properties")
+    parser.add_argument("--format", default="obj", choices=("obj", "ply", "blend"))
+    parser.add_argument("--blender", default=bpy.app.binary_path, help="Blender executable for the jobs")
+    parser.add_argument("--timeout", type=float, default=None, help="Seconds before a job is killed")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    params = parse_settings(args.set, default_params())
+    if args.worker:
+        # nobody looks at the viewport of a background job
+        params["preview_refresh"] = "OFF"
+        os.makedirs(args.output, exist_ok=True)
+        failed = False
+        for spec in args.inputs:
+            failed |= run_job(spec, args.output, params, "." + args.format)["status"] != "done"
+        sys.exit(1 if failed else 0)
+    return run_batch(args)
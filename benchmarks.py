@@ -0,0 +1,507 @@
+'''
+Copyright (C) 2018 Jean Da Costa machado.
+Jean3dimensional@gmail.com
+
+Created by Jean Da Costa machado
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import json
+import os
+import random as python_random
+import subprocess
+import sys
+import tracemalloc
+from time import perf_counter
+from types import SimpleNamespace
+
+import bmesh
+import bpy
+import numpy as np
+from mathutils import Vector, noise
+from mathutils.kdtree import KDTree
+
+from .batch import default_params
+from .core import Remesher, remesh_params
+from .particle_arrays import quad_forces
+from .pipeline import RemeshPipeline
+from .surface_particles import ParticleManager, Partile
+from .triangle_grid import TriangleGrid
+from .vector_fields import CrossFrame, FrameField
+
+
+def compare_particle_storage(manager, neighbors=9):
+    """Measures memory and one force pass for the array store against Partile objects."""
+    particles = manager.particles
+    count = len(particles)
+    manager.update_index()
+
+    tracemalloc.start()
+    objects = [Partile.from_store(manager, index) for index in range(count)]
+    object_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    neighbor_rows, distances = manager.nearest_array(particles.co, neighbors)
+
+    start = perf_counter()
+    for particle, row in zip(objects, neighbor_rows):
+        movement = Vector()
+        for neighbor in row[row >= 0]:
+            movement += particle.quad_force(objects[neighbor])
+    object_time = perf_counter() - start
+
+    start = perf_counter()
+    quad_forces(particles, np.arange(count), neighbor_rows, manager.triangle_mode)
+    array_time = perf_counter() - start
+
+    return {
+        "particles": count,
+        "object_bytes": object_bytes,
+        "array_bytes": particles.nbytes(),
+        "object_force_pass": object_time,
+        "array_force_pass": array_time,
+    }
+
+
+def validate_quad_forces(manager, neighbors=9):
+    """Largest relative difference between the batched kernel and Partile.quad_force."""
+    particles = manager.particles
+    count = len(particles)
+    manager.update_index()
+    objects = [Partile.from_store(manager, index) for index in range(count)]
+    neighbor_rows, distances = manager.nearest_array(particles.co, neighbors)
+    batched = quad_forces(particles, np.arange(count), neighbor_rows, manager.triangle_mode)
+
+    worst = 0.0
+    for particle, row, force in zip(objects, neighbor_rows, batched):
+        movement = Vector()
+        for neighbor in row[row >= 0]:
+            movement += particle.quad_force(objects[neighbor])
+        error = np.abs(np.array(movement) - force).max()
+        worst = max(worst, error / max(movement.length, 1e-12))
+    return worst
+
+
+def compare_neighbor_index(manager, steps=10, speed=0.1, neighbors=9):
+    """Per step cost of rebuilding a KDTree against updating the spatial hash in place."""
+    particles = manager.particles
+    manager.update_index()
+    rebuild_times = []
+    update_times = []
+    kd_query_times = []
+    hash_query_times = []
+    for _ in range(steps):
+        manager.step_batched(speed)
+
+        start = perf_counter()
+        tree = KDTree(len(particles))
+        for index, co in enumerate(particles.co):
+            tree.insert(co, index)
+        tree.balance()
+        rebuild_times.append(perf_counter() - start)
+
+        start = perf_counter()
+        manager.update_index()
+        update_times.append(perf_counter() - start)
+
+        start = perf_counter()
+        for co in particles.co:
+            tree.find_n(co, neighbors)
+        kd_query_times.append(perf_counter() - start)
+
+        start = perf_counter()
+        manager.nearest_array(particles.co, neighbors)
+        hash_query_times.append(perf_counter() - start)
+
+    return {
+        "particles": len(particles),
+        "kdtree_rebuild": rebuild_times,
+        "hash_update": update_times,
+        "kdtree_query": kd_query_times,
+        "hash_query": hash_query_times,
+    }
+
+
+def compare_parallel_relaxation(manager, speed=0.1, steps=5, workers=(1, 2, 4, 8, 16)):
+    """Relaxation time for each worker count and the drift from the serial batched result."""
+    snapshot = manager.particles.copy()
+
+    def restore():
+        manager.particles = snapshot.copy()
+        manager.update_index()
+
+    restore()
+    for _ in range(steps):
+        manager.step(speed, batched=True)
+    reference = manager.particles.co.copy()
+    mean_radius = manager.particles.radius.mean()
+
+    results = []
+    for count in workers:
+        restore()
+        manager.start_parallel(count)
+        start = perf_counter()
+        for _ in range(steps):
+            manager.step(speed, batched=True)
+        elapsed = perf_counter() - start
+        manager.stop_parallel()
+        drift = np.sqrt(((manager.particles.co - reference) ** 2).sum(axis=1)).max() / mean_radius
+        results.append({"workers": count, "time": elapsed, "max_drift_in_radii": float(drift)})
+
+    for result in results:
+        result["speedup"] = results[0]["time"] / result["time"]
+    restore()
+    return {"particles": len(snapshot), "steps": steps, "runs": results}
+
+
+def compare_convergence(thresholds=(0.0, 0.3, 0.5, 0.7), subdivisions=4, steps=25):
+    """Active particle count after every relaxation step, for each convergence threshold.
+
+    dropped tells whether fewer particles were moving at the end than at the
+    start, which should hold for every threshold above 0.
+    """
+    obj = icosphere_object(subdivisions)
+    results = []
+    for convergence in thresholds:
+        np.random.seed(0)
+        params = remesh_params({"convergence": convergence, "steps": 0, "x_mirror": False, "step_budget": 0})
+        solver = ParticleManager(FrameField.from_object(obj))
+        solver.preview_mode = "OFF"
+        solver.convergence = convergence
+        for feedback in Remesher(solver, params).stages():
+            pass
+
+        active = []
+        for _ in range(steps):
+            active.append(solver.step(params.step_scale, batched=True))
+            if not active[-1]:
+                break
+        results.append({
+            "convergence": convergence,
+            "particles": len(solver.particles),
+            "active": active,
+            "dropped": active[-1] < len(solver.particles),
+        })
+        solver.field.bm.free()
+    bpy.data.meshes.remove(obj.data)
+    return results
+
+
+def icosphere_object(subdivisions):
+    """Stand-in object for FrameField, an icosphere with 10 * 4 ** subdivisions + 2 vertices."""
+    bm = bmesh.new()
+    bmesh.ops.create_icosphere(bm, subdivisions=subdivisions, diameter=1)
+    mesh = bpy.data.meshes.new("tesselator_benchmark")
+    bm.to_mesh(mesh)
+    bm.free()
+    return SimpleNamespace(data=mesh)
+
+
+def compare_major_curvatures(subdivisions=(7, 8)):
+    """Times the per vertex loop against the CSR version, about 160k and 650k vertices by default."""
+    results = []
+    for level in subdivisions:
+        obj = icosphere_object(level)
+        field = FrameField.from_object(obj)
+
+        start = perf_counter()
+        field.build_major_curvatures(vectorized=False)
+        loop_time = perf_counter() - start
+        loop_sharpness = field.sharpness.copy()
+        loop_curvature = field.curvature.copy()
+
+        start = perf_counter()
+        field.build_major_curvatures()
+        array_time = perf_counter() - start
+
+        keys = field.curvature_valid
+        results.append({
+            "vertices": len(field.bm.verts),
+            "loop_time": loop_time,
+            "array_time": array_time,
+            "max_sharpness_error": float(np.abs(loop_sharpness[keys] - field.sharpness[keys]).max()),
+            "max_curvature_error": float(np.abs(loop_curvature[keys] - field.curvature[keys]).max()),
+        })
+        field.bm.free()
+        bpy.data.meshes.remove(obj.data)
+    return results
+
+
+def mesh_topology(bm):
+    """Counts, euler characteristic, valence histogram and particle index edges of an extracted mesh."""
+    layer = bm.verts.layers.int["particle"]
+    valence = np.bincount([len(vert.link_edges) for vert in bm.verts], minlength=8)
+    edges = set()
+    for edge in bm.edges:
+        a, b = edge.verts[0][layer], edge.verts[1][layer]
+        edges.add((min(a, b), max(a, b)))
+    return {
+        "verts": len(bm.verts),
+        "edges": len(bm.edges),
+        "faces": len(bm.faces),
+        "euler": len(bm.verts) - len(bm.edges) + len(bm.faces),
+        "boundary_edges": sum(1 for edge in bm.edges if edge.is_boundary),
+        "non_manifold_edges": sum(1 for edge in bm.edges if not edge.is_manifold and not edge.is_boundary),
+        "valence": valence.tolist(),
+    }, edges
+
+
+def compare_extraction(manager, bm):
+    """Times both extraction methods on the current particles and compares the meshes they build.
+
+    bm is the source mesh, it is copied since the subdivide method modifies it.
+    """
+    results = {}
+    edge_sets = {}
+    for method in ("SUBDIVIDE", "DELAUNAY"):
+        source = bm.copy()
+        start = perf_counter()
+        new_bm = manager.simplify_mesh(source, method)
+        elapsed = perf_counter() - start
+        topology, edge_sets[method] = mesh_topology(new_bm)
+        topology["time"] = elapsed
+        results[method] = topology
+        source.free()
+        new_bm.free()
+
+    shared = len(edge_sets["SUBDIVIDE"] & edge_sets["DELAUNAY"])
+    union = len(edge_sets["SUBDIVIDE"] | edge_sets["DELAUNAY"])
+    results["particles"] = len(manager.particles)
+    results["edge_jaccard"] = shared / max(union, 1)
+    results["speedup"] = results["SUBDIVIDE"]["time"] / max(results["DELAUNAY"]["time"], 1e-9)
+    return results
+
+
+def compare_field_growth(subdivisions=(6, 7), iterations=2):
+    """Times marching_growth and smooth, per vertex loops against the adjacency array versions,
+    and the global solve replacing both."""
+    results = []
+    for level in subdivisions:
+        obj = icosphere_object(level)
+        field = FrameField.from_object(obj)
+        result = {"vertices": len(field.mesh)}
+        for name, vectorized in (("loop", False), ("array", True)):
+            field.build_major_curvatures()
+            field.erase_part(2)
+            start = perf_counter()
+            field.marching_growth(vectorized=vectorized)
+            result[name + "_growth_time"] = perf_counter() - start
+            start = perf_counter()
+            field.smooth(iterations, vectorized=vectorized)
+            result[name + "_smooth_time"] = perf_counter() - start
+            result[name + "_frames"] = int(np.count_nonzero(field.field_valid))
+        field.build_major_curvatures()
+        start = perf_counter()
+        field.solve()
+        result["solve_time"] = perf_counter() - start
+        results.append(result)
+        field.bm.free()
+        bpy.data.meshes.remove(obj.data)
+    return results
+
+
+def compare_projection(subdivisions=(5, 6), count=20000, offset=0.02):
+    """Times BVHTree.find_nearest per point against TriangleGrid.find_nearest_array on points near an icosphere."""
+    results = []
+    rng = np.random.RandomState(0)
+    for level in subdivisions:
+        obj = icosphere_object(level)
+        field = FrameField.from_object(obj)
+        points = rng.normal(size=(count, 3))
+        points *= ((1 + rng.normal(scale=offset, size=count)) / np.sqrt((points * points).sum(axis=1)))[:, None]
+
+        start = perf_counter()
+        bvh_hits = np.array([field.tree.find_nearest(point)[0] for point in points.tolist()])
+        bvh_time = perf_counter() - start
+
+        start = perf_counter()
+        grid = TriangleGrid(field.mesh.co, field.mesh.faces)
+        build_time = perf_counter() - start
+        start = perf_counter()
+        location = grid.find_nearest_array(points)[0]
+        grid_time = perf_counter() - start
+
+        results.append({
+            "triangles": len(grid),
+            "bvh_time": bvh_time,
+            "grid_build_time": build_time,
+            "grid_time": grid_time,
+            "max_error": float(np.sqrt(((bvh_hits - location) ** 2).sum(axis=1)).max()),
+        })
+        field.bm.free()
+        bpy.data.meshes.remove(obj.data)
+    return results
+
+
+def compare_field_storage(field):
+    """Memory of the field arrays against the dicts of CrossFrame objects and floats they replaced."""
+    rows = np.flatnonzero(field.field_valid)
+    curvature_rows = np.flatnonzero(field.curvature_valid)
+    normals = field.frame_normals()
+
+    tracemalloc.start()
+    vert_field = {}
+    for index, u, normal, strength in zip(rows.tolist(), field.field_u[rows].tolist(),
+                                          normals[rows].tolist(), field.field_strength[rows].tolist()):
+        vert_field[index] = CrossFrame(-Vector(u), Vector(normal), strength)
+    mesh_curvature = dict(zip(curvature_rows.tolist(), field.curvature[curvature_rows].tolist()))
+    sharpness_field = dict(zip(curvature_rows.tolist(), field.sharpness[curvature_rows].tolist()))
+    dict_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    array_bytes = sum(getattr(field, name).nbytes for name in field.array_names)
+    count = len(field.mesh)
+    return {
+        "vertices": count,
+        "dict_bytes": dict_bytes,
+        "array_bytes": array_bytes,
+        "dict_bytes_per_vertex": dict_bytes / max(count, 1),
+        "array_bytes_per_vertex": array_bytes / max(count, 1),
+    }
+
+
+def uv_sphere(bm, level):
+    segments = 32 * 2 ** level
+    bmesh.ops.create_uvsphere(bm, u_segments=segments, v_segments=segments // 2, diameter=1)
+
+
+def torus(bm, level):
+    major, minor = 48 * 2 ** level, 16 * 2 ** level
+    u = np.repeat(np.linspace(0, 2 * np.pi, major, endpoint=False), minor)
+    v = np.tile(np.linspace(0, 2 * np.pi, minor, endpoint=False), major)
+    co = np.stack(((1 + 0.35 * np.cos(v)) * np.cos(u), (1 + 0.35 * np.cos(v)) * np.sin(u), 0.35 * np.sin(v)), axis=1)
+    verts = [bm.verts.new(p) for p in co.tolist()]
+    for i in range(major):
+        for j in range(minor):
+            a = i * minor + j
+            b = ((i + 1) % major) * minor + j
+            c = ((i + 1) % major) * minor + (j + 1) % minor
+            d = i * minor + (j + 1) % minor
+            bm.faces.new((verts[a], verts[b], verts[c], verts[d]))
+
+
+def noisy_blob(bm, level):
+    """Lumpy icosphere with fine grained noise, like a raw scan."""
+    bmesh.ops.create_icosphere(bm, subdivisions=5 + level, diameter=1)
+    random = np.random.RandomState(0)
+    bm.normal_update()
+    for vert in bm.verts:
+        lump = noise.noise(vert.co * 2.5) * 0.25 + noise.noise(vert.co * 9) * 0.05
+        vert.co += vert.normal * (lump + random.normal(0, 0.004))
+
+
+def sharp_box(bm, level):
+    bmesh.ops.create_cube(bm, size=2)
+    bmesh.ops.subdivide_edges(bm, edges=bm.edges, cuts=8 * 2 ** level - 1, use_grid_fill=True)
+
+
+suite_shapes = (("sphere", uv_sphere), ("torus", torus), ("noisy_blob", noisy_blob), ("sharp_box", sharp_box))
+
+suite_params = {
+    "resolution": 40,
+    "steps": 20,
+    "subdivisions": 1,
+    "particle_placement": "FAST_MARCHING",
+    "use_gp": False,
+    "x_mirror": False,
+    "workers": 1,
+    "field_cache": False,
+    "preview_refresh": "OFF",
+}
+
+
+def suite_object(name, builder, level):
+    scene = bpy.context.scene
+    for obj in list(scene.objects):
+        bpy.data.objects.remove(obj, do_unlink=True)
+    bm = bmesh.new()
+    builder(bm, level)
+    mesh = bpy.data.meshes.new(name)
+    bm.to_mesh(mesh)
+    bm.free()
+    obj = bpy.data.objects.new(name, mesh)
+    scene.objects.link(obj)
+    scene.objects.active = obj
+    obj.select = True
+    return obj
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def pipeline_suite(path=None, levels=(0, 1, 2), shapes=suite_shapes, params=None):
+    """Runs the whole remesh pipeline on synthetic shapes of growing size with fixed settings.
+
+    Every stage is timed on its own, see RemeshPipeline.timings. Random generators
+    are reseeded for each case so runs are comparable across commits. The results
+    are returned and written as json to path if given.
+    """
+    settings = default_params()
+    settings.update(suite_params)
+    settings.update(params or {})
+
+    cases = []
+    for name, builder in shapes:
+        for level in levels:
+            python_random.seed(0)
+            np.random.seed(0)
+            obj = suite_object(name, builder, level)
+            source_verts = len(obj.data.vertices)
+            pipeline = RemeshPipeline(bpy.context, obj, SimpleNamespace(**settings))
+            start = perf_counter()
+            for feedback in pipeline.stages():
+                pass
+            pipeline.finish()
+            cases.append({
+                "shape": name,
+                "level": level,
+                "source_verts": source_verts,
+                "particles": len(pipeline.solver.particles),
+                "verts": len(obj.data.vertices),
+                "faces": len(obj.data.polygons),
+                "total": perf_counter() - start,
+                "timings": pipeline.timings,
+                "counters": pipeline.profile.counters,
+            })
+            pipeline.bm.free()
+            pipeline.solver.bm.free()
+
+    results = {
+        "commit": git_commit(),
+        "blender": bpy.app.version_string,
+        "numpy": np.__version__,
+        "params": settings,
+        "cases": cases,
+    }
+    if path:
+        with open(path, "w") as file:
+            json.dump(results, file, indent=2)
+    return results
+
+
+def suite_main():
+    """Entry point for a background Blender, the argument after "--" is the json output path.
+
+        blender --background --factory-startup --python-expr "import tesselator.benchmarks as b; b.suite_main()" -- out.json
+    """
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    results = pipeline_suite(argv[0] if argv else "tesselator_benchmarks.json")
+    for case in results["cases"]:
+        print("%-10s %d %7d verts %7d particles %8.2fs" % (
+            case["shape"], case["level"], case["source_verts"], case["particles"], case["total"]))
@@ -0,0 +1,250 @@
+'''
+Copyright (C) 2018 Jean Da Costa machado.
+Jean3dimensional@gmail.com
+
+Created by Jean Da Costa machado
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import threading
+from time import perf_counter
+from types import SimpleNamespace
+
+import numpy as np
+
+from . import mesh_extraction
+from .mesh_arrays import MeshArrays, face_edges
+from .profiling import Profiler
+from .surface_particles import ParticleManager
+from .vector_fields import FrameField
+
+# the remesh operator defaults of the settings remesh() uses
+default_params = {
+    "resolution": 60,
+    "adaptive": 0.05,
+    "step_scale": 0.1,
+    "steps": 25,
+    "seeds": 5,
+    "x_mirror": True,
+    "triangle_mode": False,
+    "particle_placement": "FAST_MARCHING",
+    "levels": 0,
+    "level_steps": 5,
+    "batched_relaxation": True,
+    "convergence": 0.0,
+    "workers": 1,
+    "field_mode": "GROW",
+    "field_iterations": 200,
+    "step_budget": 50,
+    "extraction": "DELAUNAY",
+}
+
+
+def remesh_params(params=None):
+    """default_params updated with params, a dict or an object holding the settings as attributes."""
+    values = dict(default_params)
+    if params is not None:
+        values.update(params if isinstance(params, dict) else vars(params))
+    return SimpleNamespace(**values)
+
+
+def remesh(verts, faces, params=None):
+    """Particle remesh of a mesh given as plain arrays, returns the new (verts, faces).
+
+    verts is (N, 3) and faces a (F, 3) array or lists of vertex indices. params
+    takes any of default_params, see remesh_params. The result faces are lists of
+    3 or 4 vertex indices. Runs without Blender, so the field is built on the mesh
+    as given: there is no predecimation, no grease pencil guides and no subdivision
+    of the result.
+    """
+    remesher = Remesher.from_geometry(verts, faces, remesh_params(params))
+    for feedback in remesher.stages():
+        pass
+    return remesher.extract()
+
+
+class Remesher:
+    """Particle placement, relaxation and refinement over a ParticleManager.
+
+    Shared by remesh() and the Blender RemeshPipeline, which adds the Blender only
+    steps around it. The generators run a bit of work per iteration and yield the
+    feedback lines describing it. With params.step_budget in milliseconds, steps
+    over many particles are split so no iteration runs much longer than that.
+    """
+
+    def __init__(self, solver, params, profile=None):
+        self.solver = solver
+        self.params = params
+        self.profile = profile or Profiler()
+
+    @classmethod
+    def from_geometry(cls, verts, faces, params):
+        solver = ParticleManager(FrameField.from_geometry(verts, faces))
+        solver.preview_mode = "OFF"
+        solver.convergence = params.convergence
+        solver.triangle_mode = params.triangle_mode
+        return cls(solver, params)
+
+    def timed(self, stage):
+        return self.profile.timed(stage)
+
+    @property
+    def budget(self):
+        return self.params.step_budget / 1000 if self.params.step_budget > 0 else None
+
+    @property
+    def coarse_resolution(self):
+        # with multiple levels the particles are placed and relaxed coarser first
+        return self.params.resolution / 2 ** self.params.levels
+
+    def stages(self):
+        """Every stage of remesh(), from the field to the relaxed particles."""
+        params = self.params
+        solver = self.solver
+        self.profile.activate()
+
+        yield ["Building Direction Field."]
+        with self.timed("build_field"):
+            solver.build_field(None, params.x_mirror, None, params.field_mode, params.field_iterations)
+
+        with self.timed("placement"):
+            if params.particle_placement == "INTEGER_LATTICE":
+                solver.initialize_grid(solver.field.mesh.co, self.coarse_resolution, params.x_mirror,
+                                       params.adaptive)
+            elif params.particle_placement == "FAST_MARCHING":
+                solver.initialize_from_features(None, self.coarse_resolution, params.adaptive, params.seeds)
+            else:
+                raise ValueError("Placement needs Blender: %s" % params.particle_placement)
+        if params.particle_placement == "FAST_MARCHING":
+            yield from self.spread()
+        yield from self.relax_levels()
+
+    def spread(self):
+        solver = self.solver
+        seconds = 0.0
+        # steps run after the front ran out, they settle the last merges
+        extra_steps = 2
+        while True:
+            start = perf_counter()
+            with self.timed("placement"):
+                result = solver.spread_step(self.budget)
+            seconds += perf_counter() - start
+            if result is None:
+                yield ["Spreading particles.."]
+                continue
+            self.profile.record_step("placement", seconds, len(solver.particles))
+            seconds = 0.0
+            with self.timed("preview"):
+                solver.refresh_preview()
+            yield ["Spreading particles.."]
+            if not result:
+                if not extra_steps:
+                    break
+                extra_steps -= 1
+
+    def relax_levels(self):
+        """Relaxes the placed particles, then refines and relaxes them again once per level."""
+        params = self.params
+        solver = self.solver
+        with self.timed("placement"):
+            if params.x_mirror:
+                solver.mirror_particles()
+        with self.timed("preview"):
+            solver.refresh_preview(force=solver.preview_mode != "OFF")
+
+        with self.timed("relaxation"):
+            # forking a threaded process from any other thread than the main one can deadlock,
+            # the operator's background solver relaxes in its own process
+            if params.batched_relaxation and params.workers > 1 and \
+                    threading.current_thread() is threading.main_thread():
+                solver.start_parallel(params.workers)
+        yield from self.relax(params.steps)
+
+        for level in range(1, params.levels + 1):
+            with self.timed("refinement"):
+                solver.refine()
+                if params.x_mirror:
+                    solver.mirror_particles()
+            with self.timed("preview"):
+                solver.refresh_preview(force=solver.preview_mode != "OFF")
+            yield ["Refining particles.", "Level %d of %d." % (level, params.levels)]
+            yield from self.relax(params.level_steps, level)
+        solver.stop_parallel()
+
+    def relax(self, steps, level=0):
+        params = self.params
+        solver = self.solver
+        feedback = ["Relaxation step.", "0% Done.", "Press Esc to stop."]
+        i = 0
+        seconds = 0.0
+        while i < steps:
+            start = perf_counter()
+            with self.timed("relaxation"):
+                active = solver.step(params.step_scale, params.batched_relaxation, self.budget)
+            seconds += perf_counter() - start
+            if active is None:
+                # the step ran out of budget, the next iteration resumes it
+                yield feedback
+                continue
+            self.profile.record_step("relaxation", seconds, len(solver.particles))
+            seconds = 0.0
+            with self.timed("preview"):
+                solver.refresh_preview()
+            if not active:
+                break
+            feedback = ["Relaxation step.",
+                        str(int(i / steps * 100)) + "% Done.",
+                        str(active) + " particles moving.",
+                        "Press Esc to stop."]
+            if params.levels:
+                feedback.insert(1, "Level %d of %d." % (level, params.levels))
+            yield feedback
+            i += 1
+
+    def extract(self, smoothing=5):
+        """Final (verts, faces) of the particles, smoothed and projected back on the surface.
+
+        The array counterpart of RemeshPipeline.finish, params.extraction picks the method
+        like ParticleManager.simplify_mesh does.
+        """
+        solver = self.solver
+        solver.stop_parallel()
+        with self.timed("extraction"):
+            if self.params.extraction == "DELAUNAY":
+                triangles = solver.delaunay_triangles()
+            elif self.params.extraction == "SUBDIVIDE":
+                triangles = solver.subdivide_triangles()
+            else:
+                raise ValueError("Unknown extraction method: %s" % self.params.extraction)
+            used = np.unique(triangles)
+            remap = np.full(len(solver.particles), -1, dtype=np.int64)
+            remap[used] = np.arange(len(used))
+            co = solver.particles.co[used]
+            normals = solver.particles.normal[used]
+            triangles = remap[triangles]
+            if self.params.triangle_mode:
+                quads = np.empty((0, 4), dtype=np.int64)
+            else:
+                quads, triangles = mesh_extraction.join_triangles(co, triangles)
+
+        mesh = MeshArrays(co, normals, triangles, face_edges(quads, triangles))
+        connected = mesh.degree > 0
+        for i in range(smoothing):
+            with self.timed("smoothing"):
+                average = mesh.segment_sum(co[mesh.indices]) / np.maximum(mesh.degree, 1)[:, None]
+                co[connected] += (average[connected] - co[connected]) * 0.5
+            with self.timed("surface_snap"):
+                co = solver.field.tree.find_nearest_array(co)[0]
+        self.profile.deactivate()
+        return co, quads.tolist() + triangles.tolist()
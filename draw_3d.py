@@ -17,12 +17,46 @@ Created by Jean Da Costa machado
     You should have received a copy of the GNU General Public License
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
-import bgl
+import threading
+
+import numpy as np
+
+try:
+    import bgl
+except ImportError:
+    # outside Blender lines are still buffered, only drawing needs bgl
+    bgl = None
+
+# names a build needs to draw the lines from vertex arrays
+vertex_array_names = ("Buffer", "glEnableClientState", "glDisableClientState", "glVertexPointer",
+                      "glColorPointer", "glDrawArrays", "GL_VERTEX_ARRAY", "GL_COLOR_ARRAY")
+
+
+def has_vertex_arrays():
+    return bgl is not None and all(hasattr(bgl, name) for name in vertex_array_names)
 
 
 class DrawObject:
+    """Lines drawn in the 3d view.
+
+    Bulk lines are kept as flat position and color buffers. The first draw after
+    an update copies them into bgl Buffers in one go and draws them as vertex
+    arrays. Builds without the vertex array calls compile them into a display list
+    instead, so redraws only replay it but every update still sends each vertex
+    from Python. Single lines added with add_line are drawn immediately.
+    set_lines can be called from a solver thread while the view draws.
+    """
+
     def __init__(self):
         self.commands = []
+        self.positions = np.empty((0, 3), dtype=np.float32)
+        self.colors = np.empty((0, 4), dtype=np.float32)
+        self.width = 1.5
+        self.display_list = None
+        self.vertex_buffer = None
+        self.color_buffer = None
+        self.dirty = False
+        self.lock = threading.Lock()
 
     def __call__(self,*args):
         self.draw()
@@ -30,6 +64,23 @@ class DrawObject:
     def add_line(self, start, end, width=1.5, color=(1, 0, 0, 1)):
         self.commands.append((start, end, width, color))
 
+    def set_lines(self, starts, ends, colors, width=1.5):
+        """Replaces the buffered lines, colors holds one rgba row per line."""
+        positions = np.empty((len(starts) * 2, 3), dtype=np.float32)
+        positions[0::2] = starts
+        positions[1::2] = ends
+        colors = np.asarray(colors, dtype=np.float32).reshape(-1, 4)
+        # the buffers are swapped together, a draw never sees positions and colors of different updates
+        with self.lock:
+            self.positions = positions
+            self.colors = colors
+            self.width = width
+            self.dirty = True
+
+    def clear(self):
+        self.commands.clear()
+        self.set_lines(np.empty((0, 3)), np.empty((0, 3)), np.empty((0, 4)))
+
     def start_drawing(self):
         bgl.glEnable(bgl.GL_BLEND)
         bgl.glBegin(bgl.GL_LINES)
@@ -46,8 +97,73 @@ class DrawObject:
         bgl.glVertex3f(*start)
         bgl.glVertex3f(*end)
 
-    def draw(self):
+    def emit_buffers(self):
+        bgl.glLineWidth(self.width)
         self.start_drawing()
-        for c in self.commands:
-            self.line3d(*c)
+        color = None
+        positions = self.positions.tolist()
+        for index, line_color in enumerate(self.colors.tolist()):
+            if line_color != color:
+                color = line_color
+                bgl.glColor4f(*color)
+            bgl.glVertex3f(*positions[index * 2])
+            bgl.glVertex3f(*positions[index * 2 + 1])
         self.stop_drawing()
+
+    def compile(self):
+        if self.display_list is not None:
+            bgl.glDeleteLists(self.display_list, 1)
+        self.display_list = bgl.glGenLists(1)
+        bgl.glNewList(self.display_list, bgl.GL_COMPILE)
+        self.emit_buffers()
+        bgl.glEndList()
+        self.dirty = False
+
+    def upload(self):
+        """Copies the lines into bgl Buffers, with a color per vertex."""
+        count = len(self.positions)
+        self.vertex_buffer = bgl.Buffer(bgl.GL_FLOAT, [count, 3], self.positions.tolist())
+        self.color_buffer = bgl.Buffer(bgl.GL_FLOAT, [count, 4], np.repeat(self.colors, 2, axis=0).tolist())
+        self.dirty = False
+
+    def draw_arrays(self):
+        bgl.glLineWidth(self.width)
+        bgl.glEnable(bgl.GL_BLEND)
+        bgl.glEnableClientState(bgl.GL_VERTEX_ARRAY)
+        bgl.glEnableClientState(bgl.GL_COLOR_ARRAY)
+        bgl.glVertexPointer(3, bgl.GL_FLOAT, 0, self.vertex_buffer)
+        bgl.glColorPointer(4, bgl.GL_FLOAT, 0, self.color_buffer)
+        bgl.glDrawArrays(bgl.GL_LINES, 0, len(self.positions))
+        bgl.glDisableClientState(bgl.GL_COLOR_ARRAY)
+        bgl.glDisableClientState(bgl.GL_VERTEX_ARRAY)
+        bgl.glLineWidth(1)
+        bgl.glDisable(bgl.GL_BLEND)
+        bgl.glColor4f(0.0, 0.0, 0.0, 1.0)
+
+    def free(self):
+        if self.display_list is not None:
+            bgl.glDeleteLists(self.display_list, 1)
+            self.display_list = None
+        self.vertex_buffer = None
+        self.color_buffer = None
+
+    def draw(self):
+        with self.lock:
+            if len(self.colors):
+                if has_vertex_arrays():
+                    if self.dirty or self.vertex_buffer is None:
+                        self.upload()
+                    self.draw_arrays()
+                elif not hasattr(bgl, "glNewList"):
+                    # no display lists in this build, send the buffers every redraw
+                    self.emit_buffers()
+                else:
+                    if self.dirty or self.display_list is None:
+                        self.compile()
+                    bgl.glCallList(self.display_list)
+
+        if self.commands:
+            self.start_drawing()
+            for c in self.commands:
+                self.line3d(*c)
+            self.stop_drawing()
@@ -0,0 +1,124 @@
+'''
+Copyright (C) 2018 Jean Da Costa machado.
+Jean3dimensional@gmail.com
+
+Created by Jean Da Costa machado
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import hashlib
+import os
+import tempfile
+import zipfile
+import zlib
+
+import numpy as np
+
+# bump when the field construction changes so stale entries stop matching
+CACHE_VERSION = 3
+
+
+def default_directory():
+    return os.path.join(tempfile.gettempdir(), "tesselator_field_cache")
+
+
+def cache_key(co, faces, strokes=(), x_mirror=False, mode="GROW", iterations=0):
+    """Hash of the decimated mesh, the grease pencil stroke points, the mirror flag and the field settings."""
+    sha = hashlib.sha1()
+    sha.update(str(CACHE_VERSION).encode())
+    sha.update(np.ascontiguousarray(co, dtype=np.float32).tobytes())
+    sha.update(np.ascontiguousarray(faces, dtype=np.int32).tobytes())
+    for stroke in strokes:
+        sha.update(b"stroke")
+        sha.update(np.ascontiguousarray(stroke, dtype=np.float32).tobytes())
+    sha.update(b"mirror" if x_mirror else b"")
+    sha.update(("%s %d" % (mode, iterations)).encode())
+    return sha.hexdigest()
+
+
+class FieldCache:
+    """Direction fields saved as .npz files, shared by every Blender process using the directory.
+
+    Entries are written to a temporary file and renamed into place, another process
+    can remove any entry at any time.
+    """
+
+    def __init__(self, directory=None, max_bytes=256 * 1024 * 1024):
+        self.directory = directory or default_directory()
+        self.max_bytes = max_bytes
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    def load(self, key):
+        path = self.path(key)
+        if not os.path.isfile(path):
+            return None
+        try:
+            with np.load(path) as data:
+                arrays = {name: data[name] for name in data.files}
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile, zlib.error):
+            # a corrupt or truncated entry is dropped and built again
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            return None
+        # last use time drives the eviction order
+        try:
+            os.utime(path, None)
+        except FileNotFoundError:
+            pass
+        return arrays
+
+    def save(self, key, arrays):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(key)
+        # a name of its own, other processes may be saving the same key
+        with tempfile.NamedTemporaryFile(dir=self.directory, prefix=key, suffix=".tmp", delete=False) as file:
+            temp_path = file.name
+            try:
+                np.savez_compressed(file, **arrays)
+            except BaseException:
+                file.close()
+                os.remove(temp_path)
+                raise
+        os.replace(temp_path, path)
+        self.evict()
+
+    def entries(self):
+        if not os.path.isdir(self.directory):
+            return []
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".npz"):
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return sorted(entries)
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,284 @@
+'''
+Copyright (C) 2018 Jean Da Costa machado.
+Jean3dimensional@gmail.com
+
+Created by Jean Da Costa machado
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import numpy as np
+
+from .background import check_cancelled
+
+
+class MeshArrays:
+    """Vertex, edge and triangle arrays of a mesh with a CSR vertex adjacency.
+
+    The neighbors of vertex i are indices[indptr[i]:indptr[i + 1]], and
+    edge_source holds i for each of those entries.
+    """
+
+    def __init__(self, co, normals, faces, edges):
+        self.co = np.asarray(co, dtype=np.float64).reshape(-1, 3)
+        self.normals = np.asarray(normals, dtype=np.float64).reshape(-1, 3)
+        self.faces = np.asarray(faces, dtype=np.int64).reshape(-1, 3)
+        self.edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+
+        count = len(self.co)
+        source = np.concatenate((self.edges[:, 0], self.edges[:, 1]))
+        target = np.concatenate((self.edges[:, 1], self.edges[:, 0]))
+        order = np.argsort(source, kind="mergesort")
+        self.edge_source = source[order]
+        self.indices = target[order]
+        self.degree = np.bincount(source, minlength=count)
+        self.indptr = np.concatenate(([0], np.cumsum(self.degree)))
+
+    @classmethod
+    def from_bmesh(cls, bm):
+        co = [vert.co for vert in bm.verts]
+        normals = [vert.normal for vert in bm.verts]
+        faces = [[vert.index for vert in face.verts] for face in bm.faces]
+        edges = [[edge.verts[0].index, edge.verts[1].index] for edge in bm.edges]
+        return cls(co, normals, faces, edges)
+
+    @classmethod
+    def from_polygons(cls, co, polygons):
+        """Mesh of plain vertex and face arrays, polygons are fanned into triangles."""
+        co = np.asarray(co, dtype=np.float64).reshape(-1, 3)
+        faces = fan_triangles(polygons)
+        return cls(co, vertex_normals(co, faces), faces, face_edges(faces))
+
+    def __len__(self):
+        return len(self.co)
+
+    def segment_sum(self, values):
+        """Sums per edge entry values over the neighbors of each vertex."""
+        if values.ndim == 1:
+            return np.bincount(self.edge_source, weights=values, minlength=len(self))
+        return np.stack([self.segment_sum(values[:, i]) for i in range(values.shape[1])], axis=1)
+
+
+def fan_triangles(polygons):
+    """Triangles of a (F, 3) array or of vertex index lists, fanned from their first vertex."""
+    if isinstance(polygons, np.ndarray) and polygons.ndim == 2 and polygons.shape[1] == 3:
+        return polygons.astype(np.int64)
+    triangles = [(polygon[0], polygon[i], polygon[i + 1]) for polygon in polygons for i in range(1, len(polygon) - 1)]
+    return np.array(triangles, dtype=np.int64).reshape(-1, 3)
+
+
+def face_edges(*faces):
+    """Unique (E, 2) edges of (F, k) face arrays, lower index first."""
+    edges = np.concatenate([np.stack((f.ravel(), np.roll(f, -1, axis=1).ravel()), axis=1) for f in faces])
+    edges.sort(axis=1)
+    count = edges.max() + 1 if len(edges) else 0
+    key = np.unique(edges[:, 0] * count + edges[:, 1])
+    return np.stack((key // max(count, 1), key % max(count, 1)), axis=1)
+
+
+def vertex_normals(co, triangles):
+    """Area weighted vertex normals, zero on vertices without faces."""
+    face_normals = np.cross(co[triangles[:, 1]] - co[triangles[:, 0]], co[triangles[:, 2]] - co[triangles[:, 0]])
+    normals = np.zeros_like(co)
+    for corner in range(3):
+        for axis in range(3):
+            normals[:, axis] += np.bincount(triangles[:, corner], face_normals[:, axis], len(co))
+    lengths = np.sqrt((normals * normals).sum(axis=1))
+    return normals / np.maximum(lengths, 1e-30)[:, None]
+
+
+def major_curvatures(mesh):
+    """Vectorized FrameField.build_major_curvatures.
+
+    For each vertex returns the cross frame seed direction (the cross product of
+    the most diverging neighbor normal with the vertex normal), the angle to that
+    normal as sharpness, the mean signed edge curvature and whether the vertex
+    has any edges at all. Neighbors are taken in CSR order, not in the link_edges
+    order of the loop, so between equally diverging neighbors both may pick a
+    different one.
+    """
+    source = mesh.edge_source
+    target = mesh.indices
+    normals = mesh.normals
+    lengths = np.sqrt((normals * normals).sum(axis=1))
+    lengths[lengths == 0] = 1
+    unit = normals / lengths[:, None]
+    angle = np.arccos(np.clip((unit[source] * unit[target]).sum(axis=1), -1, 1))
+
+    valid = mesh.degree > 0
+    starts = mesh.indptr[:-1][valid]
+    sharpness = np.zeros(len(mesh))
+    sharpness[valid] = np.maximum.reduceat(angle, starts)
+    # first neighbor in CSR order reaching the maximum
+    entry = np.arange(len(angle))
+    first = np.where(angle == sharpness[source], entry, len(angle))
+    best = np.zeros(len(mesh), dtype=np.int64)
+    best[valid] = target[np.minimum.reduceat(first, starts)]
+
+    edge_vec = mesh.co[target] - mesh.co[source]
+    le = (edge_vec * edge_vec).sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        edge_curvature = np.where(le > 0, (edge_vec * (normals[target] - normals[source])).sum(axis=1) / le, 0)
+    curvature = mesh.segment_sum(edge_curvature) / np.maximum(mesh.degree, 1)
+
+    direction = np.cross(normals[best], normals)
+    return direction, sharpness, curvature, valid
+
+
+def nearest_frame_vectors(u, v, vec):
+    """Vectorized CrossFrame.get_nearest_vec, the signed u or v axis closest to vec."""
+    u_d = (vec * u).sum(axis=-1)
+    v_d = (vec * v).sum(axis=-1)
+    use_u = u_d * u_d > v_d * v_d
+    sign = np.where(use_u, np.sign(u_d), np.sign(v_d))
+    sign[sign == 0] = -1
+    return np.where(use_u[..., None], u, v) * sign[..., None]
+
+
+def barycentric_basis(triangles):
+    """Origin and dual edge vectors of (F, 3, 3) triangles.
+
+    The barycentric weights of a point p on face f are (1 - a - b, a, b) with
+    a = dot(p - origin[f], dual[f, 0]) and b = dot(p - origin[f], dual[f, 1]).
+    """
+    origin = triangles[:, 0]
+    e0 = triangles[:, 1] - origin
+    e1 = triangles[:, 2] - origin
+    d00 = (e0 * e0).sum(axis=1)
+    d01 = (e0 * e1).sum(axis=1)
+    d11 = (e1 * e1).sum(axis=1)
+    denom = d00 * d11 - d01 * d01
+    with np.errstate(divide="ignore", invalid="ignore"):
+        inv = np.where(denom > 0, 1 / denom, 0)[:, None]
+    dual = np.empty(triangles.shape[:1] + (2, 3))
+    dual[:, 0] = (e0 * d11[:, None] - e1 * d01[:, None]) * inv
+    dual[:, 1] = (e1 * d00[:, None] - e0 * d01[:, None]) * inv
+    return origin.copy(), dual
+
+
+def barycentric_weights(points, origin, dual):
+    d = points - origin
+    a = (d * dual[:, 0]).sum(axis=1)
+    b = (d * dual[:, 1]).sum(axis=1)
+    return np.stack((1 - a - b, a, b), axis=1)
+
+
+def cross_frames(vec, normal):
+    """Vectorized CrossFrame construction, returns the u and v axes for each row."""
+    vec = np.array(vec, dtype=np.float64)
+    degenerate = ((vec * vec).sum(axis=1) == 0) | ((vec * normal).sum(axis=1) == 1)
+    if degenerate.any():
+        n = normal[degenerate]
+        axis = np.zeros_like(n)
+        use_x = np.abs(n[:, 0]) < 0.9
+        axis[use_x, 0] = 1
+        axis[~use_x, 1] = 1
+        vec[degenerate] = np.cross(n, axis)
+    length = np.sqrt((vec * vec).sum(axis=1))
+    length[length == 0] = 1
+    v = np.cross(vec / length[:, None], normal)
+    u = np.cross(v, normal)
+    return u, v
+
+
+def csr_entries(indptr, rows):
+    """Positions of the adjacency entries of the given rows, concatenated in row order."""
+    starts = indptr[rows]
+    counts = indptr[rows + 1] - starts
+    offsets = np.cumsum(counts) - counts
+    return np.repeat(starts - offsets, counts) + np.arange(counts.sum())
+
+
+def reverse_entries(mesh):
+    """For each adjacency entry i -> j, the position of the entry j -> i."""
+    count = len(mesh)
+    key = mesh.edge_source * count + mesh.indices
+    order = np.argsort(key, kind="mergesort")
+    return order[np.searchsorted(key[order], mesh.indices * count + mesh.edge_source)]
+
+
+def tangent_basis(normals):
+    """An arbitrary but fixed orthonormal (u, v) basis of each tangent plane."""
+    lengths = np.sqrt((normals * normals).sum(axis=1))
+    lengths[lengths == 0] = 1
+    n = normals / lengths[:, None]
+    axis = np.zeros_like(n)
+    use_x = np.abs(n[:, 0]) < 0.9
+    axis[use_x, 0] = 1
+    axis[~use_x, 1] = 1
+    u = np.cross(n, axis)
+    u /= np.sqrt((u * u).sum(axis=1))[:, None]
+    return u, np.cross(n, u)
+
+
+def rosy_connection(mesh, basis_u, basis_v):
+    """Rotation taking 4-symmetric directions of each neighbor into the vertex's own basis.
+
+    For adjacency entry e, a neighbor direction encoded as exp(4i * angle) in the
+    neighbor's basis is connection[e] times that in the basis of edge_source[e].
+    """
+    source = mesh.edge_source
+    target = mesh.indices
+    angle = np.arctan2((basis_u[target] * basis_v[source]).sum(axis=1),
+                       (basis_u[target] * basis_u[source]).sum(axis=1))
+    return np.exp(4j * angle)
+
+
+def rosy_from_vectors(vec, basis_u, basis_v):
+    """exp(4i * angle) of vec in the tangent basis, equal for all four directions of a cross."""
+    return np.exp(4j * np.arctan2((vec * basis_v).sum(axis=1), (vec * basis_u).sum(axis=1)))
+
+
+def solve_rosy(mesh, connection, target, weight, guess=None, max_iterations=200, tolerance=1e-4):
+    """Smoothest 4-symmetric field, pulled towards target with the given per vertex weight.
+
+    Minimizes the sum over edges of |z_i - connection_ij * z_j|^2 plus the sum of
+    weight_i * |z_i - target_i|^2 with Jacobi preconditioned conjugate gradients.
+    The solution isn't normalized, it gets short where constraints disagree,
+    which is where the singularities go. Returns it with the iterations used.
+    """
+    # the rotations of both directions of an edge are averaged so the system is hermitian
+    rotation = connection + np.conj(connection[reverse_entries(mesh)])
+    length = np.abs(rotation)
+    rotation = np.where(length > 1e-9, rotation / np.maximum(length, 1e-9), 1)
+    diagonal = mesh.degree + weight
+    inverse = 1 / np.maximum(diagonal, 1e-9)
+
+    def product(z):
+        value = rotation * z[mesh.indices]
+        return diagonal * z - (mesh.segment_sum(value.real) + 1j * mesh.segment_sum(value.imag))
+
+    b = weight * target
+    z = np.zeros(len(mesh), dtype=np.complex128) if guess is None else guess.astype(np.complex128)
+    limit = tolerance * tolerance * np.vdot(b, b).real
+    r = b - product(z)
+    s = inverse * r
+    p = s.copy()
+    rs = np.vdot(r, s).real
+    iteration = 0
+    while iteration < max_iterations and np.vdot(r, r).real > limit:
+        check_cancelled()
+        q = product(p)
+        alpha = rs / np.vdot(p, q).real
+        z += alpha * p
+        r -= alpha * q
+        s = inverse * r
+        rs, previous = np.vdot(r, s).real, rs
+        p = s + (rs / previous) * p
+        iteration += 1
+    return z, iteration
+
+
+def vectors_from_rosy(rosy, basis_u, basis_v):
+    angle = np.angle(rosy) / 4
+    return basis_u * np.cos(angle)[:, None] + basis_v * np.sin(angle)[:, None]
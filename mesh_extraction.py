@@ -0,0 +1,515 @@
+'''
+Copyright (C) 2018 Jean Da Costa machado.
+Jean3dimensional@gmail.com
+
+Created by Jean Da Costa machado
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import numpy as np
+
+from .background import check_cancelled
+from .mesh_arrays import face_edges
+
+
+def smoothed_frames(normal, frame_u, neighbors):
+    """Particle normals averaged with their neighbors', with frames made tangent to them.
+
+    The particles' own normals are those of the flat faces they sit on, across a
+    sharp edge they disagree too much to connect. Returns (normal, u, v).
+    """
+    valid = neighbors >= 0
+    nb = np.maximum(neighbors, 0)
+    smooth = normal + (normal[nb] * valid[:, :, None]).sum(axis=1)
+    length = np.sqrt((smooth * smooth).sum(axis=1))
+    smooth = np.where(length[:, None] > 1e-9, smooth / np.maximum(length, 1e-9)[:, None], normal)
+
+    u = frame_u - smooth * (frame_u * smooth).sum(axis=1)[:, None]
+    length = np.sqrt((u * u).sum(axis=1))
+    flat = length < 1e-6
+    if flat.any():
+        # frame_u along the smoothed normal, any tangent does
+        u[flat] = np.cross(smooth[flat], np.where(np.abs(smooth[flat, :1]) < 0.9, (1., 0., 0.), (0., 1., 0.)))
+        length[flat] = np.sqrt((u[flat] * u[flat]).sum(axis=1))
+    u /= length[:, None]
+    return smooth, u, np.cross(smooth, u)
+
+
+def restricted_delaunay(co, normal, frame_u, frame_v, radius, neighbors, min_votes=2, chunk_size=4096,
+                        min_cos=-0.5, min_facing=0.25):
+    """Triangles connecting the particles, without touching the source mesh.
+
+    Every particle projects its neighbors on its tangent plane and keeps the
+    triangles it forms with pairs of them whose circumcircle holds no other
+    neighbor, which is the local piece of the restricted Delaunay triangulation.
+    Neighbors whose normal is more than acos(min_cos) away are left out, loose
+    enough to connect across sharp edges but not through thin walls. A triangle
+    is kept when at least min_votes of its three corners agree on it, and it faces
+    along the normal of each of them by more than min_facing, so it doesn't stand
+    across a sharp edge. Returns the (F, 3) triangles, sorted by vertex index, and
+    their votes.
+    """
+    count, k = neighbors.shape
+    ia, ib = np.triu_indices(k, 1)
+    columns = np.arange(k)
+    others = (columns[None, :] != ia[:, None]) & (columns[None, :] != ib[:, None])
+
+    found = [np.empty((0, 3), dtype=np.int64)]
+    for start in range(0, count, chunk_size):
+        check_cancelled()
+        rows = np.arange(start, min(count, start + chunk_size))
+        nb = neighbors[rows]
+        valid = (nb >= 0) & (nb != rows[:, None])
+        nb = np.maximum(nb, 0)
+
+        # tangent plane coordinates, in units of the particle radius
+        scale = radius[rows][:, None]
+        d = co[nb] - co[rows][:, None, :]
+        q = np.stack(((d * frame_u[rows][:, None, :]).sum(axis=2),
+                      (d * frame_v[rows][:, None, :]).sum(axis=2)), axis=2) / scale[:, :, None]
+        # neighbors are unfolded to their true distance, across a crease the plain
+        # projection shortens them differently for the particles on either side
+        planar = np.sqrt((q * q).sum(axis=2))
+        true = np.sqrt((d * d).sum(axis=2)) / scale
+        q *= np.where(planar > 1e-9, true / np.maximum(planar, 1e-9), 1)[:, :, None]
+        q2 = (q * q).sum(axis=2)
+        valid &= (normal[nb] * normal[rows][:, None, :]).sum(axis=2) > min_cos
+        valid &= q2 < 25
+
+        ax, ay, a2 = q[:, ia, 0], q[:, ia, 1], q2[:, ia]
+        bx, by, b2 = q[:, ib, 0], q[:, ib, 1], q2[:, ib]
+        orient = ax * by - ay * bx
+
+        # lifted in-circle determinant of (origin, a, b, c), negative when c is inside
+        cx, cy, c2 = q[:, None, :, 0], q[:, None, :, 1], q2[:, None, :]
+        det = (ax[:, :, None] * (by[:, :, None] * c2 - b2[:, :, None] * cy)
+               - ay[:, :, None] * (bx[:, :, None] * c2 - b2[:, :, None] * cx)
+               + a2[:, :, None] * (bx[:, :, None] * cy - by[:, :, None] * cx))
+        inside = det * np.sign(orient)[:, :, None] < -1e-9
+        inside &= others[None, :, :] & valid[:, None, :]
+
+        accept = valid[:, ia] & valid[:, ib] & (np.abs(orient) > 1e-6) & ~inside.any(axis=2)
+        row, pair = np.nonzero(accept)
+        found.append(np.stack((rows[row], nb[row, ia[pair]], nb[row, ib[pair]]), axis=1))
+
+    triangles = np.sort(np.concatenate(found), axis=1)
+    if not len(triangles):
+        return triangles, np.empty(0, dtype=np.int64)
+    order = np.lexsort(triangles.T[::-1])
+    triangles = triangles[order]
+    first = np.concatenate(([True], (triangles[1:] != triangles[:-1]).any(axis=1)))
+    starts = np.flatnonzero(first)
+    votes = np.diff(np.concatenate((starts, [len(triangles)])))
+    triangles = triangles[starts]
+    a, b, c = co[triangles[:, 0]], co[triangles[:, 1]], co[triangles[:, 2]]
+    face_normal = np.cross(b - a, c - a)
+    face_normal /= np.maximum(np.sqrt((face_normal * face_normal).sum(axis=1)), 1e-30)[:, None]
+    facing = np.abs((face_normal[:, None, :] * normal[triangles]).sum(axis=2)).min(axis=1)
+    keep = (votes >= min_votes) & (facing > min_facing)
+    return triangles[keep], votes[keep]
+
+
+def _half_edges(triangles):
+    a, b, c = triangles[:, 0], triangles[:, 1], triangles[:, 2]
+    start = np.concatenate((a, b, c))
+    end = np.concatenate((b, c, a))
+    opposite = np.concatenate((c, a, b))
+    face = np.tile(np.arange(len(triangles)), 3)
+    return np.minimum(start, end), np.maximum(start, end), opposite, face
+
+
+def _side(co, normal, x, y, w):
+    return (np.cross(co[y] - co[x], co[w] - co[x]) * normal[x]).sum(axis=-1)
+
+
+def manifold_triangles(co, normal, triangles, votes):
+    """Drops triangles until every edge has at most two faces lying on opposite sides of it.
+
+    Edges that already satisfy this are accepted as they are, only the triangles
+    touching conflicting edges are resolved greedily, the most voted first.
+    """
+    if not len(triangles):
+        return triangles
+    x, y, opposite, face = _half_edges(triangles)
+    key = x * len(co) + y
+    order = np.argsort(key, kind="mergesort")
+    key, x, y, opposite, face = key[order], x[order], y[order], opposite[order], face[order]
+    first = np.concatenate(([True], key[1:] != key[:-1]))
+    group = np.cumsum(first) - 1
+    sizes = np.bincount(group)
+    size = sizes[group]
+
+    conflicted_edge = size > 2
+    pairs = np.flatnonzero(first & (size == 2))
+    same_side = _side(co, normal, x[pairs], y[pairs], opposite[pairs]) * \
+        _side(co, normal, x[pairs], y[pairs], opposite[pairs + 1]) >= 0
+    conflicted_edge[pairs[same_side]] = True
+    conflicted_edge[pairs[same_side] + 1] = True
+
+    conflicted = np.zeros(len(triangles), dtype=np.bool_)
+    conflicted[face[conflicted_edge]] = True
+    if not conflicted.any():
+        return triangles
+
+    # edges of the accepted triangles that the greedy pass has to respect
+    touched = np.unique(key[conflicted[face]])
+    position = np.minimum(np.searchsorted(touched, key), len(touched) - 1)
+    seeded = (touched[position] == key) & ~conflicted[face]
+    edge_faces = {}
+    for k, w in zip(key[seeded].tolist(), opposite[seeded].tolist()):
+        edge_faces[k] = None if k in edge_faces else w
+
+    points = co.tolist()
+    normals = normal.tolist()
+    count = len(co)
+
+    def side(a, b, w):
+        pa, pb, pw, n = points[a], points[b], points[w], normals[a]
+        e0 = (pb[0] - pa[0], pb[1] - pa[1], pb[2] - pa[2])
+        e1 = (pw[0] - pa[0], pw[1] - pa[1], pw[2] - pa[2])
+        return ((e0[1] * e1[2] - e0[2] * e1[1]) * n[0] + (e0[2] * e1[0] - e0[0] * e1[2]) * n[1]
+                + (e0[0] * e1[1] - e0[1] * e1[0]) * n[2])
+
+    candidates = np.flatnonzero(conflicted)
+    candidates = candidates[np.argsort(-votes[candidates], kind="mergesort")]
+    accepted = []
+    for i, index in enumerate(candidates.tolist()):
+        if not i % 4096:
+            check_cancelled()
+        a, b, c = triangles[index].tolist()
+        edges = []
+        valid = True
+        for s, e, o in ((a, b, c), (b, c, a), (c, a, b)):
+            s, e = min(s, e), max(s, e)
+            k = s * count + e
+            if k in edge_faces:
+                w = edge_faces[k]
+                if w is None or side(s, e, w) * side(s, e, o) >= 0:
+                    valid = False
+                    break
+            edges.append((k, o))
+        if valid:
+            accepted.append(index)
+            for k, o in edges:
+                edge_faces[k] = None if k in edge_faces else o
+
+    keep = ~conflicted
+    keep[accepted] = True
+    return triangles[keep]
+
+
+def orient_triangles(co, normal, triangles):
+    """Flips the triangles whose winding disagrees with the normals of their corners."""
+    a, b, c = triangles[:, 0], triangles[:, 1], triangles[:, 2]
+    face_normal = np.cross(co[b] - co[a], co[c] - co[a])
+    flip = (face_normal * (normal[a] + normal[b] + normal[c])).sum(axis=1) < 0
+    triangles = triangles.copy()
+    triangles[flip, 1], triangles[flip, 2] = c[flip], b[flip]
+    return triangles
+
+
+def prune_low_valence(triangles, count):
+    """Drops the triangles around vertices with less than 3 edges until there are none, like
+    ParticleManager.finish_extraction does on the bmesh."""
+    while len(triangles):
+        valence = np.bincount(face_edges(triangles).ravel(), minlength=count)
+        low = (valence > 0) & (valence < 3)
+        if not low.any():
+            break
+        triangles = triangles[~low[triangles].any(axis=1)]
+    return triangles
+
+
+def _half_edge_keys(triangles, count):
+    """Keys of the directed half edges, the one leaving corner i of face f at row 3 * f + i,
+    and the keys of their twins."""
+    start = triangles.ravel()
+    end = np.roll(triangles, -1, axis=1).ravel()
+    return start * count + end, end * count + start
+
+
+def drop_nonmanifold(triangles, count):
+    """Drops triangles until every edge has at most two faces, wound opposite ways.
+
+    Repeated triangles are dropped too, earlier triangles win everywhere so the
+    ones to keep should come first.
+    """
+    if not len(triangles):
+        return triangles
+    corners = np.sort(triangles, axis=1)
+    unique = np.unique(corners[:, 0] * count * count + corners[:, 1] * count + corners[:, 2],
+                       return_index=True)[1]
+    triangles = triangles[np.sort(unique)]
+    while len(triangles):
+        key, twin = _half_edge_keys(triangles, count)
+        edge = np.minimum(key, twin)
+        order = np.argsort(edge, kind="mergesort")
+        first = np.concatenate(([True], edge[order][1:] != edge[order][:-1]))
+        rank = np.arange(len(order)) - np.flatnonzero(first)[np.cumsum(first) - 1]
+        # the second face of an edge has to run it the other way, a third one never fits
+        bad = rank > 1
+        second = np.flatnonzero(rank == 1)
+        bad[second] = key[order[second]] == key[order[second - 1]]
+        if not bad.any():
+            break
+        drop = np.zeros(len(triangles), dtype=np.bool_)
+        drop[order[bad] // 3] = True
+        triangles = triangles[~drop]
+    return triangles
+
+
+def drop_pinched(triangles, count):
+    """Drops the triangles around every vertex but those of its largest fan.
+
+    A fan is a run of triangles around the vertex joined by shared edges, a vertex
+    with several of them pinches separate pieces of surface together. Expects the
+    output of drop_nonmanifold.
+    """
+    if not len(triangles):
+        return triangles
+    key, twin = _half_edge_keys(triangles, count)
+    order = np.argsort(key)
+    position = np.minimum(np.searchsorted(key[order], twin), len(key) - 1)
+    matched = key[order][position] == twin
+    # half edge h runs a -> b and its twin g b -> a, rows are the corners they leave from
+    h = np.flatnonzero(matched)
+    g = order[position[matched]]
+    links = np.concatenate((np.stack((h, g // 3 * 3 + (g + 1) % 3), axis=1),
+                            np.stack((h // 3 * 3 + (h + 1) % 3, g), axis=1)))
+    # every corner takes the lowest corner of its fan as label
+    label = np.arange(len(key))
+    while True:
+        low = np.minimum(label[links[:, 0]], label[links[:, 1]])
+        new = label.copy()
+        np.minimum.at(new, links[:, 0], low)
+        np.minimum.at(new, links[:, 1], low)
+        new = new[new]
+        if (new == label).all():
+            break
+        label = new
+
+    vertex = triangles.ravel()
+    fans, fan, size = np.unique(vertex * len(key) + label, return_inverse=True, return_counts=True)
+    fan_vertex = fans // len(key)
+    by_size = np.lexsort((-size, fan_vertex))
+    largest = np.zeros(len(fans), dtype=np.bool_)
+    largest[by_size[np.concatenate(([True], fan_vertex[by_size][1:] != fan_vertex[by_size][:-1]))]] = True
+    drop = np.zeros(len(triangles), dtype=np.bool_)
+    drop[np.flatnonzero(~largest[fan.ravel()]) // 3] = True
+    return triangles[~drop]
+
+
+def boundary_loops(triangles):
+    """Simple loops of the edges with a single face, each running the way its faces wind.
+
+    Loops are walked edge by edge, a loop touching itself at a vertex with more
+    than one outgoing boundary edge is split there. Walks that don't get back to
+    their start are left out.
+    """
+    count = triangles.max() + 1 if len(triangles) else 0
+    key, twin = _half_edge_keys(triangles, count)
+    boundary = ~_contains(np.sort(key), twin)
+    outgoing = {}
+    for s, e in zip((key[boundary] // max(count, 1)).tolist(), (key[boundary] % max(count, 1)).tolist()):
+        outgoing.setdefault(s, []).append(e)
+
+    loops = []
+    for first in list(outgoing):
+        while outgoing[first]:
+            # closes a simple loop every time the walk comes back to a vertex on it
+            path = [first]
+            position = {first: 0}
+            while outgoing.get(path[-1]):
+                vert = outgoing[path[-1]].pop()
+                if vert in position:
+                    loop = path[position[vert]:]
+                    del path[position[vert] + 1:]
+                    for other in loop[1:]:
+                        del position[other]
+                    if len(loop) >= 3:
+                        loops.append(loop)
+                    if vert == first and len(path) == 1:
+                        break
+                    continue
+                position[vert] = len(path)
+                path.append(vert)
+    return loops
+
+
+def fill_holes(triangles, co, normal):
+    """Closes the boundary loops with triangles wound like the faces around them.
+
+    Every loop is clipped ear by ear, the one with the shortest new edge first,
+    ears facing away from the normals of their corners only when no other is left.
+    An ear whose new edge the mesh already has is never clipped, so filling doesn't
+    give any edge a third face. Loops left without such ears stay partly open.
+    """
+    loops = boundary_loops(triangles)
+    if not loops:
+        return triangles
+    count = len(co)
+    points = co.tolist()
+    normals = normal.tolist()
+    key, twin = _half_edge_keys(triangles, count)
+    edges = set(np.minimum(key, twin).tolist())
+
+    def length(a, b):
+        pa, pb = points[a], points[b]
+        return (pa[0] - pb[0]) ** 2 + (pa[1] - pb[1]) ** 2 + (pa[2] - pb[2]) ** 2
+
+    def facing(a, b, c):
+        pa, pb, pc = points[a], points[b], points[c]
+        e0 = (pb[0] - pa[0], pb[1] - pa[1], pb[2] - pa[2])
+        e1 = (pc[0] - pa[0], pc[1] - pa[1], pc[2] - pa[2])
+        n = [normals[a][i] + normals[b][i] + normals[c][i] for i in range(3)]
+        return ((e0[1] * e1[2] - e0[2] * e1[1]) * n[0] + (e0[2] * e1[0] - e0[0] * e1[2]) * n[1]
+                + (e0[0] * e1[1] - e0[1] * e1[0]) * n[2]) > 0
+
+    filled = []
+    for loop in loops:
+        check_cancelled()
+        while len(loop) > 3:
+            best = None
+            for i in range(len(loop)):
+                p, c, n = loop[i - 1], loop[i], loop[(i + 1) % len(loop)]
+                if min(p, n) * count + max(p, n) in edges:
+                    continue
+                ear = (not facing(p, n, c), length(p, n))
+                if best is None or ear < best[0]:
+                    best = (ear, i)
+            if best is None:
+                break
+            i = best[1]
+            p, c, n = loop[i - 1], loop[i], loop[(i + 1) % len(loop)]
+            filled.append((p, n, c))
+            edges.add(min(p, n) * count + max(p, n))
+            del loop[i]
+        if len(loop) == 3:
+            filled.append((loop[0], loop[2], loop[1]))
+    if not filled:
+        return triangles
+    return np.concatenate((triangles, np.array(filled, dtype=triangles.dtype)))
+
+
+def close_manifold(co, normal, triangles):
+    """Manifold surface out of the triangles, with its holes filled where they can be.
+
+    Triangles breaking the manifold are dropped, earlier ones win, along with the
+    ones left around vertices with less than 3 edges. Filling the holes left
+    afterwards keeps the surface manifold.
+    """
+    count = len(co)
+    while True:
+        check_cancelled()
+        size = len(triangles)
+        triangles = drop_nonmanifold(triangles, count)
+        triangles = drop_pinched(triangles, count)
+        triangles = prune_low_valence(triangles, count)
+        if len(triangles) == size:
+            break
+    return fill_holes(triangles, co, normal)
+
+
+def _contains(sorted_values, values):
+    position = np.minimum(np.searchsorted(sorted_values, values), len(sorted_values) - 1)
+    return sorted_values[position] == values
+
+
+def join_triangles(co, triangles, max_angle=1.0):
+    """Merges pairs of triangles sharing an edge into quads, the squarest first.
+
+    Only pairs forming a convex quad and bending less than max_angle radians are
+    merged. Returns the (Q, 4) quads and the (T, 3) triangles left.
+    """
+    a, b, c = triangles[:, 0], triangles[:, 1], triangles[:, 2]
+    start = np.concatenate((a, b, c))
+    end = np.concatenate((b, c, a))
+    opposite = np.concatenate((c, a, b))
+    face = np.tile(np.arange(len(triangles)), 3)
+    key = np.minimum(start, end) * len(co) + np.maximum(start, end)
+    order = np.argsort(key, kind="mergesort")
+    first = np.concatenate(([True], key[order][1:] != key[order][:-1]))
+    group = np.cumsum(first) - 1
+    # only edges with exactly two faces, wound opposite ways
+    position = np.flatnonzero(first & (np.bincount(group)[group] == 2))
+    pair = np.stack((order[position], order[position + 1]), axis=1)
+    pair = pair[start[pair[:, 0]] == end[pair[:, 1]]]
+    if not len(pair):
+        return np.empty((0, 4), dtype=np.int64), triangles
+
+    quads = np.stack((start[pair[:, 0]], opposite[pair[:, 1]], end[pair[:, 0]], opposite[pair[:, 0]]), axis=1)
+    corners = co[quads]
+    normals = np.cross(co[b] - co[a], co[c] - co[a])
+    normals /= np.maximum(np.sqrt((normals * normals).sum(axis=1)), 1e-30)[:, None]
+    n0 = normals[face[pair[:, 0]]]
+    n1 = normals[face[pair[:, 1]]]
+    bend = np.arccos(np.clip((n0 * n1).sum(axis=1), -1, 1))
+
+    score = np.zeros(len(quads))
+    convex = bend < max_angle
+    for i in range(4):
+        e0 = corners[:, i - 1] - corners[:, i]
+        e1 = corners[:, (i + 1) % 4] - corners[:, i]
+        convex &= (np.cross(e1, e0) * (n0 + n1)).sum(axis=1) > 0
+        cos = (e0 * e1).sum(axis=1) / np.maximum(np.sqrt((e0 * e0).sum(axis=1) * (e1 * e1).sum(axis=1)), 1e-30)
+        score += np.abs(np.arccos(np.clip(cos, -1, 1)) - np.pi / 2)
+
+    candidates = np.flatnonzero(convex)
+    candidates = candidates[np.argsort(score[candidates], kind="mergesort")]
+    used = np.zeros(len(triangles), dtype=np.bool_)
+    merged = []
+    for index, f0, f1 in zip(candidates.tolist(), face[pair[candidates, 0]].tolist(),
+                             face[pair[candidates, 1]].tolist()):
+        if not (used[f0] or used[f1]):
+            used[f0] = used[f1] = True
+            merged.append(index)
+    return quads[merged].reshape(-1, 4), triangles[~used]
+
+
+def split_edges(co, triangles, edges, split):
+    """Splits the masked edges at their middle and retriangulates the faces around them,
+    like bmesh.ops.subdivide_edges with a single cut followed by a triangulation.
+
+    edges are the face_edges of the triangles and split a mask over them. Returns the
+    new (co, triangles), the middle vertices come after the old ones.
+    """
+    count = len(co)
+    rows = np.flatnonzero(split)
+    middle = np.full(len(edges), -1, dtype=np.int64)
+    middle[rows] = count + np.arange(len(rows))
+    co = np.concatenate((co, (co[edges[rows, 0]] + co[edges[rows, 1]]) / 2))
+
+    # middle vertex of each side, side i runs from corner i to corner i + 1
+    start, end = triangles, np.roll(triangles, -1, axis=1)
+    key = np.minimum(start, end) * count + np.maximum(start, end)
+    sides = middle[np.searchsorted(edges[:, 0] * count + edges[:, 1], key)]
+    cut = sides >= 0
+    cuts = cut.sum(axis=1)
+
+    # rotate the corners so a single split side comes first and a single whole side last
+    shift = np.where(cuts == 1, np.argmax(cut, axis=1), 0)
+    shift = np.where(cuts == 2, (np.argmin(cut, axis=1) + 1) % 3, shift)
+    order = (np.arange(3) + shift[:, None]) % 3
+    face = np.arange(len(triangles))[:, None]
+    t, m = triangles[face, order], sides[face, order]
+    t0, t1, t2, m0, m1, m2 = t[:, 0], t[:, 1], t[:, 2], m[:, 0], m[:, 1], m[:, 2]
+
+    one, two, three = cuts == 1, cuts == 2, cuts == 3
+    parts = [triangles[cuts == 0],
+             np.stack((t0, m0, t2), axis=1)[one], np.stack((m0, t1, t2), axis=1)[one],
+             np.stack((m0, t1, m1), axis=1)[two], np.stack((t0, m0, m1), axis=1)[two],
+             np.stack((t0, m1, t2), axis=1)[two],
+             np.stack((t0, m0, m2), axis=1)[three], np.stack((m0, t1, m1), axis=1)[three],
+             np.stack((m2, m1, t2), axis=1)[three], np.stack((m0, m1, m2), axis=1)[three]]
+    return co, np.concatenate(parts)
@@ -0,0 +1,106 @@
+'''
+Copyright (C) 2018 Jean Da Costa machado.
+Jean3dimensional@gmail.com
+
+Created by Jean Da Costa machado
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import multiprocessing
+
+import numpy as np
+
+from .particle_arrays import relaxation_targets
+from .spatial_hash import SpatialHash
+
+# the field holds a BVHTree that can't be pickled, forked workers inherit it from here
+_field = None
+
+
+def _relax_cell(task):
+    particles, owned, speed, triangle_mode, cell_size = task
+    index = SpatialHash(cell_size, particles.co)
+    rows = np.arange(owned)
+    neighbors, distances = index.find_n_array(particles.co[:owned], 9)
+    moving, radius, targets = relaxation_targets(particles, rows, neighbors, distances, speed, triangle_mode)
+    return moving, radius, _field.sample_points(targets[moving])
+
+
+class ParallelRelaxation:
+    """Runs the batched relaxation step over spatial slabs in worker processes.
+
+    Particles are split in equally populated slabs along the longest axis. Each
+    worker gets the particles of its slab plus a halo of ghosts from the slabs
+    next to it, wide enough to hold the neighbors of every owned particle.
+    """
+
+    def __init__(self, manager, workers):
+        global _field
+        self.manager = manager
+        self.workers = max(1, workers)
+        self.pool = None
+        if manager.field.face_frames is None:
+            manager.field.build_sampling_data()
+        _field = manager.field
+        if self.workers > 1:
+            try:
+                self.pool = multiprocessing.get_context("fork").Pool(self.workers)
+            except ValueError:
+                # no fork on this platform, the BVHTree can't reach the workers
+                self.workers = 1
+
+    def close(self):
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def split(self):
+        particles = self.manager.particles
+        co = particles.co
+        axis = int(np.argmax(co.max(axis=0) - co.min(axis=0)))
+        x = co[:, axis]
+        bounds = np.percentile(x, np.linspace(0, 100, self.workers + 1))
+        bounds[0] = -np.inf
+        bounds[-1] = np.inf
+        cell = np.searchsorted(bounds[1:-1], x, side="right")
+        halo = 2 * self.manager.index.cell_size
+
+        cells = []
+        for i in range(self.workers):
+            owned = np.flatnonzero(cell == i)
+            ghosts = np.flatnonzero((cell != i) & (x >= bounds[i] - halo) & (x < bounds[i + 1] + halo))
+            if len(owned):
+                cells.append((owned, ghosts))
+        return cells
+
+    def step(self, speed):
+        manager = self.manager
+        particles = manager.particles
+        if not len(particles):
+            return
+
+        cells = self.split()
+        tasks = [(particles.subset(np.concatenate((owned, ghosts))), len(owned), speed,
+                  manager.triangle_mode, manager.index.cell_size) for owned, ghosts in cells]
+        if self.pool:
+            results = self.pool.map(_relax_cell, tasks)
+        else:
+            results = [_relax_cell(task) for task in tasks]
+
+        for (owned, ghosts), (moving, radius, hits) in zip(cells, results):
+            moving_rows = owned[moving]
+            particles.radius[moving_rows] = radius[moving]
+            particles.set_hits(moving_rows[hits.valid], hits, hits.valid)
+        manager.apply_symmetry()
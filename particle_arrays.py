@@ -0,0 +1,190 @@
+'''
+Copyright (C) 2018 Jean Da Costa machado.
+Jean3dimensional@gmail.com
+
+Created by Jean Da Costa machado
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import numpy as np
+
+from .mesh_arrays import nearest_frame_vectors
+
+TAG_NONE = 0
+TAG_DONE = 1
+TAG_REMOVE = 2
+
+
+class ParticleArrays:
+    # name, components, dtype, default value
+    fields = (
+        ("co", 3, np.float64, 0),
+        ("normal", 3, np.float64, 0),
+        ("frame_u", 3, np.float64, 0),
+        ("frame_v", 3, np.float64, 0),
+        ("curvature", 1, np.float64, 0),
+        ("face", 1, np.int32, -1),
+        ("radius", 1, np.float64, 0.05),
+        ("adaptive", 1, np.float64, 0.1),
+        ("target_resolution", 1, np.float64, 0.1),
+        ("tag", 1, np.int8, TAG_NONE),
+        ("counter_pair", 1, np.int32, -1),
+        ("lock_x", 1, np.bool_, False),
+    )
+
+    hit_fields = ("co", "normal", "frame_u", "frame_v", "curvature", "face")
+
+    def __init__(self, capacity=64):
+        self.count = 0
+        self.capacity = 0
+        self.data = {}
+        for name, size, dtype, default in self.fields:
+            self.data[name] = np.empty((0, size) if size > 1 else 0, dtype=dtype)
+        self.reserve(capacity)
+
+    def __len__(self):
+        return self.count
+
+    def __getattr__(self, name):
+        data = self.__dict__.get("data")
+        if data is not None and name in data:
+            return data[name][:self.count]
+        raise AttributeError(name)
+
+    def reserve(self, capacity):
+        if capacity <= self.capacity:
+            return
+        capacity = max(capacity, self.capacity * 2)
+        for name, size, dtype, default in self.fields:
+            shape = (capacity, size) if size > 1 else (capacity,)
+            array = np.full(shape, default, dtype=dtype)
+            array[:self.count] = self.data[name][:self.count]
+            self.data[name] = array
+        self.capacity = capacity
+
+    def add(self, count=1):
+        start = self.count
+        self.reserve(start + count)
+        for name, size, dtype, default in self.fields:
+            self.data[name][start:start + count] = default
+        self.count += count
+        return start
+
+    def set_hit(self, index, hit):
+        self.data["co"][index] = hit.co
+        self.data["normal"][index] = hit.normal
+        self.data["frame_u"][index] = hit.frame.u
+        self.data["frame_v"][index] = hit.frame.v
+        self.data["curvature"][index] = hit.curvature
+        self.data["face"][index] = hit.face
+
+    def set_hits(self, indices, hits, rows=slice(None)):
+        for name in self.hit_fields:
+            self.data[name][indices] = getattr(hits, name)[rows]
+
+    def keep(self, mask):
+        """Compacts the store to the rows where mask is True, returns the old to new index mapping."""
+        mask = np.asarray(mask, dtype=np.bool_)
+        remap = np.full(self.count, -1, dtype=np.int32)
+        remap[mask] = np.arange(np.count_nonzero(mask), dtype=np.int32)
+        for name, size, dtype, default in self.fields:
+            kept = self.data[name][:self.count][mask]
+            self.data[name][:len(kept)] = kept
+        self.count = int(np.count_nonzero(mask))
+        pairs = self.data["counter_pair"][:self.count]
+        paired = pairs >= 0
+        pairs[paired] = remap[pairs[paired]]
+        return remap
+
+    def extend(self, other, rows=None):
+        if rows is None:
+            rows = np.arange(len(other))
+        start = self.add(len(rows))
+        for name, size, dtype, default in self.fields:
+            self.data[name][start:self.count] = other.data[name][rows]
+        return start
+
+    def copy(self):
+        other = ParticleArrays(len(self))
+        other.extend(self)
+        return other
+
+    def subset(self, rows):
+        """Copy of the given rows, mirror pairs are dropped since their indices would not match."""
+        other = ParticleArrays(len(rows))
+        other.extend(self, rows)
+        other.counter_pair[:] = -1
+        return other
+
+    def nbytes(self):
+        return sum(self.data[name][:self.count].nbytes for name, size, dtype, default in self.fields)
+
+
+def quad_forces(particles, rows, neighbors, triangle_mode=False):
+    """Sum of the neighbor forces acting on each row.
+
+    rows is an (N,) array of particle indices and neighbors an (N, k) array of
+    the indices around them, padded with -1. Mirrors Partile.quad_force.
+    """
+    co = particles.co
+    normal = particles.normal
+    valid = neighbors >= 0
+    nb = np.where(valid, neighbors, 0)
+
+    self_co = co[rows][:, None, :]
+    self_normal = normal[rows][:, None, :]
+    nb_co = co[nb]
+    angle = np.maximum((normal[nb] * self_normal).sum(axis=2), 0)
+
+    d = _force_vector(self_co, nb_co) * 2
+    if not triangle_mode:
+        radius = particles.radius[nb][:, :, None]
+        u = nearest_frame_vectors(particles.frame_u[nb], particles.frame_v[nb], d) * radius
+        v = np.cross(u, normal[nb])
+        weight = (0.2 * angle)[:, :, None]
+        d += _force_vector(self_co, u + v + nb_co) * weight
+        d += _force_vector(self_co, u - v + nb_co) * weight
+        nb_adaptive = particles.adaptive[nb]
+        curv = particles.curvature[nb] * nb_adaptive + (1 - nb_adaptive)
+    else:
+        self_adaptive = particles.adaptive[rows][:, None]
+        curv = self_adaptive * angle + (1 - self_adaptive)
+
+    d /= curv[:, :, None]
+    d[~valid] = 0
+    return d.sum(axis=1)
+
+
+def relaxation_targets(particles, rows, neighbors, distances, speed, triangle_mode=False):
+    """Batched relaxation step for the given rows.
+
+    Returns which rows have neighbors to move away from, their new radius
+    estimate and the unprojected location they move to.
+    """
+    valid = neighbors >= 0
+    neighbor_count = valid.sum(axis=1)
+    movement = quad_forces(particles, rows, neighbors, triangle_mode)
+    radius = np.where(valid, distances, 0).sum(axis=1) / np.maximum(neighbor_count, 1) / 2.1
+    length = np.sqrt((movement * movement).sum(axis=1))
+    movement[length > 0] /= length[length > 0, None]
+    targets = particles.co[rows] + movement * (radius * speed)[:, None]
+    return neighbor_count > 0, radius, targets
+
+
+def _force_vector(location, target):
+    d = location - target
+    le = (d * d).sum(axis=-1)[..., None]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        d = np.where(le == 0, 0, d / (le * le))
+    return d
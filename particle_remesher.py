@@ -18,75 +18,17 @@ Created by Jean Da Costa machado
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
+import os
+import tempfile
+
 import bpy
 from .surface_particles import *
-from mathutils import bvhtree
 from . import ui
+from .background import BackgroundStages
+from .pipeline import RemeshPipeline
 import traceback
 
 
-def surface_snap(source_verts, tree):
-    for vert in source_verts:
-        final_co = None
-        start = vert.co
-        ray = vert.normal
-        location1, normal, index, distance1 = tree.ray_cast(start, ray)
-        location2, normal, index, distance2 = tree.ray_cast(start, -ray)
-        if location1 and location2:
-            final_co = location2 if distance2 < distance1 else location1
-        elif location1:
-            final_co = location1
-        elif location2:
-            final_co = location2
-        else:
-            location, normal, index, distance = tree.find_nearest(vert.co)
-            if location:
-                final_co = location
-        if final_co:
-            vert.co = final_co
-
-
-def triangle_quad_subdivide(obj):
-    bm = bmesh.new()
-    bm.from_mesh(obj.data)
-    bmesh.ops.subdivide_edges(bm, edges=bm.edges, cuts=1, use_grid_fill=True, smooth=1)
-    collapse_edges = set()
-    for vert in bm.verts:
-        if len(vert.link_edges) not in {5,6}:
-            continue
-        if [len(face.verts) for face in vert.link_faces].count(3) == 1:
-            for face in vert.link_faces:
-                if len(face.verts) == 3:
-                    for edge in face.edges:
-                        if vert not in edge.verts:
-                            collapse_edges.add(edge)
-
-    bmesh.ops.collapse(bm, edges=list(collapse_edges))
-    triangulate_faces = set()
-    connect_verts = set()
-    for vert in bm.verts:
-        face_count = len(vert.link_faces)
-        if face_count > 4:
-            for face in vert.link_faces:
-                triangulate_faces.add(face)
-                for vert in face.verts:
-                    if len(vert.link_edges) == 4:
-                        connect_verts.add(vert)
-        elif face_count == 3:
-            for face in vert.link_faces:
-                triangulate_faces.add(face)
-                for vert in face.verts:
-                    if len(vert.link_edges) in {3, 5}:
-                            connect_verts.add(vert)
-    
-    bmesh.ops.connect_verts(bm, verts=list(connect_verts))
-    #bmesh.ops.triangulate(bm, faces=list(triangulate_faces))
-    bmesh.ops.join_triangles(bm, faces=bm.faces, angle_face_threshold=1.5, angle_shape_threshold=3.14)
-    bmesh.ops.smooth_vert(bm, verts=bm.verts, use_axis_x=True, use_axis_y=True, use_axis_z=True, factor=1)
-
-    bm.to_mesh(obj.data)
-
-
 class ParticleTest(bpy.types.Operator):
     bl_idname = "tesselator2.remesh_particles"
     bl_label = "Particle Remesh"
@@ -99,7 +41,9 @@ class ParticleTest(bpy.types.Operator):
     tree = None
     initialized = False
     algorithm_steps = None
+    pipeline = None
     solver = None
+    runner = None
 
     resolution = bpy.props.FloatProperty(
         name="Resolution",
@@ -171,6 +115,111 @@ class ParticleTest(bpy.types.Operator):
                ("ANOTHER_MESH", "Another Mesh", "Use vertices from another mesh as starting particles")],
         default="FAST_MARCHING"
     )
+    levels = bpy.props.IntProperty(
+        name="Levels",
+        description="Relax a coarser particle set first and refine it this many times, "
+                    "each level doubling the resolution",
+        default=0,
+        min=0,
+        max=4
+    )
+    level_steps = bpy.props.IntProperty(
+        name="Level Steps",
+        description="Relaxation steps after each refinement",
+        default=5,
+        min=0
+    )
+    batched_relaxation = bpy.props.BoolProperty(
+        name="Batched Relaxation",
+        description="Move all particles at once with array operations (faster, slightly different motion)",
+        default=True
+    )
+    convergence = bpy.props.FloatProperty(
+        name="Convergence",
+        description="Particles whose net movement over a few steps stays under this fraction of their step length "
+                    "stop until a neighbor moves, relaxation ends early once all stopped (0 always runs every step)",
+        default=0.0,
+        min=0.0,
+        max=1.0
+    )
+    workers = bpy.props.IntProperty(
+        name="Workers",
+        description="Processes used to snap the result to the surface and for the relaxation steps of batch "
+                    "runs (1 runs in Blender's own process, the remesh operator always relaxes in it)",
+        default=1,
+        min=1,
+        max=64
+    )
+    step_budget = bpy.props.IntProperty(
+        name="Step Budget (ms)",
+        description="Longest run of solver work between progress updates, steps over more particles "
+                    "are split and resumed (0 runs whole steps)",
+        default=50,
+        min=0
+    )
+    field_mode = bpy.props.EnumProperty(
+        name="Field Mode",
+        description="How the direction field is built from curvature and grease pencil",
+        items=[("GROW", "Grow", "Grow the field from the sharpest vertices and smooth it, fast."),
+               ("SOLVE", "Solve", "Solve for the smoothest field following curvature and strokes, better singularities.")],
+        default="GROW"
+    )
+    field_iterations = bpy.props.IntProperty(
+        name="Solver Iterations",
+        description="Most iterations of the field solver, bounds its time on large meshes",
+        default=200,
+        min=10
+    )
+    field_cache = bpy.props.BoolProperty(
+        name="Cache Direction Field",
+        description="Reuse the direction field from disk when the decimated mesh and guides didn't change",
+        default=True
+    )
+    field_cache_size = bpy.props.IntProperty(
+        name="Cache Size (MB)",
+        description="Oldest cached fields are deleted beyond this size",
+        default=256,
+        min=1
+    )
+    extraction = bpy.props.EnumProperty(
+        name="Mesh Extraction",
+        description="How particles are connected into the final mesh",
+        items=[("DELAUNAY", "Delaunay", "Connects neighboring particles directly, fast on high resolutions."),
+               ("SUBDIVIDE", "Subdivide", "Subdivides the source mesh and connects the particles owning its faces.")],
+        default="DELAUNAY"
+    )
+    preview_particles = bpy.props.IntProperty(
+        name="Preview Particles",
+        description="Most particles drawn while remeshing, the rest are skipped evenly",
+        default=20000,
+        min=100
+    )
+    preview_refresh = bpy.props.EnumProperty(
+        name="Preview Refresh",
+        description="When the particle preview is rebuilt while remeshing",
+        items=[("STEPS", "Steps", "Rebuild the preview every few solver steps."),
+               ("TIME", "Time", "Rebuild the preview at most once per interval."),
+               ("OFF", "Off", "Don't draw particles, fastest.")],
+        default="STEPS"
+    )
+    preview_steps = bpy.props.IntProperty(
+        name="Refresh Steps",
+        description="Solver steps between preview refreshes",
+        default=1,
+        min=1
+    )
+    preview_interval = bpy.props.IntProperty(
+        name="Refresh Interval (ms)",
+        description="Shortest time between preview refreshes",
+        default=200,
+        min=0
+    )
+    profile_log = bpy.props.StringProperty(
+        name="Profile Log",
+        description="Json file receiving stage timings and counters of each run (empty uses the temporary directory)",
+        subtype="FILE_PATH",
+        default=""
+    )
     show_advanced = bpy.props.BoolProperty(
         name="Advanced Settings",
         description="Show advanced settigns."
@@ -186,74 +235,20 @@ class ParticleTest(bpy.types.Operator):
                 return True
 
     def stepper(self, context, event):
-        ui.feedback = ["Decimating domain."]
-        yield {"RUNNING_MODAL"}
-        yield {"RUNNING_MODAL"}
-
-        self.bm = bmesh.new()
-        self.bm.from_mesh(context.active_object.data)
-        self.tree = bvhtree.BVHTree.FromObject(context.active_object, context.scene)
-
-        md = context.active_object.modifiers.new(type="DECIMATE", name="Decimate")
-        md.ratio = self.predecimation
-        bpy.ops.object.modifier_apply(modifier=md.name)
-
-        ui.feedback = ["Building Direction Field."]
-        yield {"RUNNING_MODAL"}
-        self.solver = ParticleManager(context.active_object)
-        self._handle = bpy.types.SpaceView3D.draw_handler_add(self.solver.draw_obj, (), "WINDOW", "POST_VIEW")
-        self.solver.build_field(context, self.use_gp, self.x_mirror)
-        self.bm.verts.ensure_lookup_table()
-
-        if self.triangle_mode:
-            self.solver.triangle_mode = True
-        self.bm.to_mesh(context.active_object.data)
-
-        if self.particle_placement == "FAST_MARCHING":
-            new_particles = False
-            if self.use_gp:
-                new_particles = self.solver.initialize_particles_from_gp(self.resolution, self.adaptive, context)
-                if self.x_mirror:
-                    self.solver.mirror_particles(any_side=True)
-            if not new_particles:
-                self.solver.initialize_from_features(self.bm.verts, self.resolution, self.adaptive, self.seeds)
-            while True:
-                ui.feedback = ["Spreading particles.."]
-                result = self.solver.spread_step()
-                yield {"RUNNING_MODAL"}
-                if not result:
-                    break
-            for i in range(2):
-                self.solver.spread_step()
-
-
-        elif self.particle_placement == "INTEGER_LATTICE":
-            ui.feedback = ["Creating particles.."]
+        self.pipeline = pipeline = RemeshPipeline(context, context.active_object, self)
+        for feedback in pipeline.prepare():
+            ui.feedback = feedback + pipeline.profile.feedback()
             yield {"RUNNING_MODAL"}
-            self.solver.initialize_grid(self.bm.verts, self.resolution, self.x_mirror, self.adaptive)
-
-        elif self.particle_placement == "ANOTHER_MESH":
-            objs = list(context.selected_objects)
-            for obj in objs:
-                if obj is not context.active_object:
-                    break
-            self.solver.initialize_from_verts(obj.data.vertices, self.adaptive)
-            if self.x_mirror:
-                self.solver.mirror_particles()
 
-        if self.x_mirror:
-            self.solver.mirror_particles()
-
-        for i in range(self.steps):
-            self.solver.step(self.step_scale)
-            ui.feedback = ["Relaxation step.",
-                           str(int(i / self.steps * 100)) + "% Done.",
-                           "Press Esc to stop."]
+        self.solver = pipeline.solver
+        self._handle = bpy.types.SpaceView3D.draw_handler_add(self.solver.draw_obj, (), "WINDOW", "POST_VIEW")
+        # the solver runs on its own thread, the timer only polls it and redraws the preview
+        self.runner = BackgroundStages(feedback + pipeline.profile.feedback() for feedback in pipeline.solve())
+        while not self.runner.done:
+            ui.feedback = self.runner.feedback
             yield {"RUNNING_MODAL"}
-
-        ui.feedback = ["Extracting Mesh."]
-        yield {"RUNNING_MODAL"}
-        yield {"RUNNING_MODAL"}
+        if self.runner.error:
+            raise RuntimeError(self.runner.error)
 
         yield self.finish(context)
 
@@ -272,50 +267,51 @@ class ParticleTest(bpy.types.Operator):
                 return next(self.algorithm_steps)
 
             if event.type == "ESC":
+                if self.runner:
+                    # the solver stops at its next yield or cancel check, the timer finishes once it has
+                    self.runner.cancel()
+                    return {"RUNNING_MODAL"}
                 return self.finish(context)
 
             return {"RUNNING_MODAL"}
         except:
             traceback.print_exc()
             ui.feedback = []
+            if self.runner:
+                self.runner.join(1.0)
+            if self.pipeline:
+                self.pipeline.stop_snapping()
+                self.pipeline.profile.deactivate()
             context.window_manager.event_timer_remove(self._timer)
-            bpy.types.SpaceView3D.draw_handler_remove(self._handle, "WINDOW")
+            if self._handle:
+                bpy.types.SpaceView3D.draw_handler_remove(self._handle, "WINDOW")
             self.report({"ERROR"}, message="Something went wrong, remeshing couldn't finish, open console for details.")
             return {"CANCELLED"}
 
     def finish(self, context):
         ui.feedback = []
         context.window_manager.event_timer_remove(self._timer)
-        bpy.types.SpaceView3D.draw_handler_remove(self._handle, "WINDOW")
-        bm = self.solver.simplify_mesh(self.bm)
-
-        for i in range(5):
-            bmesh.ops.smooth_vert(bm, verts=bm.verts, use_axis_x=True, use_axis_y=True, use_axis_z=True, factor=0.5)
-            surface_snap(bm.verts, self.tree)
-
-        bm.to_mesh(context.active_object.data)
-        new_obj = context.active_object
-
-        for _ in range(self.subdivisions):
-            if not self.triangle_mode:
-                if self.allow_triangles:
-                    triangle_quad_subdivide(new_obj)
-                else:
-                    md = new_obj.modifiers.new(type="SUBSURF", name="SUBSURF")
-                    md.levels = 1
-                    # md.subdivision_type = "SIMPLE"
-                    bpy.ops.object.modifier_apply(modifier=md.name)
-                surface_snap(new_obj.data.vertices, self.tree)
-            else:
-                bmesh.ops.subdivide_edges(bm, edges=bm.edges, cuts=1, use_grid_fill=True)
-                surface_snap(bm.verts, self.tree)
-                # bmesh.ops.smooth_vert(bm, verts=bm.verts, use_axis_x=True, use_axis_y=True, use_axis_z=True, factor=1)
-
-        if self.triangle_mode:
-            surface_snap(bm.verts, self.tree)
-            bm.to_mesh(new_obj.data)
+        if self._handle:
+            bpy.types.SpaceView3D.draw_handler_remove(self._handle, "WINDOW")
+        if not self.pipeline:
+            return {"CANCELLED"}
+        if self.solver:
+            self.solver.draw_obj.free()
+        if self.solver and not (self.runner and self.runner.interrupted):
+            self.pipeline.finish()
         else:
-            surface_snap(new_obj.data.vertices, self.tree)
+            # stopped while preparing, building the field or extracting, there is no mesh to build
+            self.pipeline.restore()
+            self.pipeline.profile.deactivate()
+            context.area.tag_redraw()
+            return {"CANCELLED"}
+
+        path = bpy.path.abspath(self.profile_log) if self.profile_log else \
+            os.path.join(tempfile.gettempdir(), "tesselator_profile.json")
+        try:
+            self.pipeline.profile.save(path)
+        except OSError:
+            self.report({"WARNING"}, message="Couldn't write the profile log to " + path)
 
         context.area.tag_redraw()
         return {"FINISHED"}
@@ -0,0 +1,391 @@
+'''
+Copyright (C) 2018 Jean Da Costa machado.
+Jean3dimensional@gmail.com
+
+Created by Jean Da Costa machado
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import multiprocessing
+
+import bmesh
+import bpy
+import numpy as np
+from mathutils import bvhtree
+
+from .core import Remesher
+from .field_cache import FieldCache
+from .profiling import Profiler
+from .surface_particles import ParticleManager
+
+
+def surface_snap(source_verts, tree):
+    for vert in source_verts:
+        final_co = None
+        start = vert.co
+        ray = vert.normal
+        location1, normal, index, distance1 = tree.ray_cast(start, ray)
+        location2, normal, index, distance2 = tree.ray_cast(start, -ray)
+        if location1 and location2:
+            final_co = location2 if distance2 < distance1 else location1
+        elif location1:
+            final_co = location1
+        elif location2:
+            final_co = location2
+        else:
+            location, normal, index, distance = tree.find_nearest(vert.co)
+            if location:
+                final_co = location
+        if final_co:
+            vert.co = final_co
+
+
+# BVHTrees can't be pickled, forked snapping workers inherit the tree from here
+_tree = None
+
+
+def _snap_chunk(task):
+    co, normal, limit = task
+    tree = _tree
+    result = co.copy()
+    for i, (start, ray, distance) in enumerate(zip(co.tolist(), normal.tolist(), limit.tolist())):
+        back = (-ray[0], -ray[1], -ray[2])
+        for bound in ((distance,) if distance == np.inf else (distance, np.inf)):
+            if bound == np.inf:
+                location1, normal1, index1, distance1 = tree.ray_cast(start, ray)
+                location2, normal2, index2, distance2 = tree.ray_cast(start, back)
+            else:
+                location1, normal1, index1, distance1 = tree.ray_cast(start, ray, bound)
+                location2, normal2, index2, distance2 = tree.ray_cast(start, back, bound)
+            if location1 and location2:
+                result[i] = location2 if distance2 < distance1 else location1
+            elif location1 or location2:
+                result[i] = location1 or location2
+            else:
+                continue
+            break
+        else:
+            location, normal1, index, distance = tree.find_nearest(start)
+            if location:
+                result[i] = location
+    return result
+
+
+def vertex_arrays(verts):
+    """Locations and normals of mesh vertices or bmesh verts as (N, 3) arrays."""
+    if hasattr(verts, "foreach_get"):
+        co = np.empty(len(verts) * 3)
+        normal = np.empty(len(verts) * 3)
+        verts.foreach_get("co", co)
+        verts.foreach_get("normal", normal)
+        return co.reshape(-1, 3), normal.reshape(-1, 3)
+    co = np.array([vert.co for vert in verts], dtype=np.float64).reshape(-1, 3)
+    normal = np.array([vert.normal for vert in verts], dtype=np.float64).reshape(-1, 3)
+    return co, normal
+
+
+def set_vertex_locations(verts, co):
+    if hasattr(verts, "foreach_set"):
+        verts.foreach_set("co", co.ravel())
+    else:
+        for vert, location in zip(verts, co.tolist()):
+            vert.co = location
+
+
+class SurfaceSnapper:
+    """Bulk surface_snap, vertices are projected in chunks over forked worker processes.
+
+    The workers are forked once and kept until close(), like ParallelRelaxation does.
+    The hits of the previous call are kept, when the same vertices are snapped again
+    the rays are first cast only a bit further than where each vertex was last
+    snapped to. A hit inside that bound is the same closest hit the unbounded rays
+    would give, the others are cast again without bound.
+    """
+
+    chunk_size = 4096
+
+    def __init__(self, tree, workers=1):
+        global _tree
+        self.tree = tree
+        self.workers = max(1, workers)
+        self.previous = None
+        self.pool = None
+        _tree = tree
+        if self.workers > 1:
+            try:
+                self.pool = multiprocessing.get_context("fork").Pool(self.workers)
+            except ValueError:
+                # no fork on this platform, the BVHTree can't reach the workers
+                self.workers = 1
+
+    def close(self):
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def snap(self, verts):
+        global _tree
+        co, normal = vertex_arrays(verts)
+        if not len(co):
+            return
+        limit = np.full(len(co), np.inf)
+        if self.previous is not None and len(self.previous) == len(co):
+            limit = np.sqrt(((co - self.previous) ** 2).sum(axis=1)) * 2 + 1e-6
+
+        _tree = self.tree
+        step = max(self.chunk_size, -(-len(co) // (self.workers * 4)))
+        tasks = [(co[i:i + step], normal[i:i + step], limit[i:i + step]) for i in range(0, len(co), step)]
+        if self.pool and len(tasks) > 1:
+            results = self.pool.map(_snap_chunk, tasks)
+        else:
+            results = [_snap_chunk(task) for task in tasks]
+
+        result = np.concatenate(results)
+        set_vertex_locations(verts, result)
+        self.previous = result
+
+
+def triangle_quad_subdivide(obj):
+    bm = bmesh.new()
+    bm.from_mesh(obj.data)
+    bmesh.ops.subdivide_edges(bm, edges=bm.edges, cuts=1, use_grid_fill=True, smooth=1)
+    collapse_edges = set()
+    for vert in bm.verts:
+        if len(vert.link_edges) not in {5,6}:
+            continue
+        if [len(face.verts) for face in vert.link_faces].count(3) == 1:
+            for face in vert.link_faces:
+                if len(face.verts) == 3:
+                    for edge in face.edges:
+                        if vert not in edge.verts:
+                            collapse_edges.add(edge)
+
+    bmesh.ops.collapse(bm, edges=list(collapse_edges))
+    triangulate_faces = set()
+    connect_verts = set()
+    for vert in bm.verts:
+        face_count = len(vert.link_faces)
+        if face_count > 4:
+            for face in vert.link_faces:
+                triangulate_faces.add(face)
+                for vert in face.verts:
+                    if len(vert.link_edges) == 4:
+                        connect_verts.add(vert)
+        elif face_count == 3:
+            for face in vert.link_faces:
+                triangulate_faces.add(face)
+                for vert in face.verts:
+                    if len(vert.link_edges) in {3, 5}:
+                            connect_verts.add(vert)
+
+    bmesh.ops.connect_verts(bm, verts=list(connect_verts))
+    #bmesh.ops.triangulate(bm, faces=list(triangulate_faces))
+    bmesh.ops.join_triangles(bm, faces=bm.faces, angle_face_threshold=1.5, angle_shape_threshold=3.14)
+    bmesh.ops.smooth_vert(bm, verts=bm.verts, use_axis_x=True, use_axis_y=True, use_axis_z=True, factor=1)
+
+    bm.to_mesh(obj.data)
+
+
+class RemeshPipeline:
+    """The remesh stages of the particle remesher, without any UI.
+
+    params is anything holding the remesh operator settings as attributes. stages()
+    runs a bit of work per iteration and yields the feedback lines describing it,
+    finish() extracts and subdivides the final mesh into obj. Stage and step times
+    and the hot path counters of the run are collected in profile. Placement,
+    relaxation and refinement are core.Remesher's, this adds the Blender parts:
+    decimation, grease pencil and the bmesh based extraction.
+
+    stages() is prepare() then solve(). prepare() and finish() use Blender data
+    and must run on the main thread, solve() only works on arrays and the copies
+    prepare() read, so it can run on a background thread in between.
+    """
+
+    def __init__(self, context, obj, params):
+        self.context = context
+        self.obj = obj
+        self.params = params
+        self.bm = None
+        self.tree = None
+        self.solver = None
+        self.remesher = None
+        self.snapper = None
+        self.strokes = []
+        self.placement_co = None
+        self.triangles = None
+        self.profile = Profiler()
+
+    @property
+    def timings(self):
+        return self.profile.timings
+
+    def timed(self, stage):
+        return self.profile.timed(stage)
+
+    def snap(self, verts):
+        with self.timed("surface_snap"):
+            if self.snapper is None:
+                self.snapper = SurfaceSnapper(self.tree, self.params.workers)
+            self.snapper.snap(verts)
+
+    def stop_snapping(self):
+        if self.snapper:
+            self.snapper.close()
+        self.snapper = None
+
+    def stages(self):
+        yield from self.prepare()
+        yield from self.solve()
+
+    def prepare(self):
+        """Decimates obj and reads everything solve() needs from Blender."""
+        context = self.context
+        obj = self.obj
+        params = self.params
+        self.profile.activate()
+
+        yield ["Decimating domain."]
+        yield ["Decimating domain."]
+
+        with self.timed("predecimation"):
+            self.bm = bmesh.new()
+            self.bm.from_mesh(obj.data)
+            self.tree = bvhtree.BVHTree.FromObject(obj, context.scene)
+
+            md = obj.modifiers.new(type="DECIMATE", name="Decimate")
+            md.ratio = params.predecimation
+            bpy.ops.object.modifier_apply(modifier=md.name)
+
+        yield ["Building Direction Field."]
+        with self.timed("build_field"):
+            self.solver = solver = ParticleManager.from_object(obj)
+            solver.max_glyphs = params.preview_particles
+            solver.preview_mode = params.preview_refresh
+            solver.preview_steps = params.preview_steps
+            solver.preview_interval = params.preview_interval / 1000
+            solver.convergence = params.convergence
+            self.strokes = solver.gp_strokes(context)
+            self.bm.verts.ensure_lookup_table()
+
+            if params.triangle_mode:
+                solver.triangle_mode = True
+            self.bm.to_mesh(obj.data)
+
+        if params.particle_placement == "INTEGER_LATTICE":
+            self.placement_co = vertex_arrays(self.bm.verts)[0]
+        elif params.particle_placement == "ANOTHER_MESH":
+            for other in context.selected_objects:
+                if other is not obj:
+                    break
+            self.placement_co = vertex_arrays(other.data.vertices)[0]
+        self.remesher = Remesher(solver, params, self.profile)
+
+    def solve(self):
+        """Field, placement and relaxation, up to the extraction triangles. No Blender data is used.
+
+        Building the field and the extraction triangles don't yield until done but
+        stop at a background.check_cancelled() between their chunks, placement and
+        relaxation yield at least once per step_budget.
+        """
+        params = self.params
+        solver = self.solver
+        remesher = self.remesher
+
+        with self.timed("build_field"):
+            cache = FieldCache(max_bytes=params.field_cache_size * 1024 * 1024) if params.field_cache else None
+            solver.build_field(self.strokes, params.x_mirror, cache, params.field_mode, params.field_iterations)
+        yield ["Placing particles.."]
+
+        resolution = remesher.coarse_resolution
+        if params.particle_placement == "FAST_MARCHING":
+            with self.timed("placement"):
+                new_particles = False
+                if params.use_gp:
+                    new_particles = solver.initialize_particles_from_gp(resolution, params.adaptive, self.strokes)
+                    if params.x_mirror:
+                        solver.mirror_particles(any_side=True)
+                if not new_particles:
+                    solver.initialize_from_features(None, resolution, params.adaptive, params.seeds)
+            yield from remesher.spread()
+
+        elif params.particle_placement == "INTEGER_LATTICE":
+            yield ["Creating particles.."]
+            with self.timed("placement"):
+                solver.initialize_grid(self.placement_co, resolution, params.x_mirror, params.adaptive)
+
+        elif params.particle_placement == "ANOTHER_MESH":
+            with self.timed("placement"):
+                solver.initialize_from_verts(self.placement_co, params.adaptive)
+                if params.x_mirror:
+                    solver.mirror_particles()
+
+        yield from remesher.relax_levels()
+        yield ["Extracting Mesh."]
+        if params.extraction == "DELAUNAY":
+            with self.timed("extraction"):
+                self.triangles = solver.delaunay_triangles()
+        yield ["Extracting Mesh."]
+
+    def restore(self):
+        """Puts the source mesh back into obj, for runs stopped before solve() or abandoned in it."""
+        if self.solver:
+            self.solver.stop_parallel()
+        self.stop_snapping()
+        if self.bm:
+            self.bm.to_mesh(self.obj.data)
+
+    def finish(self):
+        """Builds the final mesh from the particles into obj, can be called after any stage."""
+        params = self.params
+        solver = self.solver
+        solver.stop_parallel()
+
+        with self.timed("extraction"):
+            bm = solver.simplify_mesh(self.bm, params.extraction, self.triangles)
+            bm.verts.layers.int.remove(bm.verts.layers.int["particle"])
+
+        for i in range(5):
+            with self.timed("smoothing"):
+                bmesh.ops.smooth_vert(bm, verts=bm.verts, use_axis_x=True, use_axis_y=True, use_axis_z=True, factor=0.5)
+            self.snap(bm.verts)
+
+        bm.to_mesh(self.obj.data)
+        new_obj = self.obj
+
+        for _ in range(params.subdivisions):
+            if not params.triangle_mode:
+                with self.timed("subdivision"):
+                    if params.allow_triangles:
+                        triangle_quad_subdivide(new_obj)
+                    else:
+                        md = new_obj.modifiers.new(type="SUBSURF", name="SUBSURF")
+                        md.levels = 1
+                        # md.subdivision_type = "SIMPLE"
+                        bpy.ops.object.modifier_apply(modifier=md.name)
+                self.snap(new_obj.data.vertices)
+            else:
+                with self.timed("subdivision"):
+                    bmesh.ops.subdivide_edges(bm, edges=bm.edges, cuts=1, use_grid_fill=True)
+                self.snap(bm.verts)
+                # bmesh.ops.smooth_vert(bm, verts=bm.verts, use_axis_x=True, use_axis_y=True, use_axis_z=True, factor=1)
+
+        if params.triangle_mode:
+            self.snap(bm.verts)
+            bm.to_mesh(new_obj.data)
+        else:
+            self.snap(new_obj.data.vertices)
+        self.stop_snapping()
+        self.profile.deactivate()
+        return new_obj
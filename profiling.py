@@ -0,0 +1,97 @@
+'''
+Copyright (C) 2018 Jean Da Costa machado.
+Jean3dimensional@gmail.com
+
+Created by Jean Da Costa machado
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import json
+from contextlib import contextmanager
+from time import perf_counter
+
+# the profiler hot paths report to, None when nothing is being profiled
+active = None
+
+counter_labels = (
+    ("bvh_queries", "BVH queries"),
+    ("hit_infos", "HitInfos"),
+    ("neighbor_queries", "Neighbor queries"),
+    ("field_iterations", "Field solver iterations"),
+)
+
+
+def count(name, n=1):
+    """Adds n to a counter of the active profiler, if any."""
+    if active is not None:
+        active.counters[name] = active.counters.get(name, 0) + n
+
+
+class Profiler:
+    """Wall time per stage and per step, hot path counters and particle count over time.
+
+    Stages are timed with timed(), solver steps are recorded with record_step()
+    and counters are incremented through the module level count() while the
+    profiler is activated. Work done in other processes isn't counted.
+    """
+
+    def __init__(self):
+        self.start = perf_counter()
+        self.timings = {}
+        self.counters = {}
+        self.steps = []
+
+    def activate(self):
+        global active
+        active = self
+
+    def deactivate(self):
+        global active
+        if active is self:
+            active = None
+
+    @contextmanager
+    def timed(self, stage):
+        start = perf_counter()
+        yield
+        self.timings[stage] = self.timings.get(stage, 0.0) + perf_counter() - start
+
+    def record_step(self, stage, seconds, particles):
+        self.steps.append((stage, perf_counter() - self.start, seconds, particles))
+
+    def feedback(self):
+        """Short report lines for the panel."""
+        lines = []
+        if self.steps:
+            stage, at, seconds, particles = self.steps[-1]
+            lines.append("%d particles, %.0f ms/step" % (particles, seconds * 1000))
+        for stage, seconds in sorted(self.timings.items(), key=lambda item: -item[1])[:4]:
+            lines.append("%s: %.2fs" % (stage, seconds))
+        for name, label in counter_labels:
+            if name in self.counters:
+                lines.append("%s: %d" % (label, self.counters[name]))
+        return lines
+
+    def to_dict(self):
+        return {
+            "total": perf_counter() - self.start,
+            "timings": self.timings,
+            "counters": self.counters,
+            "steps": [{"stage": stage, "at": at, "time": seconds, "particles": particles}
+                      for stage, at, seconds, particles in self.steps],
+        }
+
+    def save(self, path):
+        with open(path, "w") as file:
+            json.dump(self.to_dict(), file, indent=2)
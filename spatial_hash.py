@@ -0,0 +1,265 @@
+'''
+Copyright (C) 2018 Jean Da Costa machado.
+Jean3dimensional@gmail.com
+
+Created by Jean Da Costa machado
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import numpy as np
+
+from . import profiling
+
+_OFFSET = 1 << 20
+
+
+def _pack(cells):
+    cells = cells + _OFFSET
+    return (cells[..., 0] << 42) | (cells[..., 1] << 21) | cells[..., 2]
+
+
+def _block(reach):
+    r = np.arange(-reach, reach + 1)
+    return np.stack(np.meshgrid(r, r, r, indexing="ij"), axis=-1).reshape(-1, 3)
+
+
+class SpatialHash:
+    """Uniform grid over a point set, kept as item ids sorted by packed cell key.
+
+    Moving, adding or removing items only re-buckets the items involved, so keeping
+    the index in sync with the particles costs a key computation per step instead
+    of a full rebuild.
+    """
+
+    chunk_size = 1 << 21
+
+    def __init__(self, cell_size, points=None):
+        self.cell_size = float(cell_size)
+        self.co = np.empty((0, 3))
+        self.keys = np.empty(0, dtype=np.int64)
+        self.order = np.empty(0, dtype=np.int64)
+        self.sorted_keys = np.empty(0, dtype=np.int64)
+        self.cell_min = np.zeros(3, dtype=np.int64)
+        self.cell_max = np.zeros(3, dtype=np.int64)
+        if points is not None:
+            self.insert(points)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def cells(self, points):
+        return np.floor(np.asarray(points, dtype=np.float64) / self.cell_size).astype(np.int64)
+
+    def _update_bounds(self, points=None):
+        """Recomputes the occupied cell range, or only grows it to cover points."""
+        if points is None:
+            points = self.co
+            if len(points):
+                cells = self.cells(points)
+                self.cell_min = cells.min(axis=0)
+                self.cell_max = cells.max(axis=0)
+        elif len(points):
+            cells = self.cells(points)
+            self.cell_min = np.minimum(self.cell_min, cells.min(axis=0))
+            self.cell_max = np.maximum(self.cell_max, cells.max(axis=0))
+
+    def _bucket(self, ids, keys):
+        sort = np.argsort(keys, kind="mergesort")
+        ids = ids[sort]
+        keys = keys[sort]
+        position = np.searchsorted(self.sorted_keys, keys)
+        self.order = np.insert(self.order, position, ids)
+        self.sorted_keys = np.insert(self.sorted_keys, position, keys)
+
+    def _unbucket(self, mask):
+        stay = ~mask[self.order]
+        self.order = self.order[stay]
+        self.sorted_keys = self.sorted_keys[stay]
+
+    def insert(self, points):
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        start = len(self.keys)
+        keys = _pack(self.cells(points))
+        if not start:
+            self.cell_min, self.cell_max = self.cells(points[:1])[0], self.cells(points[:1])[0]
+        self.co = np.concatenate((self.co, points))
+        self.keys = np.concatenate((self.keys, keys))
+        self._bucket(np.arange(start, start + len(keys)), keys)
+        self._update_bounds(points)
+        return start
+
+    def move(self, ids, points):
+        """Updates the location of some items, only those changing cell are re-bucketed."""
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        keys = _pack(self.cells(points))
+        self.co[ids] = points
+        changed = keys != self.keys[ids]
+        if changed.any():
+            mask = np.zeros(len(self.keys), dtype=np.bool_)
+            mask[ids[changed]] = True
+            self._unbucket(mask)
+            self.keys[ids[changed]] = keys[changed]
+            self._bucket(ids[changed], keys[changed])
+        self._update_bounds(points)
+
+    def update(self, points):
+        points = np.array(points, dtype=np.float64).reshape(-1, 3)
+        keys = _pack(self.cells(points))
+        moved = keys != self.keys
+        self.co = points
+        if moved.any():
+            if np.count_nonzero(moved) > len(keys) // 4:
+                self.keys = keys
+                self.order = np.argsort(keys, kind="mergesort")
+                self.sorted_keys = keys[self.order]
+            else:
+                self._unbucket(moved)
+                self.keys[moved] = keys[moved]
+                self._bucket(np.flatnonzero(moved), keys[moved])
+        self._update_bounds()
+        return int(np.count_nonzero(moved))
+
+    def keep(self, mask):
+        mask = np.asarray(mask, dtype=np.bool_)
+        remap = np.cumsum(mask) - 1
+        self._unbucket(~mask)
+        self.order = remap[self.order]
+        self.co = self.co[mask]
+        self.keys = self.keys[mask]
+        self._update_bounds()
+
+    def find_n(self, co, n):
+        indices, distances = self.find_n_array(np.asarray(co, dtype=np.float64).reshape(1, 3), n)
+        valid = indices[0] >= 0
+        return list(zip(indices[0][valid].tolist(), distances[0][valid].tolist()))
+
+    def find_n_array(self, points, n):
+        """The n nearest items of each point, as (N, n) ids padded with -1 and their distances."""
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        profiling.count("neighbor_queries", len(points))
+        indices = np.full((len(points), n), -1, dtype=np.int64)
+        distances = np.full((len(points), n), np.inf)
+        if not len(self.keys) or not len(points):
+            return indices, distances
+
+        pending = np.arange(len(points))
+        extent = int((self.cell_max - self.cell_min).max()) + 1
+        bucket = self._bucket_size()
+        reach = 1
+        while len(pending):
+            if reach > extent:
+                offsets = None
+                width = len(self.keys)
+            else:
+                offsets = _block(reach)
+                width = len(offsets) * bucket
+            step = max(1, self.chunk_size // width)
+            unresolved = []
+            for start in range(0, len(pending), step):
+                rows = pending[start:start + step]
+                found, dist, exact = self._query(points[rows], n, offsets, reach, bucket)
+                indices[rows] = found
+                distances[rows] = dist
+                unresolved.append(rows[~exact])
+            pending = np.concatenate(unresolved)
+            reach *= 2
+        return indices, distances
+
+    def find_within_array(self, points, radius):
+        """Every item closer than radius to each point, as (point rows, item ids, distances).
+
+        radius is one value or one per point. Only the cells the largest radius
+        reaches are searched, so the cost doesn't grow for points with few items
+        around them like it does for find_n_array.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        radius = np.broadcast_to(np.asarray(radius, dtype=np.float64), (len(points),))
+        profiling.count("neighbor_queries", len(points))
+        rows = [np.empty(0, dtype=np.int64)]
+        ids = [np.empty(0, dtype=np.int64)]
+        distances = [np.empty(0)]
+        if not len(self.keys) or not len(points):
+            return rows[0], ids[0], distances[0]
+
+        offsets = _block(max(1, int(np.ceil(radius.max() / self.cell_size))))
+        bucket = self._bucket_size()
+        step = max(1, self.chunk_size // (len(offsets) * bucket))
+        for start in range(0, len(points), step):
+            chunk = slice(start, start + step)
+            candidates, valid = self._candidates(points[chunk], offsets, bucket)
+            d = self.co[candidates] - points[chunk, None, :]
+            dist = np.sqrt((d * d).sum(axis=2))
+            row, column = np.nonzero(valid & (dist < radius[chunk, None]))
+            rows.append(row + start)
+            ids.append(candidates[row, column])
+            distances.append(dist[row, column])
+        return np.concatenate(rows), np.concatenate(ids), np.concatenate(distances)
+
+    def _bucket_size(self):
+        """Most items any cell holds."""
+        boundaries = np.flatnonzero(self.sorted_keys[1:] != self.sorted_keys[:-1]) + 1
+        return int(np.diff(np.concatenate(([0], boundaries, [len(self.sorted_keys)]))).max())
+
+    def _candidates(self, points, offsets, bucket):
+        """Items in the cells at offsets around each point, as (N, M) ids and a validity mask.
+
+        Every cell gets bucket slots, so a point's candidates sit in the same columns
+        whatever other points it's queried with and ties resolve the same way.
+        """
+        keys = _pack(self.cells(points)[:, None, :] + offsets[None, :, :])
+        starts = np.searchsorted(self.sorted_keys, keys, side="left")
+        counts = np.searchsorted(self.sorted_keys, keys, side="right") - starts
+        slots = np.arange(bucket)
+        slot_index = starts[:, :, None] + slots
+        valid = (slots < counts[:, :, None]).reshape(len(points), -1)
+        slot_index = np.minimum(slot_index, len(self.order) - 1).reshape(len(points), -1)
+        return self.order[slot_index], valid
+
+    def _query(self, points, n, offsets, reach, bucket):
+        if offsets is None:
+            # the block covers every item, compare against all of them
+            candidates = np.broadcast_to(np.arange(len(self.keys)), (len(points), len(self.keys)))
+            valid = np.ones(candidates.shape, dtype=np.bool_)
+        else:
+            candidates, valid = self._candidates(points, offsets, bucket)
+
+        d = self.co[candidates] - points[:, None, :]
+        dist = np.sqrt((d * d).sum(axis=2))
+        dist[~valid] = np.inf
+
+        k = min(n, dist.shape[1])
+        if k < dist.shape[1]:
+            nearest = np.argpartition(dist, k - 1, axis=1)[:, :k]
+        else:
+            nearest = np.broadcast_to(np.arange(k), (len(points), k))
+        rows = np.arange(len(points))[:, None]
+        nearest_dist = dist[rows, nearest]
+        sort = np.argsort(nearest_dist, axis=1)
+        nearest = nearest[rows, sort]
+        nearest_dist = nearest_dist[rows, sort]
+
+        found = np.full((len(points), n), -1, dtype=np.int64)
+        found_dist = np.full((len(points), n), np.inf)
+        hit = np.isfinite(nearest_dist)
+        found[:, :k] = np.where(hit, candidates[rows, nearest], -1)
+        found_dist[:, :k] = nearest_dist
+
+        if offsets is None:
+            exact = np.ones(len(points), dtype=np.bool_)
+        else:
+            # anything outside the searched block is at least reach cells away
+            enough = hit.sum(axis=1) >= min(n, len(self.keys))
+            exact = enough & (found_dist[:, min(n, len(self.keys)) - 1] <= reach * self.cell_size)
+        return found, found_dist, exact
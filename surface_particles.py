@@ -17,17 +17,31 @@ Created by Jean Da Costa machado
     You should have received a copy of the GNU General Public License
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
-import bmesh
+from collections import deque
+
+import numpy as np
 from . import vector_fields
 from . import draw_3d
-from mathutils import Vector
-from mathutils.kdtree import KDTree
-from random import choice, random
+from . import field_cache
+from . import mesh_extraction
+from .particle_arrays import ParticleArrays, quad_forces, relaxation_targets, TAG_NONE, TAG_DONE, TAG_REMOVE
+from .parallel_relax import ParallelRelaxation
+from .background import check_cancelled
+from .mesh_arrays import MeshArrays, face_edges
+from .spatial_hash import SpatialHash
+from time import perf_counter
+
+try:
+    import bmesh
+    from mathutils import Vector
+except ImportError:
+    # outside Blender only the array based parts work, see core.remesh
+    bmesh = Vector = None
 
 
 def get_gp_frame(context):
     frame = None
-    gp = context.scene.grease_pencil
+    gp = context.scene.grease_pencil if context else None
     if gp:
         if gp.layers:
             if gp.layers.active:
@@ -37,25 +51,85 @@ def get_gp_frame(context):
 
 
 class ParticleManager:
-    def __init__(self, obj):
-        self.particles = []
-        self.obj = obj
-        self.field = vector_fields.FrameField(obj)
+    """Particles relaxing over the surface of a FrameField.
+
+    matrix is the 4x4 object to world transform, only used to draw the preview.
+    Sizes are relative to the largest extent of the field mesh.
+    """
+
+    # smallest chunk of particles a budgeted step works on
+    min_chunk = 64
+    # steps over which the net movement is measured for convergence
+    convergence_window = 4
 
-        self.inv_mat = obj.matrix_world.inverted()
+    def __init__(self, field, matrix=None):
+        self.particles = ParticleArrays()
+        self.field = field
+        self.matrix = np.identity(4) if matrix is None else np.array(matrix)
+        co = field.mesh.co
+        self.size = float((co.max(axis=0) - co.min(axis=0)).max()) if len(co) else 1.0
+
+        self.inv_mat = None
 
         self.bm = self.field.bm
-        self.kd_tree = KDTree(0)
-        self.kd_tree.balance()
+        self.index = SpatialHash(1.0)
         self.draw_obj = draw_3d.DrawObject()
+        self.parallel = None
+        self.front = None
+        self.active = None
+        self.convergence = 0.0
+        self.relaxing = None
+        self.spreading = None
+        self.chunk_rates = {}
+        self.chunk_sizes = {}
+        self.anchor = None
+        self.anchor_steps = 0
 
         self.triangle_mode = False
+        self.max_glyphs = 20000
+        self.preview_mode = "STEPS"
+        self.preview_steps = 1
+        self.preview_interval = 0.2
+        self.pending_steps = 0
+        self.last_preview = 0.0
+
+    @classmethod
+    def from_object(cls, obj):
+        manager = cls(vector_fields.FrameField.from_object(obj), obj.matrix_world)
+        manager.inv_mat = obj.matrix_world.inverted()
+        return manager
+
+    def gp_strokes(self, context):
+        """Points of the active grease pencil strokes in object space, a list of Vectors per stroke.
+
+        Read them on the main thread, build_field and initialize_particles_from_gp
+        take this copy so they don't touch Blender data.
+        """
+        frame = get_gp_frame(context)
+        if not frame:
+            return []
+        return [[self.inv_mat * point.co for point in stroke.points] for stroke in frame.strokes]
+
+    def build_field(self, strokes, x_mirror, cache=None, mode="GROW", iterations=200):
+        if cache:
+            key = field_cache.cache_key(self.field.mesh.co, self.field.mesh.faces, strokes, x_mirror, mode,
+                                        iterations if mode == "SOLVE" else 0)
+            arrays = cache.load(key)
+            if arrays is not None:
+                self.field.from_arrays(arrays)
+                return
 
-    def build_field(self, context, use_gp, x_mirror):
         self.field.build_major_curvatures()
-        frame = get_gp_frame(context)
-        if frame:
-            self.field.from_grease_pencil(frame, mat=self.inv_mat, x_mirror=x_mirror)
+        check_cancelled()
+        if mode == "SOLVE":
+            if strokes:
+                # strokes outweigh any curvature direction they cross
+                self.field.from_grease_pencil(strokes, x_mirror=x_mirror, replace=False,
+                                              strength=3 * max(self.field.field_strength.max(), 1e-3))
+            self.field.solve(max_iterations=iterations)
+
+        elif strokes:
+            self.field.from_grease_pencil(strokes, x_mirror=x_mirror)
             self.field.marching_growth()
             self.field.smooth(2)
 
@@ -64,174 +138,571 @@ class ParticleManager:
             self.field.marching_growth()
             self.field.smooth()
 
-    def build_kdtree(self):
-        tree = KDTree(len(self.particles))
-        for id, p in enumerate(self.particles):
-            tree.insert(p.location, id)
-        tree.balance()
-        self.kd_tree = tree
+        if cache:
+            cache.save(key, self.field.to_arrays())
 
-    def initialize_particles_from_gp(self, resolution, adaptive, context):
-        scale = max(self.obj.dimensions) / max(self.obj.scale)
-        target_resolution = scale / resolution
-        frame = get_gp_frame(context)
+    def update_index(self):
+        particles = self.particles
+        if not len(particles):
+            return
+        # cells about two particle spacings wide hold the 9 nearest neighbors
+        cell_size = 4 * particles.radius.mean()
+        if not 0.5 < self.index.cell_size / cell_size < 2:
+            self.index = SpatialHash(cell_size, particles.co)
+            # queries cost differently over the new cells
+            self.chunk_rates.clear()
+            self.chunk_sizes.clear()
+            return
+        if len(particles) > len(self.index):
+            self.index.insert(particles.co[len(self.index):])
+        self.index.update(particles.co)
+
+    def keep_particles(self, mask):
+        if len(self.particles) > len(self.index):
+            self.index.insert(self.particles.co[len(self.index):])
+        self.index.keep(mask)
+        remap = self.particles.keep(mask)
+        # an unfinished step can't be resumed on other rows
+        self.relaxing = None
+        self.spreading = None
+        self.anchor = None
+        if self.active is not None:
+            self.active = self.active[mask]
+        if self.front is not None:
+            front = remap[self.front]
+            self.front = front[front >= 0]
+        return remap
+
+    def set_resolution(self, index, target_resolution, adaptive):
+        particles = self.particles
+        particles.target_resolution[index] = target_resolution
+        particles.radius[index] = target_resolution / (particles.curvature[index] * adaptive + (1 - adaptive))
+        particles.adaptive[index] = adaptive
+
+    def initialize_particles_from_gp(self, resolution, adaptive, strokes):
+        target_resolution = self.size / resolution
         created_particles = 0
-        if not frame:
-            return created_particles
-        for stroke in frame.strokes:
-            co = self.inv_mat * stroke.points[0].co
-            last_particle = self.create_particle(Partile, co)
-            last_particle.target_resolution = target_resolution
-            last_particle.radius = target_resolution / (last_particle.last_hit.curvature * adaptive + (1 - adaptive))
-            last_particle.adaptive = adaptive
+        particles = self.particles
+        for stroke in strokes:
+            last_particle = self.create_particle(stroke[0])
+            self.set_resolution(last_particle, target_resolution, adaptive)
             created_particles += 1
-            for point in stroke.points:
-                co = self.inv_mat * point.co
-                if (co - last_particle.location).length >= last_particle.radius * 2:
-                    last_particle = self.create_particle(Partile, co)
-                    last_particle.target_resolution = target_resolution
-                    last_particle.radius = target_resolution / (
-                            last_particle.last_hit.curvature * adaptive + (1 - adaptive))
-                    last_particle.adaptive = adaptive
+            for co in stroke:
+                if (co - Vector(particles.co[last_particle])).length >= particles.radius[last_particle] * 2:
+                    last_particle = self.create_particle(co)
+                    self.set_resolution(last_particle, target_resolution, adaptive)
                     created_particles += 1
         return created_particles
 
     def initialize_from_features(self, verts, resolution=20, adaptive=0, count=50):
-        scale = max(self.obj.dimensions) / max(self.obj.scale)
-        target_resolution = scale / resolution
-        verts = sorted(self.field.bm.verts, key=lambda v: self.field.sharpness_field.get(v.index, float("inf")),
-                       reverse=True)
-        for i in range(min(count, len(self.field.bm.verts))):
-            vert = verts[i]
-            co = vert.co.copy()
-            p1 = self.create_particle(Partile, co)
-            p1.radius = target_resolution
-            p1.target_resolution = target_resolution
-            p1.adaptive = adaptive
+        target_resolution = self.size / resolution
+        field = self.field
+        sharpness = np.where(field.curvature_valid, field.sharpness, np.inf)
+        verts = np.argsort(-sharpness, kind="mergesort")[:count]
+        particles = self.particles
+        rows = self.create_particles(field.mesh.co[verts])
+        particles.radius[rows] = target_resolution
+        particles.target_resolution[rows] = target_resolution
+        particles.adaptive[rows] = adaptive
 
     def initialize_from_verts(self, verts, adaptive):
-        for vert in verts:
-            p = self.create_particle(Partile, vert.co)
-            p.adaptive = adaptive
+        co = verts if isinstance(verts, np.ndarray) else [vert.co for vert in verts]
+        rows = self.create_particles(co)
+        self.particles.adaptive[rows] = adaptive
 
     def initialize_grid(self, verts, resolution=20, use_x_mirror=True, adaptive=0):
-        particle_locations = set()
-        scale = max(self.obj.dimensions)
+        scale = self.size
         target_resolution = 1 / ((1 / scale) * resolution)
-        for vert in verts:
-            co = vert.co.copy()
-            co /= scale
-            co *= resolution
-            x = int(co.x)
-            y = int(co.y)
-            z = int(co.z)
-            if use_x_mirror:
-                if x > 0:
-                    particle_locations.add((x, y, z))
-            else:
-                particle_locations.add((x, y, z))
-
-        for location in particle_locations:
-            co = Vector(location)
-            co *= scale
-            co /= resolution
-            hit = self.sample_surface(co)
-            p1 = self.create_particle(Partile, hit.co)
-            p1.adaptive = adaptive
-            p1.target_resolution = target_resolution
-            if use_x_mirror:
-                hit.co.x *= -1
-                p2 = self.create_particle(Partile, hit.co)
-                p2.adaptive = adaptive
-                p2.target_resolution = target_resolution
-                p1.counter_pair, p2.counter_pair = p2, p1
+        co = verts if isinstance(verts, np.ndarray) else [vert.co for vert in verts]
+        co = np.array(co, dtype=np.float64).reshape(-1, 3)
+        cells = np.trunc(co / scale * resolution).astype(np.int64)
+        if use_x_mirror:
+            cells = cells[cells[:, 0] > 0]
+        particle_locations = np.array(sorted(set(map(tuple, cells.tolist()))), dtype=np.float64).reshape(-1, 3)
+
+        particles = self.particles
+        hits = self.sample_surface_array(particle_locations * scale / resolution)
+        p1 = self.add_hits(hits)
+        particles.adaptive[p1] = adaptive
+        particles.target_resolution[p1] = target_resolution
+        if use_x_mirror:
+            p2 = self.create_particles(hits.co * (-1, 1, 1))
+            particles.adaptive[p2] = adaptive
+            particles.target_resolution[p2] = target_resolution
+            particles.counter_pair[p1] = p2
+            particles.counter_pair[p2] = p1
 
     def mirror_particles(self, any_side=False):
-        new_particles = []
-        for particle in self.particles:
-            if particle.location.x > particle.radius or any_side:
-                co = particle.location.copy()
-                co.x *= -1
-                p1 = particle
-                p2 = Partile(co, self)
-                p2.radius = p1.radius
-                p2.tag = p1.tag
-                p2.adaptive = p1.adaptive
-                p2.target_resolution = p1.target_resolution
-                p1.counter_pair, p2.counter_pair = p2, p1
-                new_particles.append(p2)
-                new_particles.append(p1)
-
-            elif -particle.radius * 0.5 < particle.location.x < particle.radius * 0.5:
-                new_particles.append(particle)
-                particle.lock_x = True
-
-        self.particles = new_particles
-        self.build_kdtree()
-
-    def create_particle(self, type, location, prepend=False):
-        p = type(location, self)
-        if not prepend:
-            self.particles.append(p)
+        particles = self.particles
+        x = particles.co[:, 0]
+        radius = particles.radius
+        if any_side:
+            side = np.ones(len(particles), dtype=np.bool_)
         else:
-            self.particles.insert(0, p)
-        return p
+            side = x > radius
+        center = ~side & (-radius * 0.5 < x) & (x < radius * 0.5)
+        particles.lock_x[center] = True
+
+        remap = self.keep_particles(side | center)
+        p1 = remap[side]
+        p2 = self.create_particles(particles.co[p1] * (-1, 1, 1))
+        for name in ("radius", "tag", "adaptive", "target_resolution"):
+            getattr(particles, name)[p2] = getattr(particles, name)[p1]
+        particles.counter_pair[p1] = p2
+        particles.counter_pair[p2] = p1
+
+        self.update_index()
+
+    def refine(self):
+        """Splits every particle in four along its diagonal frame directions, at half its resolution.
+
+        The children are laid on a square grid twice as dense as the one the parents
+        relaxed into. Mirror pairs are dropped, mirror_particles has to run again.
+        Returns the new particle count.
+        """
+        parents = self.particles
+        count = len(parents)
+        u = parents.frame_u
+        v = parents.frame_v
+        offsets = np.stack((u + v, u - v, v - u, -u - v), axis=1) * (parents.radius / 2)[:, None, None]
+        hits = self.sample_surface_array((parents.co[:, None, :] + offsets).reshape(-1, 3))
+        rows = np.repeat(np.arange(count), 4)[hits.valid]
+
+        self.particles = particles = ParticleArrays(len(rows))
+        new = self.add_hits(hits, hits.valid)
+        adaptive = parents.adaptive[rows]
+        particles.adaptive[new] = adaptive
+        particles.target_resolution[new] = parents.target_resolution[rows] / 2
+        particles.radius[new] = particles.target_resolution[new] / (adaptive * hits.curvature[hits.valid] + (1 - adaptive))
+
+        self.index = SpatialHash(1.0)
+        self.front = None
+        self.active = None
+        self.anchor = None
+        self.relaxing = None
+        self.spreading = None
+        self.update_index()
+        return len(particles)
+
+    def create_particle(self, location):
+        hit = self.sample_surface(location)
+        index = self.particles.add()
+        self.particles.set_hit(index, hit)
+        return index
+
+    def create_particles(self, locations):
+        return self.add_hits(self.sample_surface_array(locations))
+
+    def add_hits(self, hits, rows=slice(None)):
+        count = len(np.arange(len(hits))[rows])
+        start = self.particles.add(count)
+        indices = np.arange(start, start + count)
+        self.particles.set_hits(indices, hits, rows)
+        return indices
+
+    def remove_particles(self, indices):
+        keep = np.ones(len(self.particles), dtype=np.bool_)
+        keep[indices] = False
+        return self.keep_particles(keep)
+
+    def budget_chunks(self, kind, done, count, budget):
+        """(begin, end) row ranges from done to count, until budget seconds have passed.
+
+        Chunks are sized to fit the remaining budget from the rows per second the
+        previous chunks of the same kind ran at, growing at most twofold from one
+        chunk to the next in case the rows got slower. The first chunk always runs,
+        later ones only when min_chunk rows still fit. Without a budget it's a
+        single range.
+        """
+        if budget is None:
+            if done < count:
+                yield done, count
+            return
+        start = perf_counter()
+        first = True
+        while done < count:
+            left = budget - (perf_counter() - start)
+            size = int(self.chunk_rates.get(kind, 0) * left)
+            if not first and size < self.min_chunk:
+                return
+            first = False
+            size = max(self.min_chunk, min(size, 2 * self.chunk_sizes.get(kind, self.min_chunk)))
+            end = min(count, done + size)
+            chunk_start = perf_counter()
+            yield done, end
+            self.chunk_rates[kind] = (end - done) / max(perf_counter() - chunk_start, 1e-6)
+            self.chunk_sizes[kind] = end - done
+            done = end
+
+    def step(self, speed, batched=False, budget=None):
+        """Relaxes the particles once, returns how many are still moving.
+
+        With a budget in seconds the batched step works through the particles in
+        chunks and returns None once the budget is spent, the next call resumes it.
+        The parallel and the per particle steps always run whole.
+        """
+        active = len(self.particles)
+        if self.parallel:
+            self.parallel.step(speed)
+        elif batched:
+            active = self.step_batched(speed, budget)
+            if active is None:
+                return None
+        else:
+            for index in range(len(self.particles)):
+                self.step_particle(index, speed)
+        self.update_index()
+        return active
+
+    def step_batched(self, speed, budget=None):
+        """Relaxes the active particles, all of them unless convergence is set.
+
+        With convergence, particles are frozen and woken again by update_convergence.
+        Targets come from where the particles were when the step started, a step
+        split over several budgeted calls moves them the same as a whole one.
+        Returns None while the step is unfinished.
+        """
+        particles = self.particles
+        if not len(particles):
+            return 0
+
+        if self.relaxing is None:
+            if not self.convergence or self.active is None or len(self.active) != len(particles):
+                self.active = np.ones(len(particles), dtype=np.bool_)
+            rows = np.flatnonzero(self.active)
+            if not len(rows):
+                return 0
+            self.relaxing = [particles.copy(), rows, 0]
+
+        before, rows, done = self.relaxing
+        for begin, end in self.budget_chunks("relaxation", done, len(rows), budget):
+            self.relax_rows(before, rows[begin:end], speed)
+            self.relaxing[2] = end
+        if self.relaxing[2] < len(rows):
+            return None
+        self.relaxing = None
+        self.apply_symmetry()
+
+        if self.convergence:
+            self.update_convergence(speed)
+        return int(np.count_nonzero(self.active))
+
+    def update_convergence(self, speed):
+        """Every convergence_window steps, freezes the particles that settled.
+
+        A step moves every particle by speed times its radius, also when it only
+        jitters around its rest position, so settling is judged on the net movement
+        over the window. Particles that got less than convergence times the distance
+        of window straight steps away from where the window started are frozen,
+        unless one of their neighbors got farther.
+        """
+        particles = self.particles
+        if self.anchor is None or len(self.anchor) != len(particles):
+            self.anchor = particles.co.copy()
+            self.anchor_steps = 0
+            return
+        self.anchor_steps += 1
+        if self.anchor_steps < self.convergence_window:
+            return
 
-    def remove_particle(self, particle):
-        self.particles.remove(particle)
-
-    def step(self, speed, ):
-        new_tree = KDTree(len(self.particles))
-        self.draw_obj.commands.clear()
-        for id, particle in enumerate(self.particles):
-            particle.step(speed)
-            particle.draw()
-            new_tree.insert(particle.location, id)
-        new_tree.balance()
-        self.kd_tree = new_tree
-
-    def spread_step(self):
-        count = 0
-        new_particles = []
-        self.draw_obj.commands.clear()
-
-        for particle in self.particles:
-            new_particles += particle.spread()
-            count += len(new_particles)
-
-        for particle in self.particles:
-            if not particle.tag == "REMOVE":
-                new_particles.append(particle)
-        self.particles = new_particles
-
-        new_tree = KDTree(len(self.particles))
-        for id, particle in enumerate(self.particles):
-            particle.draw()
-            new_tree.insert(particle.location, id)
-        new_tree.balance()
-        self.kd_tree = new_tree
-
-        return count
+        net = np.sqrt(((particles.co - self.anchor) ** 2).sum(axis=1))
+        moved = np.flatnonzero(net > self.convergence * self.convergence_window * speed * particles.radius)
+        self.update_index()
+        neighbors = self.nearest_array(particles.co[moved], 9)[0]
+        self.active[:] = False
+        self.active[moved] = True
+        self.active[neighbors[neighbors >= 0]] = True
+        self.anchor = particles.co.copy()
+        self.anchor_steps = 0
+
+    def relax_rows(self, before, rows, speed):
+        """Moves rows by the forces between the particles as they were in before."""
+        particles = self.particles
+        neighbors, distances = self.nearest_array(before.co[rows], 9)
+        moving, radius, targets = relaxation_targets(before, rows, neighbors, distances, speed,
+                                                     self.triangle_mode)
+        moving_rows = rows[moving]
+        particles.radius[moving_rows] = radius[moving]
+        hits = self.sample_surface_array(targets[moving])
+        particles.set_hits(moving_rows[hits.valid], hits, hits.valid)
+
+    def apply_symmetry(self):
+        particles = self.particles
+        rows = np.arange(len(particles))
+        # each mirror pair is driven by its lower index
+        counter_pair = particles.counter_pair
+        drivers = rows[counter_pair > rows]
+        particles.co[counter_pair[drivers]] = particles.co[drivers] * (-1, 1, 1)
+        particles.co[particles.lock_x & (counter_pair < 0), 0] = 0
+
+    def start_parallel(self, workers):
+        self.stop_parallel()
+        self.parallel = ParallelRelaxation(self, workers)
+
+    def stop_parallel(self):
+        if self.parallel:
+            self.parallel.close()
+        self.parallel = None
+
+    def step_particle(self, index, speed):
+        particles = self.particles
+        neighbors = []
+        avg_dist = 0
+        for neighbor, dist in self.get_nearest(particles.co[index], 9):
+            avg_dist += dist
+            neighbors.append(neighbor)
+
+        if not neighbors:
+            return
+
+        movement = quad_forces(particles, np.array([index]), np.array([neighbors]), self.triangle_mode)[0]
+        radius = (avg_dist / len(neighbors)) / 2.1
+        particles.radius[index] = radius
+        length = np.sqrt(movement.dot(movement))
+        if length > 0:
+            movement = movement / length
+        # sampled as arrays so the per particle step runs without mathutils too
+        hits = self.sample_surface_array(particles.co[index] + movement * (radius * speed))
+        if hits.valid[0]:
+            particles.set_hits([index], hits)
+        counter_pair = particles.counter_pair[index]
+        if counter_pair >= 0:
+            particles.co[counter_pair] = particles.co[index]
+            particles.co[counter_pair, 0] *= -1
+        elif particles.lock_x[index]:
+            particles.co[index, 0] = 0
+
+    def spread_step(self, budget=None):
+        """Spreads the particles added by the previous step, returns how many were created.
+
+        With a budget in seconds the front is spread in chunks and None is returned
+        once the budget is spent, the next call resumes the step.
+        """
+        particles = self.particles
+        if self.front is None:
+            self.update_index()
+            self.front = np.flatnonzero(particles.tag == TAG_NONE)
+        if self.spreading is None:
+            self.spreading = [self.front[particles.tag[self.front] == TAG_NONE], 0, []]
+
+        front, done, created = self.spreading
+        for begin, end in self.budget_chunks("spreading", done, len(front), budget):
+            created.append(self.spread_rows(front[begin:end]))
+            self.spreading[1] = end
+        if self.spreading[1] < len(front):
+            return None
+        self.spreading = None
+
+        new = np.concatenate(created) if created else np.empty(0, dtype=np.int64)
+        self.front = new
+        removed = np.count_nonzero(particles.tag == TAG_REMOVE)
+        if removed and (not len(new) or removed * 4 > len(particles)):
+            self.keep_particles(particles.tag != TAG_REMOVE)
+
+        return len(new)
+
+    def spread_rows(self, front):
+        """Merges or spreads the given front particles, returns the new particles."""
+        particles = self.particles
+        # earlier chunks of the step may have merged some of them away
+        front = front[particles.tag[front] == TAG_NONE]
+        radius = particles.radius
+
+        # particles sitting on top of another one are merged into their nearest other one
+        rows, nearest, distances = self.index.find_within_array(particles.co[front],
+                                                                (radius[front] + radius.max()) / 2 * 1.5)
+        other = nearest != front[rows]
+        rows, nearest, distances = rows[other], nearest[other], distances[other]
+        order = np.lexsort((distances, rows))
+        rows, nearest, distances = rows[order], nearest[order], distances[order]
+        first = np.flatnonzero(np.concatenate(([True], rows[1:] != rows[:-1])))[:len(rows)]
+        merged = []
+        for row, p, dist in zip(rows[first].tolist(), nearest[first].tolist(), distances[first].tolist()):
+            index = front[row]
+            if particles.tag[p] == TAG_REMOVE:
+                continue
+            if dist < ((radius[index] + radius[p]) / 2) * 1.5:
+                particles.tag[index] = TAG_REMOVE
+                particles.co[p] += particles.co[index]
+                particles.co[p] /= 2
+                merged.append(p)
+        if merged:
+            self.index.move(merged, particles.co[merged])
+
+        # the rest try to place a new particle along each of their frame directions
+        spreading = front[particles.tag[front] == TAG_NONE]
+        new = np.empty(0, dtype=np.int64)
+        if len(spreading):
+            u = particles.frame_u[spreading]
+            v = particles.frame_v[spreading]
+            directions = np.stack((u, v, -u, -v), axis=1)
+            offsets = directions * (radius[spreading] * 2)[:, None, None]
+            hits = self.sample_surface_array((particles.co[spreading][:, None, :] + offsets).reshape(-1, 3))
+
+            threshold = np.repeat(radius[spreading], 4) * 1.5
+            valid = np.flatnonzero(hits.valid)
+            free = hits.valid.copy()
+            free[valid[self.index.find_within_array(hits.co[valid], threshold[valid])[0]]] = False
+            free = self.first_in_batch(hits.co, threshold, free)
+            free_rows = np.flatnonzero(free)
+            parents = spreading[free_rows // 4]
+
+            new = self.add_hits(hits, free_rows)
+            adaptive = particles.adaptive[parents]
+            target_resolution = particles.target_resolution[parents]
+            curv = adaptive * hits.curvature[free_rows] + (1 - adaptive)
+            particles.radius[new] = target_resolution / curv
+            particles.adaptive[new] = adaptive
+            particles.target_resolution[new] = target_resolution
+            self.index.insert(particles.co[new])
+            # particles with every direction taken are surrounded and won't be tried again
+            particles.tag[spreading] = TAG_DONE
+        return new
+
+    def first_in_batch(self, points, threshold, candidates):
+        """Drops candidates closer than threshold to an earlier candidate of the same batch."""
+        rows = np.flatnonzero(candidates)
+        if len(rows) < 2:
+            return candidates
+        # cells as wide as the largest threshold, close pairs are at most a cell apart
+        batch = SpatialHash(threshold[rows].max(), points[rows])
+        close, others, distances = batch.find_within_array(points[rows], threshold[rows])
+        candidates = candidates.copy()
+        candidates[rows[close[others < close]]] = False
+        return candidates
 
     def get_nearest(self, location, n):
-        for location, index, dist in self.kd_tree.find_n(location, n):
-            yield self.particles[index], dist
+        for index, dist in self.index.find_n(location, n):
+            yield index, dist
+
+    def nearest_array(self, points, n):
+        return self.index.find_n_array(points, n)
 
     def sample_surface(self, location):
         return self.field.sample_point(location)
 
+    def sample_surface_array(self, points):
+        return self.field.sample_points(points)
+
+    def refresh_preview(self, force=False):
+        """Counts a solver step and redraws the preview if the refresh interval has passed.
+
+        preview_mode is "STEPS" to redraw every preview_steps steps, "TIME" to redraw
+        at most every preview_interval seconds or "OFF". Returns whether it redrew.
+        """
+        self.pending_steps += 1
+        if not force:
+            if self.preview_mode == "OFF":
+                return False
+            if self.preview_mode == "STEPS" and self.pending_steps < self.preview_steps:
+                return False
+            if self.preview_mode == "TIME" and perf_counter() - self.last_preview < self.preview_interval:
+                return False
+        self.draw()
+        self.pending_steps = 0
+        self.last_preview = perf_counter()
+        return True
+
     def draw(self):
-        self.draw_obj.commands.clear()
-        for particle in self.particles:
-            particle.draw()
+        particles = self.particles
+        if not len(particles):
+            self.draw_obj.clear()
+            return
+
+        dark_red = (0.9, 0.1, 0, 1)
+        dark_orange = (1, 0.5, 0, 1)
+
+        # a uniform subsample keeps the preview cost bounded on dense particle sets
+        rows = slice(None)
+        if len(particles) > self.max_glyphs:
+            rows = np.unique(np.linspace(0, len(particles) - 1, self.max_glyphs).astype(np.int64))
+
+        radius = particles.radius[rows][:, None]
+        center = particles.co[rows] + (0.3 * radius * particles.normal[rows])
+        u = particles.frame_u[rows] * radius
+        v = particles.frame_v[rows] * radius
+
+        mat = self.matrix
+        rot = mat[:3, :3].T
+        loc = mat[:3, 3]
+        starts = np.concatenate((center - u, center - v)).dot(rot) + loc
+        ends = np.concatenate((center + u, center + v)).dot(rot) + loc
+        colors = np.repeat((dark_orange, dark_red), len(center), axis=0)
+        self.draw_obj.set_lines(starts, ends, colors)
+
+    def simplify_mesh(self, bm, method="DELAUNAY", triangles=None):
+        """Output mesh with a vertex per particle, connected by the given extraction method.
+
+        DELAUNAY connects the particles directly from their tangent planes, SUBDIVIDE
+        densifies the source mesh bm and connects the particles owning its faces.
+        triangles are the delaunay_triangles() of the current particles if already known.
+        """
+        if method == "DELAUNAY":
+            new_bm = self.extract_delaunay(triangles)
+        else:
+            new_bm = self.extract_subdivide(bm)
+        self.finish_extraction(new_bm)
+        return new_bm
+
+    def extract_delaunay(self, triangles=None):
+        if triangles is None:
+            triangles = self.delaunay_triangles()
+        return self.particle_bmesh(triangles.tolist())
+
+    def delaunay_triangles(self):
+        """(F, 3) particle indices of the restricted Delaunay triangles, closed into a manifold."""
+        particles = self.particles
+        self.update_index()
+        neighbors, distances = self.nearest_array(particles.co, 11)
+        normal, u, v = mesh_extraction.smoothed_frames(particles.normal, particles.frame_u, neighbors)
+        triangles, votes = mesh_extraction.restricted_delaunay(particles.co, normal, u, v, particles.radius, neighbors)
+        # triangles whose middle is more than a particle radius off the surface bridge a gap in it
+        gap = self.sample_surface_array(particles.co[triangles].mean(axis=1)).distance
+        on_surface = gap <= particles.radius[triangles].mean(axis=1)
+        triangles, votes = triangles[on_surface], votes[on_surface]
+        triangles = mesh_extraction.manifold_triangles(particles.co, normal, triangles, votes)
+        triangles = mesh_extraction.orient_triangles(particles.co, normal, triangles)
+        return mesh_extraction.close_manifold(particles.co, normal, triangles)
+
+    def particle_bmesh(self, faces):
+        """New bmesh with a vertex per particle, tagged with its index in the "particle" layer."""
+        new_bm = bmesh.new()
+        layer = new_bm.verts.layers.int.new("particle")
+        particle_verts = []
+        for index, co in enumerate(self.particles.co.tolist()):
+            vert = new_bm.verts.new(co)
+            vert[layer] = index
+            particle_verts.append(vert)
+
+        for face in faces:
+            try:
+                new_bm.faces.new([particle_verts[p] for p in face])
+            except ValueError:
+                pass
+        return new_bm
+
+    def finish_extraction(self, new_bm):
+        # removing a vertex can only drop the valence of its neighbors
+        queue = deque(vert for vert in new_bm.verts if len(vert.link_edges) < 3)
+        while queue:
+            vert = queue.popleft()
+            if not vert.is_valid:
+                continue
+            neighbors = [edge.other_vert(vert) for edge in vert.link_edges]
+            new_bm.verts.remove(vert)
+            for other in neighbors:
+                if len(other.link_edges) == 2:
+                    queue.append(other)
+
+        bmesh.ops.holes_fill(new_bm, edges=new_bm.edges)
+        bmesh.ops.triangulate(new_bm, faces=new_bm.faces)
+        bmesh.ops.recalc_face_normals(new_bm, faces=new_bm.faces)
+        if not self.triangle_mode:
+            bmesh.ops.join_triangles(new_bm, faces=new_bm.faces, angle_face_threshold=1.0, angle_shape_threshold=3.14)
 
-    def simplify_mesh(self, bm):
+    def extract_subdivide(self, bm):
 
-        class Ownership:
-            def __init__(self, particle, dist):
-                self.particle = particle
-                self.distance = dist
-                self.valid = False
+        particles = self.particles
 
         bmesh.ops.triangulate(bm, faces=bm.faces)
         last_edges = float("+inf")
@@ -242,7 +713,7 @@ class ParticleManager:
                 center = edge.verts[0].co + edge.verts[1].co
                 center /= 2
                 for p, dist in self.get_nearest(center, 1):
-                    if p.radius ** 2 < le:
+                    if particles.radius[p] ** 2 < le:
                         edges.add(edge)
             if not len(edges) < last_edges:
                 break
@@ -250,80 +721,79 @@ class ParticleManager:
             bmesh.ops.subdivide_edges(bm, edges=list(edges), cuts=1)
             bmesh.ops.triangulate(bm, faces=bm.faces)
 
-        bm.faces.ensure_lookup_table()
-        bm.verts.ensure_lookup_table()
-        tree = KDTree(len(bm.verts))
-        for vert in bm.verts:
-            tree.insert(vert.co, vert.index)
-        tree.balance()
+        bm.verts.index_update()
+        return self.particle_bmesh(self.owner_triangles(MeshArrays.from_bmesh(bm)).tolist())
 
-        ownership_mapping = {}
-        ownership_validation_front = set()
-
-        for vert in bm.verts:
-            for p, dist in self.get_nearest(vert.co, 1):
-                ownership_mapping[vert] = Ownership(p, dist)
-
-        for particle in self.particles:
-            location, index, dist = tree.find(particle.location)
-            vert = bm.verts[index]
-            if vert in ownership_mapping:
-                if ownership_mapping[vert].particle == particle:
-                    ownership_mapping[vert].valid = True
-                    ownership_validation_front.add(vert)
-
-        while True:
-            new_front = set()
-            for vert in ownership_validation_front:
-                for edge in vert.link_edges:
-                    other_vert = edge.other_vert(vert)
-                    if other_vert not in ownership_mapping:
-                        continue
-                    if ownership_mapping[other_vert].valid:
-                        continue
-                    if other_vert in ownership_mapping:
-                        if ownership_mapping[vert].particle is ownership_mapping[other_vert].particle:
-                            new_front.add(other_vert)
-                            ownership_mapping[other_vert].valid = True
-            ownership_validation_front = new_front
-            if not new_front:
-                break
+    def subdivide_triangles(self):
+        """(F, 3) particle indices connected like extract_subdivide does, closed into a manifold.
 
-        new_bm = bmesh.new()
-        for particle in self.particles:
-            particle.vert = new_bm.verts.new(particle.location)
-
-        for face in bm.faces:
-            connections = set()
-            for vert in face.verts:
-                if vert in ownership_mapping:
-                    if ownership_mapping[vert].valid:
-                        p = ownership_mapping[vert].particle
-                        connections.add(p)
-            if len(connections) == 3:
-                try:
-                    new_bm.faces.new([particle.vert for particle in connections])
-                except ValueError:
-                    pass
+        The array counterpart of extract_subdivide, it densifies the field mesh instead of a bmesh.
+        """
+        particles = self.particles
+        self.update_index()
+        co, triangles = self.field.mesh.co, self.field.mesh.faces
+        last_edges = float("+inf")
         while True:
-            stop = True
-            for vert in new_bm.verts:
-                if len(vert.link_edges) < 3:
-                    new_bm.verts.remove(vert)
-                    stop = False
-            if stop:
+            check_cancelled()
+            edges = face_edges(triangles)
+            length = ((co[edges[:, 0]] - co[edges[:, 1]]) ** 2).sum(axis=1)
+            nearest = self.nearest_array((co[edges[:, 0]] + co[edges[:, 1]]) / 2, 1)[0][:, 0]
+            split = particles.radius[nearest] ** 2 < length
+            if not np.count_nonzero(split) < last_edges:
                 break
+            last_edges = np.count_nonzero(split)
+            co, triangles = mesh_extraction.split_edges(co, triangles, edges, split)
+
+        triangles = self.owner_triangles(MeshArrays.from_polygons(co, triangles))
+        triangles = mesh_extraction.orient_triangles(particles.co, particles.normal, triangles)
+        return mesh_extraction.close_manifold(particles.co, particles.normal, triangles)
+
+    def owner_triangles(self, mesh):
+        """Unique (F, 3) triangles of the particles owning the corners of the mesh faces.
+
+        Each mesh vertex belongs to its nearest particle, as long as it is connected to
+        the vertex closest to that particle through vertices of the same owner.
+        """
+        particles = self.particles
+        owner = self.nearest_array(mesh.co, 1)[0][:, 0]
+
+        # a particle's region starts from the vertex closest to it, if that vertex is its own
+        seed = SpatialHash(self.index.cell_size, mesh.co).find_n_array(particles.co, 1)[0][:, 0]
+        seeded = (seed >= 0) & (owner[np.maximum(seed, 0)] == np.arange(len(particles)))
+        valid = np.zeros(len(mesh), dtype=np.bool_)
+        valid[seed[seeded]] = True
+
+        # grow every region over the edges joining vertices of the same owner
+        indptr = mesh.indptr.tolist()
+        indices = mesh.indices.tolist()
+        owners = owner.tolist()
+        reached = valid.tolist()
+        queue = deque(np.flatnonzero(valid).tolist())
+        while queue:
+            vert = queue.popleft()
+            for other in indices[indptr[vert]:indptr[vert + 1]]:
+                if not reached[other] and owners[other] == owners[vert]:
+                    reached[other] = True
+                    queue.append(other)
+        valid = np.array(reached, dtype=np.bool_)
+
+        labels = np.where(valid[mesh.faces], owner[mesh.faces], -1)
+        ordered = np.sort(labels, axis=1)
+        connected = (ordered[:, 0] >= 0) & (ordered[:, 0] != ordered[:, 1]) & (ordered[:, 1] != ordered[:, 2])
+        # the face winding is kept, each set of owners once
+        count = len(particles)
+        key = (ordered[:, 0] * count + ordered[:, 1]) * count + ordered[:, 2]
+        first = np.unique(key[connected], return_index=True)[1]
+        return labels[connected][np.sort(first)]
 
-        bmesh.ops.holes_fill(new_bm, edges=new_bm.edges)
-        bmesh.ops.triangulate(new_bm, faces=new_bm.faces)
-        bmesh.ops.recalc_face_normals(new_bm, faces=new_bm.faces)
-        if not self.triangle_mode:
-            bmesh.ops.join_triangles(new_bm, faces=new_bm.faces, angle_face_threshold=1.0, angle_shape_threshold=3.14)
 
-        return new_bm
+class Partile:
+    """Object-per-particle reference implementation.
 
+    ParticleManager keeps its particles in a ParticleArrays store, this class is only
+    kept to validate the array kernels and to compare memory use against the old layout.
+    """
 
-class Partile:
     def __init__(self, location, manager):
         self.last_hit = manager.sample_surface(location)
         self.location = self.last_hit.co
@@ -337,6 +807,16 @@ class Partile:
         self.lock_x = False
         self.tag = False
 
+    @classmethod
+    def from_store(cls, manager, index):
+        particles = manager.particles
+        p = cls(Vector(particles.co[index]), manager)
+        p.radius = particles.radius[index]
+        p.adaptive = particles.adaptive[index]
+        p.target_resolution = particles.target_resolution[index]
+        p.lock_x = bool(particles.lock_x[index])
+        return p
+
     def cubic_decay(self, x, d):
         x = x / d
         x = max(min(x, 1), 0)
@@ -365,92 +845,3 @@ class Partile:
         else:
             curv = self.adaptive * angle + (1 - self.adaptive)
         return d / curv
-
-    def step(self, speed):
-        hit = self.last_hit
-        movement = Vector()
-        count = 0
-        avg_dist = 0
-
-        for neighbor, dist in self.manager.get_nearest(self.location, 9):
-            if dist < 0:
-                self.velocity = Vector((random() - 0.5, random() - 0.5, random() - 0.5)).normalized().cross(
-                    self.normal) * 16 * self.radius
-                continue
-
-            avg_dist += dist
-            movement += self.quad_force(neighbor)
-            count += 1
-
-        if not count:
-            return
-
-        self.radius = (avg_dist / count) / 2.1
-        movement.normalize()
-        self.last_hit = self.manager.sample_surface(self.location + (movement * self.radius * speed))
-        self.location = self.last_hit.co
-        self.loc_history.pop(0)
-        self.loc_history.append(self.location)
-        self.normal = self.last_hit.normal
-        if self.counter_pair:
-            co = self.location.copy()
-            co.x *= -1
-            self.counter_pair.location = co
-        elif self.lock_x:
-            self.location.x = 0
-
-    def spread(self):
-        new_particles = []
-
-        if self.tag not in {"REMOVE", "DONE"}:
-            for p, dist in self.manager.get_nearest(self.location, 2):
-                if p is self:
-                    continue
-                if p.tag in {"REMOVE"}:
-                    continue
-                if dist < ((self.radius + p.radius) / 2) * 1.5:
-                    self.tag = "REMOVE"
-                    p.location += self.location
-                    p.location /= 2
-                    return new_particles
-            u = self.last_hit.frame.u
-            v = self.last_hit.frame.v
-
-            for vec in (u, v, -u, -v):
-                hit = self.manager.sample_surface(vec * self.radius * 2 + self.location)
-                free = True
-                for p, dist in self.manager.get_nearest(hit.co, 1):
-                    if dist < self.radius * 1.5:
-                        free = False
-                if free:
-                    p1 = Partile(hit.co, self.manager)
-                    new_particles.append(p1)
-                    curv = self.adaptive * hit.curvature + (1 - self.adaptive)
-                    p1.radius = self.target_resolution / curv
-                    p1.adaptive = self.adaptive
-                    p1.target_resolution = self.target_resolution
-                    self.tag = "DONE"
-        return new_particles
-
-    def draw(self):
-        dark_red = (0.9, 0.1, 0, 1)
-        dark_orange = (1, 0.5, 0, 1)
-        red = (1, 0, 0, 1)
-
-        mat = self.last_hit.frame.get_matrix()
-
-        lines = [
-            (
-                mat * Vector((-1, 0, 0)) * self.radius + self.location + (0.3 * self.radius * self.normal),
-                mat * Vector((1, 0, 0)) * self.radius + self.location + (0.3 * self.radius * self.normal),
-                dark_orange
-            ),
-            (
-                mat * Vector((0, -1, 0)) * self.radius + self.location + (0.3 * self.radius * self.normal),
-                mat * Vector((0, 1, 0)) * self.radius + self.location + (0.3 * self.radius * self.normal),
-                dark_red
-            )
-        ]
-        for a, b, color in lines:
-            mat = self.manager.obj.matrix_world
-            self.manager.draw_obj.add_line(mat * a, mat * b, color=color)
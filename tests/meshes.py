@@ -0,0 +1,135 @@
+'''
+Copyright (C) 2018 Jean Da Costa machado.
+Jean3dimensional@gmail.com
+
+Created by Jean Da Costa machado
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+from collections import Counter, defaultdict
+
+import numpy as np
+
+from tesselator.mesh_arrays import face_edges
+
+
+def icosphere(subdivisions=3):
+    """Unit icosphere as (verts, triangles)."""
+    t = (1 + 5 ** 0.5) / 2
+    verts = np.array([(-1, t, 0), (1, t, 0), (-1, -t, 0), (1, -t, 0), (0, -1, t), (0, 1, t),
+                      (0, -1, -t), (0, 1, -t), (t, 0, -1), (t, 0, 1), (-t, 0, -1), (-t, 0, 1)], dtype=np.float64)
+    faces = np.array([(0, 11, 5), (0, 5, 1), (0, 1, 7), (0, 7, 10), (0, 10, 11), (1, 5, 9), (5, 11, 4),
+                      (11, 10, 2), (10, 7, 6), (7, 1, 8), (3, 9, 4), (3, 4, 2), (3, 2, 6), (3, 6, 8),
+                      (3, 8, 9), (4, 9, 5), (2, 4, 11), (6, 2, 10), (8, 6, 7), (9, 8, 1)])
+    verts /= np.sqrt((verts * verts).sum(axis=1))[:, None]
+    for i in range(subdivisions):
+        edges = face_edges(faces)
+        middle = {(a, b): len(verts) + index for index, (a, b) in enumerate(edges.tolist())}
+        mid = verts[edges[:, 0]] + verts[edges[:, 1]]
+        verts = np.concatenate((verts, mid / np.sqrt((mid * mid).sum(axis=1))[:, None]))
+        new_faces = []
+        for a, b, c in faces.tolist():
+            ab, bc, ca = middle[min(a, b), max(a, b)], middle[min(b, c), max(b, c)], middle[min(c, a), max(c, a)]
+            new_faces += [(a, ab, ca), (b, bc, ab), (c, ca, bc), (ab, bc, ca)]
+        faces = np.array(new_faces)
+    return verts, faces
+
+
+def cube(cuts=8):
+    """Cube from -1 to 1 with every side split in cuts x cuts quads, as (verts, triangles)."""
+    grid = np.linspace(-1, 1, cuts + 1)
+    index = {}
+    verts = []
+    faces = []
+
+    def vert(co):
+        key = tuple(np.round(co, 6).tolist())
+        if key not in index:
+            index[key] = len(verts)
+            verts.append(key)
+        return index[key]
+
+    for axis in range(3):
+        for sign in (-1, 1):
+            for i in range(cuts):
+                for j in range(cuts):
+                    quad = []
+                    for a, b in ((i, j), (i + 1, j), (i + 1, j + 1), (i, j + 1)):
+                        co = np.zeros(3)
+                        co[axis], co[(axis + 1) % 3], co[(axis + 2) % 3] = sign, grid[a], grid[b]
+                        quad.append(vert(co))
+                    if sign < 0:
+                        quad.reverse()
+                    faces += [(quad[0], quad[1], quad[2]), (quad[0], quad[2], quad[3])]
+    return np.array(verts, dtype=np.float64), np.array(faces)
+
+
+def torus(major=64, minor=24, radius=0.35):
+    """Torus around z, as (verts, triangles)."""
+    u = np.repeat(np.linspace(0, 2 * np.pi, major, endpoint=False), minor)
+    v = np.tile(np.linspace(0, 2 * np.pi, minor, endpoint=False), major)
+    verts = np.stack(((1 + radius * np.cos(v)) * np.cos(u), (1 + radius * np.cos(v)) * np.sin(u),
+                      radius * np.sin(v)), axis=1)
+    faces = []
+    for i in range(major):
+        for j in range(minor):
+            a, b = i * minor + j, (i + 1) % major * minor + j
+            c, d = (i + 1) % major * minor + (j + 1) % minor, i * minor + (j + 1) % minor
+            faces += [(a, b, c), (a, c, d)]
+    return verts, np.array(faces)
+
+
+def topology(faces):
+    """Euler characteristic, edge and vertex defects and pieces of a mesh given as index lists.
+
+    Counted on the faces alone: boundary edges have one face, non manifold edges
+    more than two, and a pinched vertex has faces around it that don't form a
+    single fan.
+    """
+    edge_faces = Counter()
+    links = defaultdict(list)
+    for face in faces:
+        for i in range(len(face)):
+            a, b = face[i], face[(i + 1) % len(face)]
+            edge_faces[min(a, b), max(a, b)] += 1
+            links[a].append((face[i - 1], b))
+
+    def find(parent, a):
+        while parent.setdefault(a, a) != a:
+            a = parent[a]
+        return a
+
+    pinched = 0
+    for vert, link in links.items():
+        parent = {}
+        for a, b in link:
+            parent[find(parent, a)] = find(parent, b)
+        pinched += len(set(find(parent, a) for a in parent)) > 1
+
+    parent = {}
+    for face in faces:
+        for vert in face[1:]:
+            parent[find(parent, vert)] = find(parent, face[0])
+    return {
+        "euler": len(links) - len(edge_faces) + len(faces),
+        "boundary_edges": sum(1 for count in edge_faces.values() if count == 1),
+        "non_manifold_edges": sum(1 for count in edge_faces.values() if count > 2),
+        "pinched_verts": pinched,
+        "pieces": len(set(find(parent, vert) for vert in links)),
+    }
+
+
+def closed(euler):
+    """topology() of a closed manifold in one piece with the given euler characteristic."""
+    return {"euler": euler, "boundary_edges": 0, "non_manifold_edges": 0, "pinched_verts": 0, "pieces": 1}
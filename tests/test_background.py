@@ -0,0 +1,60 @@
+'''
+Copyright (C) 2018 Jean Da Costa machado.
+Jean3dimensional@gmail.com
+
+Created by Jean Da Costa machado
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import threading
+
+import meshes
+from tesselator.background import BackgroundStages, check_cancelled
+from tesselator.core import Remesher, remesh_params
+
+
+def test_cancel_interrupts_work_between_yields():
+    started = threading.Event()
+
+    def stages():
+        yield ["Working."]
+        while True:
+            started.set()
+            check_cancelled()
+
+    runner = BackgroundStages(stages())
+    assert started.wait(5)
+    assert runner.join(5)
+    assert runner.interrupted and runner.error is None
+
+
+def test_cancel_stops_the_field_build():
+    verts, faces = meshes.icosphere(4)
+    solver = Remesher.from_geometry(verts, faces, remesh_params()).solver
+    cancelled = threading.Event()
+
+    def stages():
+        cancelled.wait(5)
+        solver.build_field(None, False, None, "SOLVE", 200)
+        yield ["Field built."]
+
+    runner = BackgroundStages(stages())
+    runner.cancel()
+    cancelled.set()
+    assert runner.finished.wait(5)
+    assert runner.interrupted and runner.feedback == []
+
+
+def test_check_cancelled_does_nothing_outside_a_worker():
+    check_cancelled()
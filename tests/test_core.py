@@ -0,0 +1,62 @@
+'''
+Copyright (C) 2018 Jean Da Costa machado.
+Jean3dimensional@gmail.com
+
+Created by Jean Da Costa machado
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import numpy as np
+import pytest
+
+import meshes
+from tesselator import mesh_extraction
+from tesselator.core import remesh, remesh_params
+
+
+@pytest.mark.parametrize("extraction", ["DELAUNAY", "SUBDIVIDE"])
+def test_remesh_closes_an_icosphere(extraction):
+    np.random.seed(0)
+    verts, faces = meshes.icosphere(3)
+    co, new_faces = remesh(verts, faces, dict(resolution=30, steps=10, x_mirror=False, extraction=extraction))
+    assert meshes.topology(new_faces) == meshes.closed(2)
+    # the smoothed vertices are snapped back on the unit sphere
+    assert np.abs(np.sqrt((co * co).sum(axis=1)) - 1).max() < 0.01
+    assert {len(face) for face in new_faces} <= {3, 4}
+
+
+def test_remesh_keeps_triangles_in_triangle_mode():
+    np.random.seed(0)
+    verts, faces = meshes.icosphere(3)
+    co, new_faces = remesh(verts, faces, dict(resolution=30, steps=10, x_mirror=False, triangle_mode=True))
+    assert meshes.topology(new_faces) == meshes.closed(2)
+    assert {len(face) for face in new_faces} == {3}
+
+
+def test_remesh_rejects_unknown_extraction():
+    verts, faces = meshes.icosphere(2)
+    with pytest.raises(ValueError):
+        remesh(verts, faces, dict(resolution=10, steps=1, extraction="VORONOI"))
+
+
+def test_split_edges_leaves_no_t_junctions():
+    verts, faces = meshes.icosphere(1)
+    edges = mesh_extraction.face_edges(faces)
+    split = np.arange(len(edges)) % 3 == 0
+    co, triangles = mesh_extraction.split_edges(verts, faces, edges, split)
+    assert len(co) == len(verts) + split.sum()
+    assert meshes.topology(triangles.tolist()) == meshes.closed(2)
+    # every triangle keeps facing outwards
+    a, b, c = co[triangles[:, 0]], co[triangles[:, 1]], co[triangles[:, 2]]
+    assert ((np.cross(b - a, c - a) * (a + b + c)).sum(axis=1) > 0).all()
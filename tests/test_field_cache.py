@@ -0,0 +1,37 @@
+'''
+Copyright (C) 2018 Jean Da Costa machado.
+Jean3dimensional@gmail.com
+
+Created by Jean Da Costa machado
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import os
+
+import numpy as np
+
+from tesselator.field_cache import FieldCache
+
+
+def test_load_drops_corrupt_entries(tmpdir):
+    cache = FieldCache(str(tmpdir))
+    cache.save("good", {"field_u": np.arange(30000.0)})
+    with open(cache.path("good"), "rb") as file:
+        data = file.read()
+    for key, blob in (("not_a_zip", b"PK\x03\x04" + b"x" * 100), ("truncated", data[:len(data) // 2])):
+        with open(cache.path(key), "wb") as file:
+            file.write(blob)
+        assert cache.load(key) is None
+        assert not os.path.exists(cache.path(key))
+    assert cache.load("good")["field_u"].sum() == np.arange(30000.0).sum()
@@ -0,0 +1,102 @@
+'''
+Copyright (C) 2018 Jean Da Costa machado.
+Jean3dimensional@gmail.com
+
+Created by Jean Da Costa machado
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import numpy as np
+import pytest
+
+import meshes
+from tesselator import mesh_extraction
+from tesselator.core import Remesher, remesh_params
+
+
+def relaxed(verts, faces, **params):
+    """Remesher whose particles went through placement and relaxation."""
+    np.random.seed(0)
+    remesher = Remesher.from_geometry(verts, faces, remesh_params(dict(dict(steps=10, x_mirror=False), **params)))
+    for feedback in remesher.stages():
+        pass
+    return remesher
+
+
+def test_drop_nonmanifold_keeps_two_opposite_faces_per_edge():
+    triangles = np.array([(0, 1, 2), (1, 0, 3), (1, 0, 4), (0, 1, 5), (2, 1, 0)])
+    kept = mesh_extraction.drop_nonmanifold(triangles, 6)
+    assert kept.tolist() == [[0, 1, 2], [1, 0, 3]]
+
+
+def test_drop_pinched_keeps_the_largest_fan():
+    triangles = np.array([(0, 1, 2), (0, 2, 3), (0, 3, 4), (0, 5, 6)])
+    kept = mesh_extraction.drop_pinched(triangles, 7)
+    assert kept.tolist() == triangles[:3].tolist()
+
+
+def test_fill_holes_closes_an_open_box():
+    verts, faces = meshes.cube(3)
+    # the side facing +z is left open
+    faces = faces[~(verts[faces][:, :, 2] > 0.99).all(axis=1)]
+    assert meshes.topology(faces.tolist())["boundary_edges"] == 12
+    filled = mesh_extraction.fill_holes(faces, verts, verts)
+    assert meshes.topology(filled.tolist()) == meshes.closed(2)
+
+
+def test_fill_holes_splits_loops_touching_at_a_vertex():
+    verts, faces = meshes.cube(2)
+    # two corner quads of the +z side sharing only the center vertex are open
+    top = (verts[faces][:, :, 2] > 0.99).all(axis=1)
+    center = verts[faces][:, :, :2].mean(axis=1)
+    faces = faces[~(top & (center[:, 0] * center[:, 1] > 0))]
+    assert len(mesh_extraction.boundary_loops(faces)) == 2
+    filled = mesh_extraction.fill_holes(faces, verts, verts)
+    assert meshes.topology(filled.tolist()) == meshes.closed(2)
+
+
+@pytest.mark.parametrize("shape, euler, params", [
+    ("icosphere", 2, {"resolution": 20}),
+    ("torus", 0, {"resolution": 30}),
+    ("torus", 0, {"resolution": 30, "x_mirror": True}),
+    ("cube", 2, {"resolution": 24, "particle_placement": "INTEGER_LATTICE"}),
+    ("cube", 2, {"resolution": 24, "particle_placement": "INTEGER_LATTICE", "x_mirror": True}),
+])
+def test_delaunay_extraction_keeps_the_source_topology(shape, euler, params):
+    verts, faces = getattr(meshes, shape)()
+    remesher = relaxed(verts, faces, **params)
+    triangles = remesher.solver.delaunay_triangles()
+    assert meshes.topology(triangles.tolist()) == meshes.closed(euler)
+
+
+def test_delaunay_extraction_matches_subdivide_topology():
+    """Both methods connect the same particles into meshes of the same topology."""
+    bmesh = pytest.importorskip("bmesh")
+    from tesselator.benchmarks import mesh_topology
+
+    verts, faces = meshes.torus()
+    solver = relaxed(verts, faces, resolution=30).solver
+    results = {}
+    for method in ("SUBDIVIDE", "DELAUNAY"):
+        bm = bmesh.new()
+        bm_verts = [bm.verts.new(co) for co in verts.tolist()]
+        for face in faces.tolist():
+            bm.faces.new([bm_verts[index] for index in face])
+        new_bm = solver.simplify_mesh(bm, method)
+        results[method] = mesh_topology(new_bm)[0]
+        bm.free()
+        new_bm.free()
+    for method, topology in results.items():
+        assert topology["boundary_edges"] == topology["non_manifold_edges"] == 0, method
+    assert results["DELAUNAY"]["euler"] == results["SUBDIVIDE"]["euler"] == 0
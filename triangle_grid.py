@@ -0,0 +1,211 @@
+'''
+Copyright (C) 2018 Jean Da Costa machado.
+Jean3dimensional@gmail.com
+
+Created by Jean Da Costa machado
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import numpy as np
+
+from .spatial_hash import _pack
+
+
+def _cube(size):
+    r = np.arange(size)
+    return np.stack(np.meshgrid(r, r, r, indexing="ij"), axis=-1).reshape(-1, 3)
+
+
+def closest_points_on_triangles(p, a, b, c):
+    """Closest point to each p on the triangle (a, b, c) of the same row."""
+    ab = b - a
+    ac = c - a
+    ap = p - a
+    bp = p - b
+    cp = p - c
+    d1 = (ab * ap).sum(axis=1)
+    d2 = (ac * ap).sum(axis=1)
+    d3 = (ab * bp).sum(axis=1)
+    d4 = (ac * bp).sum(axis=1)
+    d5 = (ab * cp).sum(axis=1)
+    d6 = (ac * cp).sum(axis=1)
+    va = d3 * d6 - d5 * d4
+    vb = d5 * d2 - d1 * d6
+    vc = d1 * d4 - d3 * d2
+
+    def ratio(x, y):
+        return x / np.where(np.abs(y) > 1e-30, y, 1e-30)
+
+    # Voronoi regions of the triangle, later regions take precedence
+    denom = va + vb + vc
+    result = a + ab * ratio(vb, denom)[:, None] + ac * ratio(vc, denom)[:, None]
+    e = d4 - d3
+    f = d5 - d6
+    region = (va <= 0) & (e >= 0) & (f >= 0)
+    result[region] = (b + (c - b) * ratio(e, e + f)[:, None])[region]
+    region = (vb <= 0) & (d2 >= 0) & (d6 <= 0)
+    result[region] = (a + ac * ratio(d2, d2 - d6)[:, None])[region]
+    region = (d6 >= 0) & (d5 <= d6)
+    result[region] = c[region]
+    region = (vc <= 0) & (d1 >= 0) & (d3 <= 0)
+    result[region] = (a + ab * ratio(d1, d1 - d3)[:, None])[region]
+    region = (d3 >= 0) & (d4 <= d3)
+    result[region] = b[region]
+    region = (d1 <= 0) & (d2 <= 0)
+    result[region] = a[region]
+    return result
+
+
+class TriangleGrid:
+    """Closest point queries on a triangle mesh, standing in for mathutils BVHTree outside Blender.
+
+    Triangles are bucketed in a uniform grid over every cell their bounding box
+    overlaps. A point is first tested against the triangles of its own cell, which
+    holds its nearest triangle when the hit is closer than the cell walls. Points
+    failing that are tested against growing blocks of cells around them, the few
+    left after that against every triangle.
+    """
+
+    chunk_size = 1 << 20
+    block_sizes = (1, 2, 3, 5, 9)
+
+    def __init__(self, co, triangles, cell_size=None):
+        self.co = np.asarray(co, dtype=np.float64).reshape(-1, 3)
+        self.triangles = np.asarray(triangles, dtype=np.int64).reshape(-1, 3)
+        self.corners = self.co[self.triangles]
+        normals = np.cross(self.corners[:, 1] - self.corners[:, 0], self.corners[:, 2] - self.corners[:, 0])
+        lengths = np.sqrt((normals * normals).sum(axis=1))
+        self.normals = normals / np.maximum(lengths, 1e-30)[:, None]
+
+        self.centroids = self.corners.mean(axis=1)
+        self.low = low = self.corners.min(axis=1)
+        self.high = high = self.corners.max(axis=1)
+        if cell_size is None:
+            extent = (high - low).max(axis=1) if len(low) else np.ones(1)
+            # big triangles are capped to a few thousand cells each
+            cell_size = max(2 * np.median(extent), extent.max() / 16, 1e-9)
+        self.cell_size = float(cell_size)
+
+        first = np.floor(low / self.cell_size).astype(np.int64)
+        span = np.floor(high / self.cell_size).astype(np.int64) - first + 1
+        counts = span.prod(axis=1)
+        triangle = np.repeat(np.arange(len(counts)), counts)
+        local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        sx, sy = span[triangle, 0], span[triangle, 1]
+        cells = first[triangle] + np.stack((local % sx, local // sx % sy, local // (sx * sy)), axis=1)
+        keys = _pack(cells)
+        order = np.argsort(keys, kind="mergesort")
+        self.keys = keys[order]
+        self.items = triangle[order]
+
+    def __len__(self):
+        return len(self.triangles)
+
+    def find_nearest(self, point):
+        """Same result as BVHTree.find_nearest, with arrays: (location, normal, index, distance)."""
+        location, normal, face, distance = self.find_nearest_array(np.reshape(point, (1, 3)))
+        if face[0] < 0:
+            return None, None, None, None
+        return location[0], normal[0], int(face[0]), distance[0]
+
+    def find_nearest_array(self, points):
+        """Nearest surface point of each point, face is -1 and distance inf when there are no triangles."""
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        location = points.copy()
+        normal = np.zeros_like(points)
+        face = np.full(len(points), -1, dtype=np.int64)
+        distance = np.full(len(points), np.inf)
+        count = len(self.triangles)
+        if not count:
+            return location, normal, face, distance
+        result = (location, normal, face, distance)
+
+        pending = np.arange(len(points))
+        for size in self.block_sizes:
+            if not len(pending):
+                break
+            co = points[pending]
+            cells = np.floor(co / self.cell_size).astype(np.int64)
+            if size % 2:
+                low = cells - size // 2
+            else:
+                # even blocks are centered on the cell corner nearest to the point
+                low = cells - size // 2 + (co - cells * self.cell_size > self.cell_size / 2)
+            keys = _pack(low[:, None, :] + _cube(size)[None, :, :])
+            starts = np.searchsorted(self.keys, keys, side="left")
+            counts = np.searchsorted(self.keys, keys, side="right") - starts
+            total = np.cumsum(counts.sum(axis=1))
+            # chunks of about chunk_size point and triangle pairs
+            bounds = np.searchsorted(total, np.arange(0, total[-1], self.chunk_size), side="right")
+            for begin, end in zip(bounds, np.append(bounds[1:], len(pending))):
+                if begin < end:
+                    self._test_cells(points, pending[begin:end], starts[begin:end], counts[begin:end], result)
+
+            # anything closer than the walls of the searched block was in it
+            wall = np.minimum(co - low * self.cell_size, (low + size) * self.cell_size - co).min(axis=1)
+            pending = pending[~(distance[pending] <= wall)]
+
+        step = max(1, self.chunk_size // count)
+        for start in range(0, len(pending), step):
+            rows = pending[start:start + step]
+            self._test(points, rows, np.repeat(np.arange(len(rows)), count), np.tile(np.arange(count), len(rows)),
+                       result)
+        return location, normal, face, distance
+
+    def _test_cells(self, points, rows, starts, counts, result):
+        counts = counts.ravel()
+        row = np.repeat(np.repeat(np.arange(len(rows)), starts.shape[1]), counts)
+        entries = np.repeat(starts.ravel() - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+        self._test(points, rows, row, self.items[entries], result)
+
+    def _test(self, points, rows, row, candidates, result):
+        """Keeps the closest candidate triangle of each row, where closer than the current hit.
+
+        row holds the position in rows of each candidate and is sorted.
+        """
+        if not len(row):
+            return
+        location, normal, face, distance = result
+        p = points[rows][row]
+        first = np.concatenate(([True], row[1:] != row[:-1]))
+        group = np.cumsum(first) - 1
+        starts = np.flatnonzero(first)
+
+        # a triangle whose box is farther than some centroid can't be the nearest
+        d = self.centroids[candidates] - p
+        upper = np.minimum.reduceat((d * d).sum(axis=1), starts)
+        upper = np.minimum(upper, distance[rows[row[starts]]] ** 2)
+        gap = np.maximum(self.low[candidates] - p, 0) + np.maximum(p - self.high[candidates], 0)
+        near = (gap * gap).sum(axis=1) <= upper[group]
+        row = row[near]
+        candidates = candidates[near]
+        p = p[near]
+
+        corners = self.corners[candidates]
+        closest = closest_points_on_triangles(p, corners[:, 0], corners[:, 1], corners[:, 2])
+        d = np.sqrt(((closest - p) ** 2).sum(axis=1))
+
+        first = np.concatenate(([True], row[1:] != row[:-1]))
+        group = np.cumsum(first) - 1
+        smallest = np.minimum.reduceat(d, np.flatnonzero(first))
+        best = np.flatnonzero(d == smallest[group])
+        best = best[np.concatenate(([True], row[best][1:] != row[best][:-1]))]
+        target = rows[row[best]]
+        better = d[best] < distance[target]
+        best = best[better]
+        target = target[better]
+        location[target] = closest[best]
+        normal[target] = self.normals[candidates[best]]
+        face[target] = candidates[best]
+        distance[target] = d[best]
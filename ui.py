@@ -108,6 +108,111 @@ class TesselatorSettings(bpy.types.PropertyGroup):
                ("ANOTHER_MESH", "Another Mesh", "Use vertices from another mesh as starting particles")],
         default="FAST_MARCHING"
     )
+    levels = bpy.props.IntProperty(
+        name="Levels",
+        description="Relax a coarser particle set first and refine it this many times, "
+                    "each level doubling the resolution",
+        default=0,
+        min=0,
+        max=4
+    )
+    level_steps = bpy.props.IntProperty(
+        name="Level Steps",
+        description="Relaxation steps after each refinement",
+        default=5,
+        min=0
+    )
+    batched_relaxation = bpy.props.BoolProperty(
+        name="Batched Relaxation",
+        description="Move all particles at once with array operations (faster, slightly different motion)",
+        default=True
+    )
+    convergence = bpy.props.FloatProperty(
+        name="Convergence",
+        description="Particles whose net movement over a few steps stays under this fraction of their step length "
+                    "stop until a neighbor moves, relaxation ends early once all stopped (0 always runs every step)",
+        default=0.0,
+        min=0.0,
+        max=1.0
+    )
+    workers = bpy.props.IntProperty(
+        name="Workers",
+        description="Processes used to snap the result to the surface and for the relaxation steps of batch "
+                    "runs (1 runs in Blender's own process, the remesh operator always relaxes in it)",
+        default=1,
+        min=1,
+        max=64
+    )
+    step_budget = bpy.props.IntProperty(
+        name="Step Budget (ms)",
+        description="Longest run of solver work between progress updates, steps over more particles "
+                    "are split and resumed (0 runs whole steps)",
+        default=50,
+        min=0
+    )
+    field_mode = bpy.props.EnumProperty(
+        name="Field Mode",
+        description="How the direction field is built from curvature and grease pencil",
+        items=[("GROW", "Grow", "Grow the field from the sharpest vertices and smooth it, fast."),
+               ("SOLVE", "Solve", "Solve for the smoothest field following curvature and strokes, better singularities.")],
+        default="GROW"
+    )
+    field_iterations = bpy.props.IntProperty(
+        name="Solver Iterations",
+        description="Most iterations of the field solver, bounds its time on large meshes",
+        default=200,
+        min=10
+    )
+    field_cache = bpy.props.BoolProperty(
+        name="Cache Direction Field",
+        description="Reuse the direction field from disk when the decimated mesh and guides didn't change",
+        default=True
+    )
+    field_cache_size = bpy.props.IntProperty(
+        name="Cache Size (MB)",
+        description="Oldest cached fields are deleted beyond this size",
+        default=256,
+        min=1
+    )
+    extraction = bpy.props.EnumProperty(
+        name="Mesh Extraction",
+        description="How particles are connected into the final mesh",
+        items=[("DELAUNAY", "Delaunay", "Connects neighboring particles directly, fast on high resolutions."),
+               ("SUBDIVIDE", "Subdivide", "Subdivides the source mesh and connects the particles owning its faces.")],
+        default="DELAUNAY"
+    )
+    preview_particles = bpy.props.IntProperty(
+        name="Preview Particles",
+        description="Most particles drawn while remeshing, the rest are skipped evenly",
+        default=20000,
+        min=100
+    )
+    preview_refresh = bpy.props.EnumProperty(
+        name="Preview Refresh",
+        description="When the particle preview is rebuilt while remeshing",
+        items=[("STEPS", "Steps", "Rebuild the preview every few solver steps."),
+               ("TIME", "Time", "Rebuild the preview at most once per interval."),
+               ("OFF", "Off", "Don't draw particles, fastest.")],
+        default="STEPS"
+    )
+    preview_steps = bpy.props.IntProperty(
+        name="Refresh Steps",
+        description="Solver steps between preview refreshes",
+        default=1,
+        min=1
+    )
+    preview_interval = bpy.props.IntProperty(
+        name="Refresh Interval (ms)",
+        description="Shortest time between preview refreshes",
+        default=200,
+        min=0
+    )
+    profile_log = bpy.props.StringProperty(
+        name="Profile Log",
+        description="Json file receiving stage timings and counters of each run (empty uses the temporary directory)",
+        subtype="FILE_PATH",
+        default=""
+    )
     show_advanced = bpy.props.BoolProperty(
         name="Advanced Settings",
         description="Show advanced settigns."
@@ -168,10 +273,48 @@ class TesselatorPanel(bpy.types.Panel):
             box.prop(settings, "step_scale", slider=True)
             box.prop(settings, "adaptive", slider=True)
             col = box.column(align=True)
+            col.prop(settings, "levels")
+            row = col.row()
+            row.enabled = settings.levels > 0
+            row.prop(settings, "level_steps")
+            box.prop(settings, "batched_relaxation", toggle=True)
+            row = box.row()
+            row.enabled = settings.batched_relaxation
+            row.prop(settings, "workers")
+            row = box.row()
+            row.enabled = settings.batched_relaxation and settings.workers == 1
+            row.prop(settings, "convergence", slider=True)
+            box.prop(settings, "step_budget")
+            col = box.column(align=True)
+            col.label("Direction Field")
+            col.prop(settings, "field_mode", text="")
+            row = col.row()
+            row.enabled = settings.field_mode == "SOLVE"
+            row.prop(settings, "field_iterations")
+            col = box.column(align=True)
+            col.prop(settings, "field_cache", toggle=True)
+            row = col.row()
+            row.enabled = settings.field_cache
+            row.prop(settings, "field_cache_size")
+            col = box.column(align=True)
             col.label("Particle Placement")
             col.prop(settings, "particle_placement", text = "")
             if settings.particle_placement == "FAST_MARCHING":
                 col.prop(settings, "seeds")
+            col = box.column(align=True)
+            col.label("Preview")
+            col.prop(settings, "preview_refresh", text="")
+            if settings.preview_refresh == "STEPS":
+                col.prop(settings, "preview_steps")
+            elif settings.preview_refresh == "TIME":
+                col.prop(settings, "preview_interval")
+            row = col.row()
+            row.enabled = settings.preview_refresh != "OFF"
+            row.prop(settings, "preview_particles")
+            box.prop(settings, "profile_log")
+            col = box.column(align=True)
+            col.label("Mesh Extraction")
+            col.prop(settings, "extraction", text="")
 
         op.resolution = settings.resolution
         op.adaptive = settings.adaptive
@@ -184,4 +327,20 @@ class TesselatorPanel(bpy.types.Panel):
         op.allow_triangles = settings.allow_triangles
         op.triangle_mode = settings.triangle_mode
         op.seeds = settings.seeds
-        op.particle_placement = settings.particle_placement
\ No newline at end of file
+        op.particle_placement = settings.particle_placement
+        op.levels = settings.levels
+        op.level_steps = settings.level_steps
+        op.batched_relaxation = settings.batched_relaxation
+        op.workers = settings.workers
+        op.convergence = settings.convergence
+        op.step_budget = settings.step_budget
+        op.field_mode = settings.field_mode
+        op.field_iterations = settings.field_iterations
+        op.field_cache = settings.field_cache
+        op.field_cache_size = settings.field_cache_size
+        op.extraction = settings.extraction
+        op.preview_particles = settings.preview_particles
+        op.preview_refresh = settings.preview_refresh
+        op.preview_steps = settings.preview_steps
+        op.preview_interval = settings.preview_interval
+        op.profile_log = settings.profile_log
\ No newline at end of file
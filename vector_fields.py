@@ -18,31 +18,115 @@ Created by Jean Da Costa machado
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
-import bmesh
-from mathutils import Vector, bvhtree, Matrix, geometry
+import numpy as np
 from random import random
+from . import profiling
+from .background import check_cancelled
+from .mesh_arrays import MeshArrays, barycentric_basis, barycentric_weights, cross_frames, csr_entries, \
+    major_curvatures, nearest_frame_vectors, rosy_connection, rosy_from_vectors, solve_rosy, tangent_basis, \
+    vectors_from_rosy
+from .triangle_grid import TriangleGrid
 
+try:
+    import bmesh
+    from mathutils import Vector, bvhtree, Matrix
+except ImportError:
+    # outside Blender only the array based parts work, see core.remesh
+    bmesh = Vector = bvhtree = Matrix = None
 
 
 class HitInfo:
+    """A single surface sample with lazily interpolated frame and curvature, needs mathutils.
+
+    Outside Blender sample with HitArrays, see FrameField.sample_points.
+    """
+
     def __init__(self, location, normal, face_index, distance, field):
+        profiling.count("hit_infos")
         self.co = location
-        face = field.bm.faces[face_index]
-        verts = [vert.co for vert in face.verts]
-        curvature = [Vector((0, 0, field.mesh_curvature[vert.index])) for vert in field.bm.faces[face_index].verts]
-        self.curvature_signed = geometry.barycentric_transform(location, *verts, *curvature).z
-        self.curvature = max(self.curvature_signed, -self.curvature_signed)
         self.normal = normal
-        try:
-            co = face.verts[0]
-            vec = field.vert_field[co.index].u
-            vecs = [field.vert_field[vert.index].get_nearest_vec(vec) for vert in face.verts]
-            vec = geometry.barycentric_transform(location, *verts, *vecs)
-        except KeyError:
-            vec = Vector((random(), random(), random())).cross(normal).normalized()
-        self.frame = CrossFrame(vec, self.normal)
-
         self.face = face_index
+        self.field = field
+        self._weights = None
+        self._curvature_signed = None
+        self._frame = None
+
+    @property
+    def weights(self):
+        if self._weights is None:
+            ox, oy, oz = self.field.face_origin[self.face].tolist()
+            (ax, ay, az), (bx, by, bz) = self.field.face_dual[self.face].tolist()
+            x = self.co.x - ox
+            y = self.co.y - oy
+            z = self.co.z - oz
+            a = x * ax + y * ay + z * az
+            b = x * bx + y * by + z * bz
+            self._weights = (1 - a - b, a, b)
+        return self._weights
+
+    @property
+    def curvature_signed(self):
+        if self._curvature_signed is None:
+            c0, c1, c2 = self.field.face_curvature[self.face].tolist()
+            w0, w1, w2 = self.weights
+            self._curvature_signed = c0 * w0 + c1 * w1 + c2 * w2
+        return self._curvature_signed
+
+    @property
+    def curvature(self):
+        return max(self.curvature_signed, -self.curvature_signed)
+
+    @property
+    def frame(self):
+        if self._frame is None:
+            if self.field.face_frame_valid[self.face]:
+                vec = Vector(np.dot(self.weights, self.field.face_frames[self.face]))
+            else:
+                vec = Vector((random(), random(), random())).cross(self.normal).normalized()
+            self._frame = CrossFrame(vec, self.normal)
+        return self._frame
+
+
+class HitArrays:
+    """Batched HitInfo, every attribute is an array with one row per sampled point."""
+
+    def __init__(self, points, field):
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        count = len(points)
+        self.co = points.copy()
+        self.normal = np.zeros((count, 3))
+        self.face = np.full(count, -1, dtype=np.int32)
+        self.distance = np.full(count, np.inf)
+
+        profiling.count("bvh_queries", count)
+        if hasattr(field.tree, "find_nearest_array"):
+            self.co, self.normal, self.face, self.distance = field.tree.find_nearest_array(points)
+            self.valid = self.face >= 0
+            hits = ()
+        else:
+            find_nearest = field.tree.find_nearest
+            hits = [find_nearest(point) for point in points.tolist()]
+            self.valid = np.array([hit[2] is not None for hit in hits], dtype=np.bool_)
+        if hits and self.valid.any():
+            hits = [hit for hit in hits if hit[2] is not None]
+            self.co[self.valid] = [hit[0] for hit in hits]
+            self.normal[self.valid] = [hit[1] for hit in hits]
+            self.face[self.valid] = [hit[2] for hit in hits]
+            self.distance[self.valid] = [hit[3] for hit in hits]
+
+        face = np.maximum(self.face, 0)
+        weights = barycentric_weights(self.co, field.face_origin[face], field.face_dual[face])
+        self.curvature_signed = (weights * field.face_curvature[face]).sum(axis=1)
+        self.curvature = np.abs(self.curvature_signed)
+
+        vec = (weights[:, :, None] * field.face_frames[face]).sum(axis=1)
+        missing = ~field.face_frame_valid[face]
+        if missing.any():
+            vec[missing] = np.cross(np.random.random((np.count_nonzero(missing), 3)), self.normal[missing])
+        self.frame_u, self.frame_v = cross_frames(vec, self.normal)
+
+    def __len__(self):
+        return len(self.co)
 
 
 class CrossFrame:
@@ -86,24 +170,127 @@ class CrossFrame:
         return Matrix((self.u, self.v, self.normal)).transposed().to_4x4()
 
 
+def _nearest_vec(u, v, vec):
+    """CrossFrame.get_nearest_vec for plain (x, y, z) sequences."""
+    u_d = vec[0] * u[0] + vec[1] * u[1] + vec[2] * u[2]
+    v_d = vec[0] * v[0] + vec[1] * v[1] + vec[2] * v[2]
+    if u_d * u_d > v_d * v_d:
+        return u if u_d > 0 else (-u[0], -u[1], -u[2])
+    else:
+        return v if v_d > 0 else (-v[0], -v[1], -v[2])
+
+
 class FrameField:
+    """Cross field over the vertices of the (decimated) mesh.
+
+    Every per vertex quantity is a dense array indexed by vertex: the frame axes
+    field_u and field_v with their strength, valid where field_valid is set, and
+    the curvature and sharpness, valid where curvature_valid is set. The frame
+    normal is field_u x field_v. That is 66 bytes per vertex,
+    benchmarks.compare_field_storage measures it against the former dicts of
+    CrossFrame objects and floats.
+    """
 
-    def __init__(self, obj):
-        self.bm = bmesh.new()
-        self.bm.from_mesh(obj.data)
-        bmesh.ops.triangulate(self.bm, faces=self.bm.faces)
-        self.bm.verts.ensure_lookup_table()
-        self.bm.edges.ensure_lookup_table()
-        self.bm.faces.ensure_lookup_table()
-        self.tree = bvhtree.BVHTree.FromBMesh(self.bm)
-        self.vert_field = {}
-        self.sharpness_field = {}
-        self.face_field = {}
-        self.mesh_curvature = {}
+    def __init__(self, mesh, tree, bm=None):
+        self.bm = bm
+        self.tree = tree
+        self.mesh = mesh
+
+        count = len(self.mesh)
+        self.field_u = np.zeros((count, 3))
+        self.field_v = np.zeros((count, 3))
+        self.field_strength = np.zeros(count, dtype=np.float32)
+        self.field_valid = np.zeros(count, dtype=np.bool_)
+        self.curvature = np.zeros(count)
+        self.sharpness = np.zeros(count, dtype=np.float32)
+        self.curvature_valid = np.zeros(count, dtype=np.bool_)
         self.max_curvature = 0
-        self.min_curvatire = 0
+        self.min_curvature = 0
+        self.face_frames = None
+        self.connection = None
+
+    @classmethod
+    def from_object(cls, obj):
+        bm = bmesh.new()
+        bm.from_mesh(obj.data)
+        bmesh.ops.triangulate(bm, faces=bm.faces)
+        bm.verts.ensure_lookup_table()
+        bm.edges.ensure_lookup_table()
+        bm.faces.ensure_lookup_table()
+        return cls(MeshArrays.from_bmesh(bm), bvhtree.BVHTree.FromBMesh(bm), bm)
+
+    @classmethod
+    def from_geometry(cls, co, polygons):
+        """Field over plain vertex and face arrays, sampled through a TriangleGrid."""
+        mesh = MeshArrays.from_polygons(co, polygons)
+        return cls(mesh, TriangleGrid(mesh.co, mesh.faces))
+
+    array_names = ("field_u", "field_v", "field_strength", "field_valid", "curvature", "sharpness", "curvature_valid")
+
+    def to_arrays(self):
+        """The built field, used by the on-disk field cache."""
+        return {name: getattr(self, name) for name in self.array_names}
+
+    def from_arrays(self, data):
+        for name in self.array_names:
+            setattr(self, name, np.array(data[name], dtype=getattr(self, name).dtype))
+        self.update_curvature_range()
+        self.face_frames = None
+
+    def set_frames(self, rows, vec, normal, strength=1.):
+        """Sets the frames of rows like CrossFrame(vec, normal, strength) would."""
+        self.field_u[rows], self.field_v[rows] = cross_frames(vec, normal)
+        self.field_strength[rows] = strength
+        self.field_valid[rows] = True
+        self.face_frames = None
+
+    def build_connection(self):
+        """Tangent bases and the neighbor rotations used by the 4-symmetric field operations."""
+        self.basis_u, self.basis_v = tangent_basis(self.mesh.normals)
+        self.connection = rosy_connection(self.mesh, self.basis_u, self.basis_v)
+
+    def field_rosy(self, rows):
+        if self.connection is None:
+            self.build_connection()
+        return rosy_from_vectors(self.field_u[rows], self.basis_u[rows], self.basis_v[rows])
+
+    def set_rosy(self, rows, rosy):
+        u = vectors_from_rosy(rosy, self.basis_u[rows], self.basis_v[rows])
+        self.set_frames(rows, u, self.mesh.normals[rows])
 
-    def build_major_curvatures(self):
+    def frame_normals(self):
+        return np.cross(self.field_u, self.field_v)
+
+    def update_curvature_range(self):
+        if self.curvature_valid.any():
+            self.max_curvature = self.curvature[self.curvature_valid].max()
+            self.min_curvature = self.curvature[self.curvature_valid].min()
+
+    def build_sampling_data(self):
+        """Caches per face vertex positions, curvatures and aligned frame vectors for HitInfo."""
+        faces = self.mesh.faces
+        self.face_origin, self.face_dual = barycentric_basis(self.mesh.co[faces])
+        self.face_curvature = np.where(self.curvature_valid, self.curvature, 0)[faces]
+        face_u = self.field_u[faces]
+        self.face_frames = nearest_frame_vectors(face_u, self.field_v[faces], face_u[:, :1])
+        self.face_frame_valid = self.field_valid[faces].all(axis=1)
+
+    def build_major_curvatures(self, vectorized=True):
+        if not vectorized:
+            return self.build_major_curvatures_loop()
+
+        direction, sharpness, curvature, valid = major_curvatures(self.mesh)
+        rows = np.flatnonzero(valid)
+        self.field_valid[:] = False
+        self.set_frames(rows, direction[rows], self.mesh.normals[rows], sharpness[rows])
+        self.sharpness = sharpness.astype(np.float32)
+        self.curvature = curvature
+        self.curvature_valid = valid
+        self.update_curvature_range()
+        self.ready = True
+        self.face_frames = None
+
+    def build_major_curvatures_loop(self):
         for vert in self.bm.verts:
             if len(vert.link_edges) == 0:
                 continue
@@ -121,107 +308,231 @@ class FrameField:
                 if le > 0:
                     sum_curvature += edge_vec.dot(other_vert.normal - vert.normal) / le
             sum_curvature /= len(vert.link_edges)
-            self.vert_field[vert.index] = CrossFrame(best_normal.cross(vert.normal), vert.normal, best_value)
-            self.sharpness_field[vert.index] = best_value
-            self.mesh_curvature[vert.index] = sum_curvature
-        self.max_curvature = max(self.mesh_curvature.values())
-        self.min_curvature = min(self.mesh_curvature.values())
+            frame = CrossFrame(best_normal.cross(vert.normal), vert.normal, best_value)
+            self.field_u[vert.index] = frame.u
+            self.field_v[vert.index] = frame.v
+            self.field_strength[vert.index] = best_value
+            self.field_valid[vert.index] = True
+            self.sharpness[vert.index] = best_value
+            self.curvature[vert.index] = sum_curvature
+            self.curvature_valid[vert.index] = True
+        self.update_curvature_range()
         self.ready = True
+        self.face_frames = None
 
-    def from_grease_pencil(self, gp_frame, mat, x_mirror=False):
-
-        new_field = {}
-        for stroke in gp_frame.strokes:
-            for i in range(len(stroke.points) - 1):
-                p0 = mat * stroke.points[i].co
-                p1 = mat * stroke.points[i + 1].co
+    def from_grease_pencil(self, strokes, x_mirror=False, replace=True, strength=1.):
+        """Frames along strokes, lists of Vectors in object space, see ParticleManager.gp_strokes."""
+        rows = []
+        vecs = []
+        normals = []
+        for stroke in strokes:
+            for i in range(len(stroke) - 1):
+                p0 = stroke[i]
+                p1 = stroke[i + 1]
                 p_avg = (p0 + p1) / 2
                 d = (p0 - p1).normalized()
                 location, normal, face_index, distance = self.tree.find_nearest(p_avg)
                 for vert in self.bm.faces[face_index].verts:
-                    i = vert.index
-                    new_field[i] = CrossFrame(d, vert.normal)
+                    rows.append(vert.index)
+                    vecs.append(d)
+                    normals.append(vert.normal)
 
                 if x_mirror:
                     p_avg.x = -p_avg.x
                     location, normal, face_index, distance = self.tree.find_nearest(p_avg)
                     for vert in self.bm.faces[face_index].verts:
-                        i = vert.index
-                        new_field[i] = CrossFrame(d.reflect(Vector((1, 0, 0))), normal)
-        if new_field:
-            self.vert_field = new_field
+                        rows.append(vert.index)
+                        vecs.append(d.reflect(Vector((1, 0, 0))))
+                        normals.append(normal)
+        if rows:
+            if replace:
+                self.field_valid[:] = False
+            # later strokes overwrite earlier ones on shared vertices
+            self.set_frames(rows, np.array(vecs).reshape(-1, 3), np.array(normals).reshape(-1, 3), strength)
 
     def erase_part(self, factor=3):
-        target_size = 1 + len(self.vert_field) / factor
-        for item in (sorted(self.vert_field.items(), key=lambda i: i[1].strength)):
-            del self.vert_field[item[0]]
-            if len(self.vert_field) <= target_size:
+        """Keeps about 1 / factor of the frames, the strongest ones."""
+        rows = np.flatnonzero(self.field_valid)
+        if not len(rows):
+            return
+        target_size = 1 + len(rows) / factor
+        erased = max(1, int(np.ceil(len(rows) - target_size)))
+        weakest = rows[np.argsort(self.field_strength[rows], kind="mergesort")]
+        self.field_valid[weakest[:erased]] = False
+        self.face_frames = None
+
+    def marching_growth(self, vectorized=True):
+        """Extends the field to every connected vertex, one BFS level at a time.
+
+        Each new vertex gets the 4-symmetric average of its neighbors from the
+        previous levels.
+        """
+        if not vectorized:
+            return self.marching_growth_loop()
+
+        mesh = self.mesh
+        seen = self.field_valid.copy()
+        rosy = np.zeros(len(mesh), dtype=np.complex128)
+        rows = np.flatnonzero(seen)
+        if not len(rows):
+            return
+        rosy[rows] = self.field_rosy(rows)
+
+        grown = []
+        level = rows
+        while True:
+            check_cancelled()
+            front = np.unique(mesh.indices[csr_entries(mesh.indptr, level)])
+            front = front[~seen[front]]
+            if not len(front):
                 break
+            entries = csr_entries(mesh.indptr, front)
+            entries = entries[seen[mesh.indices[entries]]]
+            position = np.searchsorted(front, mesh.edge_source[entries])
+            value = self.connection[entries] * rosy[mesh.indices[entries]]
+            total = np.bincount(position, value.real, len(front)) + 1j * np.bincount(position, value.imag, len(front))
+            length = np.abs(total)
+            # opposite neighbors can cancel out, the first one decides then
+            first = value[np.searchsorted(position, np.arange(len(front)))]
+            rosy[front] = np.where(length > 1e-9, total / np.maximum(length, 1e-9), first)
+            seen[front] = True
+            grown.append(front)
+            level = front
+
+        if grown:
+            grown = np.concatenate(grown)
+            self.set_rosy(grown, rosy[grown])
+        self.face_frames = None
+
+    def marching_growth_loop(self):
+        indptr = self.mesh.indptr.tolist()
+        indices = self.mesh.indices.tolist()
+        seen = self.field_valid.tolist()
+        field_u = self.field_u.tolist()
+        field_v = self.field_v.tolist()
 
-    def marching_growth(self):
-        seen_verts = set(self.bm.verts[i] for i in self.vert_field.keys())
         current_front = set()
-        for vert in seen_verts:
-            for edge in vert.link_edges:
-                other_vert = edge.other_vert(vert)
-                if other_vert not in seen_verts:
-                    current_front.add(other_vert)
+        for index in np.flatnonzero(self.field_valid).tolist():
+            for other in indices[indptr[index]:indptr[index + 1]]:
+                if not seen[other]:
+                    current_front.add(other)
 
-        while True:
+        while current_front:
+            check_cancelled()
             new_front = set()
-            for vert in current_front:
-                u = Vector()
+            grown = []
+            grown_u = []
+            for index in current_front:
+                u = None
                 connected_frames = 0
-                for edge in vert.link_edges:
-                    other_vert = edge.other_vert(vert)
-                    if other_vert in seen_verts:
-                        if not connected_frames:
-                            u += self.vert_field[other_vert.index].u
-                            connected_frames += 1
-                        else:
-                            u += self.vert_field[other_vert.index].get_nearest_vec(u)
-                            connected_frames += 1
+                for other in indices[indptr[index]:indptr[index + 1]]:
+                    if seen[other]:
+                        vec = field_u[other] if u is None else _nearest_vec(field_u[other], field_v[other], u)
+                        u = vec if u is None else (u[0] + vec[0], u[1] + vec[1], u[2] + vec[2])
+                        connected_frames += 1
                     else:
-                        new_front.add(other_vert)
+                        new_front.add(other)
                 if connected_frames:
-                    self.vert_field[vert.index] = CrossFrame(u / connected_frames, vert.normal)
-                    seen_verts.add(vert)
-            current_front = new_front
-            if len(new_front) == 0:
-                break
+                    grown.append(index)
+                    grown_u.append([c / connected_frames for c in u])
+
+            if grown:
+                self.set_frames(grown, np.array(grown_u), self.mesh.normals[grown])
+                for index, u, v in zip(grown, self.field_u[grown].tolist(), self.field_v[grown].tolist()):
+                    seen[index] = True
+                    field_u[index] = u
+                    field_v[index] = v
+            current_front = set(index for index in new_front if not seen[index])
+        self.face_frames = None
 
-    def smooth(self, iterations=2):
+    def smooth(self, iterations=2, vectorized=True):
+        """Replaces each frame by the 4-symmetric average of its neighbors.
+
+        Frames are encoded as exp(4i * angle) in a fixed tangent basis so one
+        iteration is a sparse complex matrix product over the adjacency.
+        """
+        if not vectorized:
+            return self.smooth_loop(iterations)
+
+        mesh = self.mesh
+        rows = np.flatnonzero(self.field_valid)
+        if not len(rows):
+            return
+        rosy = np.zeros(len(mesh), dtype=np.complex128)
+        rosy[rows] = self.field_rosy(rows)
+        weight = self.connection * self.field_valid[mesh.indices]
         for _ in range(iterations):
-            new_vert_field = {}
-            new_curvature = {}
-            for index in self.vert_field.keys():
-                vert = self.bm.verts[index]
+            value = weight * rosy[mesh.indices]
+            total = mesh.segment_sum(value.real) + 1j * mesh.segment_sum(value.imag)
+            length = np.abs(total)
+            update = self.field_valid & (length > 1e-9)
+            rosy[update] = total[update] / length[update]
+        self.set_rosy(rows, rosy[rows])
+        self.face_frames = None
+
+    def solve(self, alignment=1., max_iterations=200, tolerance=1e-4):
+        """Replaces the field by the smoothest one softly aligned to the current frames.
+
+        Each frame pulls with alignment * (strength / strongest) ^ 2, so weak
+        curvature directions barely matter. Unlike marching_growth and smooth the
+        result doesn't depend on seed order, and the cost is bounded by
+        max_iterations sparse products whatever the mesh size.
+        """
+        rows = np.flatnonzero(self.field_valid)
+        if not len(rows):
+            return
+        mesh = self.mesh
+        strength = self.field_strength[rows].astype(np.float64)
+        strongest = strength.max()
+        strength = strength / strongest if strongest > 0 else np.ones(len(rows))
+
+        target = np.zeros(len(mesh), dtype=np.complex128)
+        target[rows] = self.field_rosy(rows)
+        weight = np.zeros(len(mesh))
+        weight[rows] = alignment * strength * strength
+        rosy, iterations = solve_rosy(mesh, self.connection, target, weight, target, max_iterations, tolerance)
+        profiling.count("field_iterations", iterations)
+
+        # vertices no constraint reaches stay as they are
+        solved = np.flatnonzero(np.abs(rosy) > 1e-12)
+        self.set_rosy(solved, rosy[solved])
+        self.face_frames = None
+
+    def smooth_loop(self, iterations=2):
+        indptr = self.mesh.indptr.tolist()
+        indices = self.mesh.indices.tolist()
+        for _ in range(iterations):
+            rows = np.flatnonzero(self.field_valid)
+            valid = self.field_valid.tolist()
+            field_u = self.field_u.tolist()
+            field_v = self.field_v.tolist()
+            new_u = []
+            for index in rows.tolist():
                 count = 1
-                u = Vector()
-                c = 0
-                for edge in vert.link_edges:
-                    i = edge.other_vert(vert).index
-                    if i in self.vert_field:
-                        u += self.vert_field[i].get_nearest_vec(u)
-                        c += self.mesh_curvature[i]
+                u = (0.0, 0.0, 0.0)
+                for i in indices[indptr[index]:indptr[index + 1]]:
+                    if valid[i]:
+                        vec = _nearest_vec(field_u[i], field_v[i], u)
+                        u = (u[0] + vec[0], u[1] + vec[1], u[2] + vec[2])
                         count += 1
-                u /= count
-                c /= count
-                new_vert_field[index] = CrossFrame(u, vert.normal)
-                new_curvature[index] = c
-            self.vert_field = new_vert_field
+                new_u.append([c / count for c in u])
+            self.set_frames(rows, np.array(new_u).reshape(-1, 3), self.mesh.normals[rows])
+        self.face_frames = None
 
     def mirror_field(self):
-        new_field = {}
-        for vert in self.bm.verts:
-            if vert.co.x < 0:
-                new_field[vert.index] = self.vert_field[vert.index]
-            else:
-                vec = self.sample_point(vert.co).frame.u
-                new_field[vert.index] = CrossFrame(vec, vert.normal)
-        self.vert_field = new_field
+        rows = np.flatnonzero(self.mesh.co[:, 0] >= 0)
+        hits = self.sample_points(self.mesh.co[rows])
+        self.set_frames(rows, hits.frame_u, self.mesh.normals[rows])
+
+    def sample_points(self, points):
+        if self.face_frames is None:
+            self.build_sampling_data()
+        return HitArrays(points, self)
 
     def sample_point(self, point):
+        if self.face_frames is None:
+            self.build_sampling_data()
+        profiling.count("bvh_queries")
         hit = self.tree.find_nearest(point)
         if None not in hit:
             return HitInfo(*hit, self)
@@ -230,11 +541,11 @@ class FrameField:
 
     def preview_field(self, out):
         bm = bmesh.new()
-        for index in self.vert_field.keys():
+        for index in np.flatnonzero(self.field_valid).tolist():
             vert = self.bm.verts[index]
             v0 = bm.verts.new(vert.co)
-            for v in self.vert_field[vert.index].u, self.vert_field[vert.index].v:
-                c = 0.5 / self.mesh_curvature[index]
+            for v in Vector(self.field_u[index]), Vector(self.field_v[index]):
+                c = 0.5 / self.curvature[index]
                 n_vert = bm.verts.new(v * c + vert.co)
                 bm.edges.new((v0, n_vert))
                 n_vert = bm.verts.new(-v * c + vert.co)